@@ -1,35 +1,216 @@
-import discord
+import asyncio
 from logger import logging as logger
+from metrics import ROLE_GRANT_LATENCY, timed
 
 
+class RoleAssigner:
+    """
+    Grants Discord roles through one long-lived gateway connection per process.
 
-async def assign_role_to_user(bot_token, guild_id, MEMBER_NAME, role_name):
-    intents = discord.Intents.default()
-    intents.members = True
+    Guild members are indexed by name and roles are cached by name. Both are kept current from gateway
+    events, so granting a role by user id needs no lookups. Grants go through a queue that is drained
+    one at a time and backs off when Discord answers with 429. discord.py is imported and the gateway connection
+    opened by the first grant, so a process that never grants a role pays for neither.
 
-    client = discord.Client(intents=intents)
-    async with client:
-        await client.login(bot_token)
-        guild = await client.fetch_guild(guild_id)
-        if not guild:
-            logger.info(f"Server with ID {guild_id} not found.")
-            return
+    A connection that fails, or whose members cannot be indexed, is rebuilt with a new client after
+    `RECONNECT_DELAY` seconds, doubled after each failure up to `MAX_RECONNECT_DELAY`. Grants wait up to
+    `connect_timeout` seconds for a connection being opened and fail right away while there is none, so their
+    caller can retry them.
+    """
+
+    RECONNECT_DELAY = 1
+    MAX_RECONNECT_DELAY = 300
+
+    def __init__(self, bot_token, guild_id, min_interval=0.5, connect_timeout=30):
+        self.bot_token = bot_token
+        self.guild_id = int(guild_id)
+        self.min_interval = min_interval
+        self.connect_timeout = connect_timeout
+        self.client = None
+        self.members = {}
+        self.roles = {}
+        self.queue = asyncio.Queue()
+        self._indexed = asyncio.Event()
+        self._connecting = False
+        self._tasks = []
+
+    async def start(self):
+        """
+        Connects to the gateway and starts draining the grant queue in the background.
+        """
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._run()),
+                asyncio.create_task(self._process_queue()),
+            ]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    def _build_client(self):
+        import discord
 
-        member_id = 0
+        intents = discord.Intents.default()
+        intents.members = True
+        client = discord.Client(intents=intents)
+        for handler in (self.on_ready, self.on_member_join, self.on_member_update, self.on_member_remove,
+                        self.on_guild_role_create, self.on_guild_role_update, self.on_guild_role_delete):
+            setattr(client, handler.__name__, handler)
+        return client
 
-        async for member in guild.fetch_members(limit=1000):
-            if member.name == MEMBER_NAME:
-                member_id = member.id
+    async def _run(self):
+        delay = self.RECONNECT_DELAY
+        while True:
+            self.client = self._build_client()
+            self._connecting = True
+            try:
+                # Returns once the client is closed, as `on_ready` does when it fails
+                await self.client.start(self.bot_token)
+                logger.info("Discord connection closed, reconnecting")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.bind(rate_limit='discord_connect').exception(f"Failed to connect to Discord: {e}")
+            if self._indexed.is_set():
+                delay = self.RECONNECT_DELAY
+            self._indexed.clear()
+            self._connecting = False
+            try:
+                await self.client.close()
+            except Exception as e:
+                logger.info(f"Failed to close the Discord client: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
 
-        member = await guild.fetch_member(member_id)
-        if not member:
-            logger.info(f"User with ID {member_id} not found on server '{guild.name}'.")
+    async def assign(self, role_name, user_id=None, username=None):
+        """
+        Queues a role grant and waits for it to be applied, connecting to Discord first if needed.
+
+        Args:
+            role_name (str): The name of the role to grant.
+            user_id (int): The Discord user id. Preferred over `username` when known.
+            username (str): The Discord username, used to look the member up when no id is known.
+
+        Returns:
+            bool: True if the role has been granted.
+        """
+        await self.start()
+        done = asyncio.get_running_loop().create_future()
+        await self.queue.put((role_name, user_id, username, done))
+        return await done
+
+    async def on_ready(self):
+        guild = self.client.get_guild(self.guild_id)
+        if guild is None:
+            logger.info(f"Server with ID {self.guild_id} not found.")
+            self._indexed.set()
             return
+        if not guild.chunked:
+            try:
+                await guild.chunk()
+            except Exception as e:
+                # discord.py only logs errors of event handlers, so reconnect instead of staying unindexed
+                logger.exception(f"Failed to index the members of server '{guild.name}': {e}")
+                await self.client.close()
+                return
+        self.members = {member.name: member.id for member in guild.members}
+        self.roles = {role.name: role for role in guild.roles}
+        logger.info(f"Indexed {len(self.members)} members and {len(self.roles)} roles on server '{guild.name}'.")
+        self._indexed.set()
+
+    async def on_member_join(self, member):
+        if member.guild.id == self.guild_id:
+            self.members[member.name] = member.id
+
+    async def on_member_update(self, before, after):
+        if after.guild.id == self.guild_id and before.name != after.name:
+            self.members.pop(before.name, None)
+            self.members[after.name] = after.id
 
-        role = discord.utils.get(guild.roles, name=role_name)
+    async def on_member_remove(self, member):
+        if member.guild.id == self.guild_id:
+            self.members.pop(member.name, None)
+
+    async def on_guild_role_create(self, role):
+        if role.guild.id == self.guild_id:
+            self.roles[role.name] = role
+
+    async def on_guild_role_update(self, before, after):
+        if after.guild.id == self.guild_id:
+            self.roles.pop(before.name, None)
+            self.roles[after.name] = after
+
+    async def on_guild_role_delete(self, role):
+        if role.guild.id == self.guild_id:
+            self.roles.pop(role.name, None)
+
+    async def _process_queue(self):
+        import discord
+
+        while True:
+            role_name, user_id, username, done = await self.queue.get()
+            # discord.py flags the client ready before `on_ready` has run, so wait for the index instead
+            if not self._indexed.is_set() and self._connecting:
+                try:
+                    await asyncio.wait_for(self._indexed.wait(), self.connect_timeout)
+                except asyncio.TimeoutError:
+                    pass
+            if not self._indexed.is_set():
+                logger.info(f"Not connected to Discord, failed to assign role '{role_name}'")
+                if not done.done():
+                    done.set_result(False)
+                continue
+            while not done.done():
+                try:
+                    with timed(ROLE_GRANT_LATENCY) as stage:
+                        granted = await self._grant(role_name, user_id, username)
+                        stage.outcome = 'ok' if granted else 'not_found'
+                    done.set_result(granted)
+                except discord.HTTPException as e:
+                    if e.status != 429:
+                        logger.info(f"Failed to assign role '{role_name}': {e}")
+                        done.set_result(False)
+                        break
+                    retry_after = float(e.response.headers.get('Retry-After', 1))
+                    logger.info(f"Rate limited by Discord, retrying in {retry_after}s")
+                    await asyncio.sleep(retry_after)
+                except Exception as e:
+                    done.set_exception(e)
+            await asyncio.sleep(self.min_interval)
+
+    async def _grant(self, role_name, user_id, username):
+        import discord
+
+        guild = self.client.get_guild(self.guild_id)
+        if guild is None:
+            logger.info(f"Server with ID {self.guild_id} not found.")
+            return False
+
+        if user_id is None:
+            user_id = self.members.get(username)
+        if user_id is None:
+            logger.info(f"User '{username}' not found on server '{guild.name}'.")
+            return False
+
+        member = guild.get_member(int(user_id))
+        if member is None:
+            try:
+                member = await guild.fetch_member(int(user_id))
+            except discord.NotFound:
+                logger.info(f"User with ID {user_id} not found on server '{guild.name}'.")
+                return False
+
+        role = self.roles.get(role_name)
         if not role:
             logger.info(f"Role '{role_name}' not found on server '{guild.name}'.")
-            return
+            return False
 
         await member.add_roles(role)
-        logger.info(f"Role '{role_name}' has been assigned to user '{member.display_name}' on server '{guild.name}'.")
\ No newline at end of file
+        logger.info(f"Role '{role_name}' has been assigned to user '{member.display_name}' on server '{guild.name}'.")
+        return True
@@ -0,0 +1,151 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from eth_account import Account
+from eth_account.hdaccount import key_from_seed, seed_from_mnemonic
+from logger import logging as logger
+
+
+HD_PATH = "m/44'/60'/0'/0"
+
+
+def derive_addresses(seed, start, count):
+    """
+    Derives consecutive child addresses of an HD wallet seed.
+
+    Runs in a worker process, since each derivation is CPU-bound elliptic curve math.
+
+    Args:
+        seed (bytes): The BIP-39 seed of the master wallet.
+        start (int): The first child index.
+        count (int): The number of addresses to derive.
+
+    Returns:
+        list: (index, checksummed address) tuples.
+    """
+    return [
+        (index, Account.from_key(key_from_seed(seed, f"{HD_PATH}/{index}")).address)
+        for index in range(start, start + count)
+    ]
+
+
+class AddressPool:
+    """
+    Hands out deposit addresses derived by index from one HD wallet, pre-filled in Redis.
+
+    A background task keeps at least `low_watermark` ready addresses in a Redis list, deriving new ones
+    in a process pool, so `acquire` is a single LPOP. Addresses whose session expired unpaid are put on
+    a cooldown and handed out again afterwards. Newly derived addresses are marked as such, since only they
+    are known to hold no funds. The private key of any address can be recovered from the mnemonic and the
+    index stored with its session.
+    """
+
+    READY_KEY = 'address_pool_ready'
+    NEXT_INDEX_KEY = 'address_pool_next_index'
+    COOLDOWN_KEY = 'address_pool_cooldown'
+
+    # KEYS: cooldown set, ready list. ARGV: current timestamp. Moves matured addresses back atomically.
+    RECYCLE_SCRIPT = """
+    local entries = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    for _, entry in ipairs(entries) do
+        redis.call('ZREM', KEYS[1], entry)
+        redis.call('RPUSH', KEYS[2], entry)
+    end
+    return #entries
+    """
+
+    def __init__(self, redis, mnemonic=None, low_watermark=200, batch_size=100, cooldown=24 * 60 * 60):
+        """
+        Initializes the pool.
+
+        Args:
+            redis (Redis): The Redis client.
+            mnemonic (str): The mnemonic of the master wallet. Only needed by pools that derive addresses.
+            low_watermark (int): The number of ready addresses below which the pool is refilled.
+            batch_size (int): The number of addresses derived per refill step.
+            cooldown (float): Seconds an expired address waits before it is handed out again.
+        """
+        self.redis = redis
+        self.mnemonic = mnemonic
+        self.low_watermark = low_watermark
+        self.batch_size = batch_size
+        self.cooldown = cooldown
+        self._seed = None
+        self._executor = None
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._recycle = redis.register_script(self.RECYCLE_SCRIPT)
+
+    async def start(self):
+        """
+        Computes the master seed off the event loop and starts refilling the pool in the background.
+        """
+        self._executor = ProcessPoolExecutor(max_workers=1)
+        loop = asyncio.get_running_loop()
+        self._seed = await loop.run_in_executor(self._executor, seed_from_mnemonic, self.mnemonic, "")
+        await self.refill()
+        self._task = asyncio.create_task(self._refill_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def acquire(self):
+        """
+        Takes a ready address from the pool, deriving more first if the pool has run dry.
+
+        Returns:
+            tuple: The HD child index, the checksummed address and whether the address has never been handed
+                out before.
+        """
+        entry = await self.redis.lpop(self.READY_KEY)
+        while entry is None:
+            await self.refill()
+            entry = await self.redis.lpop(self.READY_KEY)
+        self._wakeup.set()
+        index, address, *marker = _decode(entry).split(':')
+        return int(index), address, marker == ['new']
+
+    async def release(self, index, address):
+        """
+        Returns an address whose session expired unpaid, to be handed out again after the cooldown.
+
+        Args:
+            index (int): The HD child index of the address.
+            address (str): The checksummed address.
+        """
+        await self.redis.zadd(self.COOLDOWN_KEY, {f"{index}:{address}": time.time() + self.cooldown})
+
+    async def refill(self):
+        """
+        Recycles addresses whose cooldown is over and derives new ones until the low watermark is reached.
+        """
+        await self._recycle(keys=[self.COOLDOWN_KEY, self.READY_KEY], args=[time.time()])
+        loop = asyncio.get_running_loop()
+        while await self.redis.llen(self.READY_KEY) < self.low_watermark:
+            start = await self.redis.incrby(self.NEXT_INDEX_KEY, self.batch_size) - self.batch_size
+            addresses = await loop.run_in_executor(
+                self._executor, derive_addresses, self._seed, start, self.batch_size
+            )
+            await self.redis.rpush(self.READY_KEY, *(f"{index}:{address}:new" for index, address in addresses))
+            logger.info(f"Derived deposit addresses {start}..{start + self.batch_size - 1}")
+
+    async def _refill_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=60)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.refill()
+            except Exception as e:
+                logger.exception(f"Failed to refill the address pool: {e}")
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
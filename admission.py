@@ -0,0 +1,231 @@
+import asyncio
+import time
+import uuid
+from dataclasses import dataclass
+import config
+from metrics import CHECKOUT_ADMISSIONS, PENDING_CHECKOUTS
+from sessions import PaymentSessions
+
+
+@dataclass
+class Decision:
+    """
+    The outcome of a checkout request.
+
+    Attributes:
+        outcome (str): One of the `CheckoutAdmission` outcomes.
+        payment_id (str): The id of the pending payment to reuse, for REUSED.
+        ticket (str): The reservation to bind the new payment to, for ADMITTED.
+        retry_after (float): Seconds after which the request may succeed, for RATE_LIMITED and BUSY.
+    """
+    outcome: str
+    payment_id: str = None
+    ticket: str = None
+    retry_after: float = None
+
+
+class CheckoutAdmission:
+    """
+    Decides whether a checkout request may open a new payment session.
+
+    A request for the same plan, network and token as a pending session of the same user gets that
+    session back. Otherwise the request is admitted only if the user is within a sliding-window rate limit
+    of `rate_limit` new sessions per `rate_window` seconds, has fewer than `max_per_user` pending sessions,
+    and fewer than `max_pending` sessions are pending overall. All checks and the reservation happen in
+    one Lua script, so concurrent requests cannot overshoot the limits. Sessions stop counting as pending
+    when they are released or their deadline passes, which bounds the deposits the watchers follow.
+    """
+
+    ADMITTED = 'admitted'
+    REUSED = 'reused'
+    RATE_LIMITED = 'rate_limited'
+    USER_LIMIT = 'user_limit'
+    BUSY = 'busy'
+
+    CHOICE_PREFIX = 'checkout_choice_'
+    USER_PREFIX = 'checkout_pending_'
+    RATE_PREFIX = 'checkout_rate_'
+    PENDING_KEY = 'checkout_pending'
+    TICKET_PREFIX = 'ticket:'
+
+    # KEYS: choice key, user pending set, global pending set, user rate window.
+    # ARGV: now, ticket, hold seconds, max per user, max pending, rate limit, rate window.
+    ADMIT_SCRIPT = """
+    local now = tonumber(ARGV[1])
+    local existing = redis.call('GET', KEYS[1])
+    if existing then
+        return {'existing', existing}
+    end
+    local window = tonumber(ARGV[7])
+    redis.call('ZREMRANGEBYSCORE', KEYS[4], '-inf', now - window)
+    if redis.call('ZCARD', KEYS[4]) >= tonumber(ARGV[6]) then
+        local oldest = redis.call('ZRANGE', KEYS[4], 0, 0, 'WITHSCORES')
+        return {'rate_limited', tostring(tonumber(oldest[2]) + window - now)}
+    end
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+    redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now)
+    if redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[4]) then
+        return {'user_limit', ''}
+    end
+    local pending = redis.call('ZCARD', KEYS[3])
+    if pending >= tonumber(ARGV[5]) then
+        local first = redis.call('ZRANGE', KEYS[3], 0, 0, 'WITHSCORES')
+        return {'busy', tostring(tonumber(first[2]) - now)}
+    end
+    redis.call('ZADD', KEYS[4], now, ARGV[2])
+    redis.call('EXPIRE', KEYS[4], math.ceil(window))
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[3]), ARGV[2])
+    redis.call('ZADD', KEYS[3], now + tonumber(ARGV[3]), ARGV[2])
+    if redis.call('TTL', KEYS[2]) < tonumber(ARGV[3]) then
+        redis.call('EXPIRE', KEYS[2], ARGV[3])
+    end
+    return {'admitted', tostring(pending + 1)}
+    """
+
+    # KEYS: choice key, user pending set, global pending set. ARGV: ticket, payment id, deadline, TTL.
+    BIND_SCRIPT = """
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[4])
+    for i = 2, 3 do
+        redis.call('ZREM', KEYS[i], ARGV[1])
+        redis.call('ZADD', KEYS[i], ARGV[3], ARGV[2])
+    end
+    if redis.call('TTL', KEYS[2]) < tonumber(ARGV[4]) then
+        redis.call('EXPIRE', KEYS[2], ARGV[4])
+    end
+    return 1
+    """
+
+    # KEYS: choice key. ARGV: expected value. Deletes the key only if it still holds that value.
+    RELEASE_CHOICE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, redis, sessions=None, max_per_user=None, max_pending=None, rate_limit=None, hold=30,
+                 wait=5):
+        """
+        Initializes the admission control. Limits default to `MAX_PENDING_PER_USER`, `MAX_PENDING_SESSIONS` and
+        `CHECKOUT_RATE_LIMIT` in `config.py`.
+
+        Args:
+            redis (Redis): The Redis client.
+            sessions (PaymentSessions): The payment session store, used to check sessions offered for reuse.
+            max_per_user (int): The most pending sessions per user.
+            max_pending (int): The most pending sessions overall.
+            rate_limit (tuple): The most new sessions per user and the window in seconds they are counted in.
+            hold (float): Seconds a reservation is held while its session is being created.
+            wait (float): Seconds a request waits for a concurrent identical request to create its session.
+        """
+        self.redis = redis
+        self.sessions = sessions or PaymentSessions(redis)
+        self.max_per_user = max_per_user or getattr(config, 'MAX_PENDING_PER_USER', 3)
+        self.max_pending = max_pending or getattr(config, 'MAX_PENDING_SESSIONS', 10000)
+        self.rate_limit, self.rate_window = rate_limit or getattr(config, 'CHECKOUT_RATE_LIMIT', (10, 60))
+        self.hold = hold
+        self.wait = wait
+        self._admit = redis.register_script(self.ADMIT_SCRIPT)
+        self._bind = redis.register_script(self.BIND_SCRIPT)
+        self._release_choice = redis.register_script(self.RELEASE_CHOICE_SCRIPT)
+
+    def _keys(self, user, plan, network, token):
+        return [
+            f"{self.CHOICE_PREFIX}{user}_{plan}_{network.lower()}_{token.lower()}",
+            f"{self.USER_PREFIX}{user}",
+            self.PENDING_KEY,
+            f"{self.RATE_PREFIX}{user}",
+        ]
+
+    async def admit(self, user, plan, network, token):
+        """
+        Admits, redirects or rejects a checkout request.
+
+        Args:
+            user (str): The Discord user id, or the username if the id is unknown.
+            plan (str): The plan name.
+            network (str): The network name.
+            token (str): The token symbol.
+
+        Returns:
+            Decision: The decision.
+        """
+        keys = self._keys(user, plan, network, token)
+        deadline = time.monotonic() + self.wait
+        while True:
+            ticket = f"{self.TICKET_PREFIX}{uuid.uuid4().hex}"
+            outcome, value = await self._admit(keys=keys, args=[
+                time.time(), ticket, self.hold, self.max_per_user, self.max_pending, self.rate_limit, self.rate_window,
+            ])
+            outcome, value = _decode(outcome), _decode(value)
+            if outcome == 'existing':
+                decision = await self._reuse(keys[0], value, deadline)
+                if decision is None:
+                    continue
+            elif outcome == self.ADMITTED:
+                PENDING_CHECKOUTS.set(int(value))
+                decision = Decision(self.ADMITTED, ticket=ticket)
+            elif outcome in (self.RATE_LIMITED, self.BUSY):
+                decision = Decision(outcome, retry_after=max(float(value), 1))
+            else:
+                decision = Decision(outcome)
+            CHECKOUT_ADMISSIONS.labels(outcome=decision.outcome).inc()
+            return decision
+
+    async def _reuse(self, choice_key, value, deadline):
+        if value.startswith(self.TICKET_PREFIX):
+            # An identical request is creating its session right now: wait for it and hand out the same one
+            if time.monotonic() >= deadline:
+                return Decision(self.BUSY, retry_after=1)
+            await asyncio.sleep(0.1)
+            return None
+        status, session_deadline = await self.sessions.get_status(value)
+        if status == PaymentSessions.PENDING and session_deadline > time.time():
+            return Decision(self.REUSED, payment_id=value)
+        await self._release_choice(keys=[choice_key], args=[value])
+        return None
+
+    async def bind(self, user, plan, network, token, ticket, payment_id, deadline):
+        """
+        Swaps the reservation of an admitted request for the session created for it.
+
+        Args:
+            user (str): The user the request was admitted for.
+            plan (str): The plan name.
+            network (str): The network name.
+            token (str): The token symbol.
+            ticket (str): The ticket of the admission decision.
+            payment_id (str): The id of the created payment.
+            deadline (float): Unix timestamp of the payment deadline.
+        """
+        keys = self._keys(user, plan, network, token)[:3]
+        await self._bind(keys=keys, args=[ticket, payment_id, deadline, max(int(deadline - time.time()), 1)])
+
+    async def release(self, user, payment_id, plan=None, network=None, token=None):
+        """
+        Stops counting a payment, or the ticket of a request that failed, as pending.
+
+        Args:
+            user (str): The user the payment belongs to.
+            payment_id (str): The id of the payment, or the ticket of the admission decision.
+            plan (str): The plan name. With the network and token, also frees the choice for a new session.
+            network (str): The network name.
+            token (str): The token symbol.
+        """
+        await self.redis.zrem(f"{self.USER_PREFIX}{user}", payment_id)
+        await self.redis.zrem(self.PENDING_KEY, payment_id)
+        if plan is not None:
+            choice_key = self._keys(user, plan, network, token)[0]
+            await self._release_choice(keys=[choice_key], args=[payment_id])
+
+
+def user_key(user_id, username):
+    """
+    Returns the key a user's checkouts are counted under: the Discord user id, or the username if the id is unknown.
+    """
+    return str(user_id) if user_id else username
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
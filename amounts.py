@@ -0,0 +1,123 @@
+import random
+from decimal import Decimal, ROUND_UP
+
+
+# A payment counts as paid once this share of its expected amount has arrived, in percent.
+PAID_THRESHOLD = 97
+
+# The smallest decimal place a dust tag is added at. Tokens with fewer decimals are tagged in base units.
+TAG_DECIMALS = 8
+
+
+def to_units(amount, decimals):
+    """
+    Converts a readable amount to token base units, rounding up.
+
+    Args:
+        amount (Decimal or str): The readable amount.
+        decimals (int): The decimals of the token.
+
+    Returns:
+        int: The amount in base units.
+    """
+    return int(Decimal(str(amount)).scaleb(decimals).to_integral_value(rounding=ROUND_UP))
+
+
+def from_units(units, decimals):
+    """
+    Converts an amount in token base units to a readable amount, without trailing zeros.
+
+    Args:
+        units (int): The amount in base units.
+        decimals (int): The decimals of the token.
+
+    Returns:
+        Decimal: The readable amount.
+    """
+    amount = Decimal(units).scaleb(-decimals)
+    return amount.quantize(Decimal(1)) if amount == amount.to_integral_value() else amount.normalize()
+
+
+def is_paid(received, expected):
+    """
+    Checks whether the base units received so far pay for an expected amount, within PAID_THRESHOLD.
+    """
+    return received * 100 >= expected * PAID_THRESHOLD
+
+
+def payment_id(address, network=None, token=None, amount=None):
+    """
+    Identifies a payment. A payment to its own deposit address is identified by the address; a payment to a
+    shared address by the address, network, token and its unique amount in base units.
+
+    Args:
+        address (str): The deposit address.
+        network (str): The network of a payment to a shared address.
+        token (str): The token symbol of a payment to a shared address.
+        amount (int): The tagged amount of a payment to a shared address.
+
+    Returns:
+        str: The payment id.
+    """
+    if amount is None:
+        return address.lower()
+    return f"{address.lower()}:{network.lower()}:{token.upper()}:{amount}"
+
+
+class AmountTags:
+    """
+    Hands out (shared address, amount) pairs that no other open payment uses, so many payments can share a
+    few receiving addresses and still be told apart by the amount of a single transfer.
+
+    The price of a plan is tagged with a random amount of dust: 1 to `tags - 1` steps of the token's
+    TAG_DECIMALS place. Each pair is reserved in Redis with SET NX until `hold` seconds after the session it
+    was issued for has expired, so a transfer that arrives late by up to `hold` seconds is not matched to a newer
+    payment. A transfer that arrives even later can be credited to a newer payment that got the same pair.
+    """
+
+    KEY_PREFIX = 'amount_tag_'
+
+    def __init__(self, redis, addresses, tags=1000, attempts=20, hold=24 * 60 * 60):
+        """
+        Initializes the tag issuer.
+
+        Args:
+            redis (Redis): The Redis client.
+            addresses (list): The shared receiving addresses.
+            tags (int): The number of distinct tags per address, token and price.
+            attempts (int): The number of random pairs tried before giving up.
+            hold (float): Seconds a pair stays reserved after its session has expired.
+        """
+        self.redis = redis
+        self.addresses = list(addresses)
+        self.tags = tags
+        self.attempts = attempts
+        self.hold = hold
+
+    @staticmethod
+    def step(decimals):
+        return 10 ** max(decimals - TAG_DECIMALS, 0)
+
+    async def reserve(self, network, token, amount, decimals, ttl):
+        """
+        Reserves a shared address and a unique amount for a payment.
+
+        Args:
+            network (str): The network of the payment.
+            token (str): The token symbol of the payment.
+            amount (int): The price in base units.
+            decimals (int): The decimals of the token.
+            ttl (float): Seconds until the session of the payment has expired. The pair is held `hold` seconds
+                longer.
+
+        Returns:
+            tuple: The shared address and the tagged amount in base units, or None if no free pair was found.
+        """
+        step = self.step(decimals)
+        for _ in range(self.attempts):
+            address = random.choice(self.addresses)
+            tagged = amount + random.randrange(1, self.tags) * step
+            key = f"{self.KEY_PREFIX}{payment_id(address, network, token, tagged)}"
+            if await self.redis.set(key, 1, nx=True, ex=max(int(ttl + self.hold), 1)):
+                return address, tagged
+        return None
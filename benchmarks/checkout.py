@@ -0,0 +1,262 @@
+"""
+Load test for the checkout and confirmation pipeline.
+
+Drives /choose_plan, /payment and /check_payment_status with a configurable number of concurrent
+buyers against local stand-ins: fakeredis (or a local Redis), a mock JSON-RPC node that lands each
+deposit a few blocks after checkout, and stubbed Discord, SMTP and CoinGecko clients. The report is
+printed as JSON so results can be compared between commits.
+
+Usage:
+    python -m benchmarks.checkout --sessions 200 --concurrency 50 --output bench_output.txt
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+import types
+from decimal import Decimal
+
+
+def percentiles(values):
+    """
+    Summarizes a list of samples.
+
+    Args:
+        values (list): The samples.
+
+    Returns:
+        dict: The p50, p95, p99 and max of the samples, or an empty dict if there are none.
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 3)
+
+    return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': round(values[-1], 3),
+            'mean': round(statistics.fmean(values), 3)}
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes up a task that sleeps for `interval` seconds.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append((loop.time() - started - self.interval) * 1000)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+
+def install_stubs(node_url, redis_url, block_time=None, confirmations=None, shared_addresses=0):
+    """
+    Points the application at the local stand-ins before it is imported.
+
+    Args:
+        node_url (str or list): The URL or URLs of the mock JSON-RPC node, used for every network.
+        redis_url (str): The URL of a local Redis server, or None to use fakeredis.
+        block_time (float): The block time of the mock node, used for every network.
+        confirmations (int): The confirmation depth of every network, or None for the defaults.
+        shared_addresses (int): The number of shared deposit addresses, 0 for one address per checkout.
+    """
+    install_config(node_url, block_time, confirmations, shared_addresses)
+    install_services(redis_url)
+
+
+def install_config(node_url, block_time=None, confirmations=None, shared_addresses=0):
+    """
+    Installs a `config` module pointing at the local stand-ins. See `install_stubs` for the arguments.
+    """
+    config = types.ModuleType('config')
+    config.DISCORD_OAUTH2_URL = 'http://localhost/oauth2'
+    config.CLIENT_ID = config.CLIENT_SECRET = config.SCOPE = 'benchmark'
+    config.REDIRECT_URI = 'http://localhost/oauth2/callback'
+    config.REDIS_HOST, config.REDIS_PORT, config.REDIS_PASSWD = 'localhost', 6379, None
+    config.TOKEN, config.GUILD_ID, config.ROLE_NAME = 'benchmark', 1, 'benchmark'
+    config.POLYGON_NODE_URL = config.ARBITRUM_NODE_URL = config.SEPOLIA_NODE_URL = node_url
+    config.GMAIL_USER, config.GMAIL_PASSWORD = 'benchmark@localhost', 'benchmark'
+    if block_time is not None:
+        config.BLOCK_TIMES = {'polygon': block_time, 'arbitrum': block_time, 'sepolia': block_time}
+    if confirmations is not None:
+        config.CONFIRMATIONS = {'polygon': confirmations, 'arbitrum': confirmations, 'sepolia': confirmations}
+    if shared_addresses:
+        config.SHARED_ADDRESSES = [f"0x{index + 1:040x}" for index in range(shared_addresses)]
+    sys.modules['config'] = config
+
+
+def install_services(redis_url, subsystems=True):
+    """
+    Replaces Redis, the ETH price source and, if `subsystems` is set, the Discord and SMTP clients with stand-ins.
+
+    Args:
+        redis_url (str): The URL of a local Redis server, or None to use fakeredis.
+        subsystems (bool): Whether to stub the Discord and SMTP clients too, which imports their modules.
+    """
+    import aioredis
+    if redis_url is None:
+        import fakeredis.aioredis
+        shared = fakeredis.FakeServer()
+        aioredis.from_url = lambda *args, **kwargs: fakeredis.aioredis.FakeRedis(server=shared)
+    else:
+        from_url = aioredis.from_url
+        aioredis.from_url = lambda *args, **kwargs: from_url(redis_url)
+
+    import utils
+
+    async def fixed_price(self):
+        self.price = 2000.0
+        self.updated_at = time.monotonic()
+
+    utils.PriceOracle._fetch = fixed_price
+
+    if not subsystems:
+        return
+
+    import add_role
+    import send_message
+
+    async def noop(self, *args, **kwargs):
+        return True
+
+    add_role.RoleAssigner.start = add_role.RoleAssigner.close = add_role.RoleAssigner.assign = noop
+    send_message.Mailer.start = send_message.Mailer.close = send_message.Mailer.send = send_message.Mailer.deliver = noop
+
+
+async def buyer(app, node, plan, token, network, poll_interval, results):
+    """
+    Runs one checkout from plan selection to confirmation.
+    """
+    from payments import Data
+
+    client = app.test_client()
+    async with client.session_transaction() as session:
+        session['username'] = f"buyer{id(client)}#0"
+        session['user_id'] = str(id(client))
+
+    started = time.perf_counter()
+    response = await client.post('/choose_plan', form={'plan': plan})
+    results['choose_plan'].append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    response = await client.post('/payment', json={'token': token, 'network': network})
+    results['payment'].append((time.perf_counter() - started) * 1000)
+    checkout = await response.get_json()
+    paid_at = time.perf_counter()
+
+    amount = int(Decimal(checkout['amount']).scaleb(node.decimals))
+    node.schedule_deposit(Data.CONTRACT_ADDRESSES[network][token.upper()], checkout['wallet_address'], amount)
+
+    while True:
+        started = time.perf_counter()
+        response = await client.get('/check_payment_status')
+        results['check_payment_status'].append((time.perf_counter() - started) * 1000)
+        status = await response.get_json()
+        if status['payment_confirmed']:
+            results['time_to_confirmation'].append(time.perf_counter() - paid_at)
+            return
+        if status['payment_timeout']:
+            results['timed_out'] += 1
+            return
+        await asyncio.sleep(poll_interval)
+
+
+async def run(args):
+    from benchmarks.mock_node import MockNode
+
+    node = MockNode(block_time=args.block_time)
+    await node.start()
+    for _ in range(args.endpoints - 1):
+        await node.add_endpoint()
+    if args.flaky_latency or args.flaky_error_rate:
+        await node.add_endpoint(latency=args.flaky_latency, error_rate=args.flaky_error_rate)
+    install_stubs(node.urls, args.redis_url, args.block_time, args.confirmations, args.shared_addresses)
+
+    from index import app
+
+    results = {'choose_plan': [], 'payment': [], 'check_payment_status': [], 'time_to_confirmation': [],
+               'timed_out': 0}
+    monitor = LoopLagMonitor()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited():
+        async with semaphore:
+            await buyer(app, node, args.plan, args.token, args.network, args.poll_interval, results)
+
+    async with app.test_app():
+        calls_before = node.total_calls()
+        monitor.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(limited() for _ in range(args.sessions)))
+        elapsed = time.perf_counter() - started
+        monitor.stop()
+        rpc_calls = node.total_calls() - calls_before
+
+    await node.close()
+
+    confirmed = len(results['time_to_confirmation'])
+    return {
+        'sessions': args.sessions,
+        'concurrency': args.concurrency,
+        'block_time_s': args.block_time,
+        'rpc_endpoints': len(node.urls),
+        'confirmations': args.confirmations,
+        'shared_addresses': args.shared_addresses,
+        'elapsed_s': round(elapsed, 3),
+        'confirmed': confirmed,
+        'timed_out': results['timed_out'],
+        'latency_ms': {
+            'choose_plan': percentiles(results['choose_plan']),
+            'payment': percentiles(results['payment']),
+            'check_payment_status': percentiles(results['check_payment_status']),
+        },
+        'time_to_confirmation_s': percentiles(results['time_to_confirmation']),
+        'rpc_calls': rpc_calls,
+        'rpc_calls_by_method': node.calls,
+        'rpc_calls_per_confirmed_payment': round(rpc_calls / confirmed, 3) if confirmed else None,
+        'event_loop_lag_ms': percentiles(monitor.samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=100, help='number of checkouts to run')
+    parser.add_argument('--concurrency', type=int, default=50, help='checkouts in flight at once')
+    parser.add_argument('--plan', default='basic_1_month')
+    parser.add_argument('--token', default='usdt')
+    parser.add_argument('--network', default='polygon')
+    parser.add_argument('--block-time', type=float, default=1.0, help='seconds per block of the mock node')
+    parser.add_argument('--confirmations', type=int, default=None, help='confirmation depth of every network')
+    parser.add_argument('--shared-addresses', type=int, default=0, help='shared deposit addresses, 0 for one per checkout')
+    parser.add_argument('--endpoints', type=int, default=1, help='healthy node endpoints per network')
+    parser.add_argument('--flaky-latency', type=float, default=0, help='adds an endpoint with this latency')
+    parser.add_argument('--flaky-error-rate', type=float, default=0, help='adds an endpoint failing this share of requests')
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='seconds between status checks')
+    parser.add_argument('--redis-url', default=None, help='local Redis to use instead of fakeredis')
+    parser.add_argument('--output', default=None, help='file to write the JSON report to')
+    args = parser.parse_args()
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
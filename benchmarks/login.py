@@ -0,0 +1,95 @@
+"""
+Load test for the Discord login callback.
+
+Drives /oauth2/callback with a configurable number of concurrent logins against a local mock of the Discord
+OAuth2 API, which can add per-request and per-connection latency and enforce a rate limit, and prints
+callback latency percentiles, Discord requests per route, connections opened and 429s as JSON. Logins cycle
+through `--users` distinct users, so every user after the first round logs in again with a cached identity.
+
+Usage:
+    python -m benchmarks.login --logins 500 --users 100 --concurrency 50 --connect-latency 0.1
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from benchmarks.checkout import install_stubs, percentiles
+
+
+async def run(args):
+    from benchmarks.mock_discord import MockDiscord
+    from benchmarks.mock_node import MockNode
+
+    node = MockNode(block_time=1.0)
+    await node.start()
+    discord = MockDiscord(
+        latency=args.latency, connect_latency=args.connect_latency, rate_limit=args.rate_limit, window=args.window,
+    )
+    await discord.start()
+    install_stubs(node.urls, args.redis_url)
+    sys.modules['config'].DISCORD_API_URL = discord.url
+
+    from index import app
+
+    latencies = []
+    failures = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def login(index):
+        nonlocal failures
+        async with semaphore:
+            client = app.test_client()
+            started = time.perf_counter()
+            response = await client.get('/oauth2/callback', query_string={'code': f"user{index % args.users}"})
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 302:
+                failures += 1
+
+    async with app.test_app():
+        started = time.perf_counter()
+        await asyncio.gather(*(login(index) for index in range(args.logins)))
+        elapsed = time.perf_counter() - started
+
+    await discord.close()
+    await node.close()
+
+    return {
+        'logins': args.logins,
+        'users': args.users,
+        'concurrency': args.concurrency,
+        'latency_s': args.latency,
+        'connect_latency_s': args.connect_latency,
+        'rate_limit': args.rate_limit,
+        'elapsed_s': round(elapsed, 3),
+        'failed': failures,
+        'latency_ms': percentiles(latencies),
+        'discord_calls': discord.calls,
+        'discord_connections': discord.connections,
+        'discord_rate_limited': discord.rate_limited,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=200, help='number of logins to run')
+    parser.add_argument('--users', type=int, default=50, help='distinct users the logins cycle through')
+    parser.add_argument('--concurrency', type=int, default=50, help='logins in flight at once')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds every Discord request takes')
+    parser.add_argument('--connect-latency', type=float, default=0.1, help='extra seconds for a new connection')
+    parser.add_argument('--rate-limit', type=int, default=None, help='Discord requests per route and window')
+    parser.add_argument('--window', type=float, default=1.0, help='seconds of the Discord rate limit window')
+    parser.add_argument('--redis-url', default=None, help='local Redis to use instead of fakeredis')
+    parser.add_argument('--output', default=None, help='file to write the JSON report to')
+    args = parser.parse_args()
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
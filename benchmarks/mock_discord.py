@@ -0,0 +1,113 @@
+import asyncio
+import time
+from aiohttp import web
+
+
+class MockDiscord:
+    """
+    A local Discord OAuth2 API serving the token exchange and `/users/@me`.
+
+    Any code is exchanged for the access token `token-<code>`, so logins with the same code get the same token,
+    and the token identifies the user `<code>`. Every request is delayed by `latency` seconds, and the first
+    request on a new connection additionally by `connect_latency`, which stands in for the TLS handshake.
+    Each route allows `rate_limit` requests per `window` seconds with Discord's rate-limit headers and answers
+    429 beyond that. Requests, connections and 429s are counted.
+    """
+
+    def __init__(self, latency=0, connect_latency=0, rate_limit=None, window=1.0):
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.rate_limit = rate_limit
+        self.window = window
+        self.calls = {}
+        self.rate_limited = 0
+        self.connections = 0
+        self._transports = set()
+        self._windows = {}
+        self._runner = None
+        self.url = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_post('/oauth2/token', self.token)
+        app.router.add_get('/v9/users/@me', self.me)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def token(self, request):
+        limited = await self._admit(request, 'token')
+        if limited is not None:
+            return limited
+        form = await request.post()
+        if not form.get('code'):
+            return web.json_response({'error': 'invalid_grant'}, status=400)
+        return web.json_response({
+            'access_token': f"token-{form['code']}",
+            'token_type': 'Bearer',
+            'expires_in': 604800,
+            'scope': form.get('scope', 'identify'),
+        }, headers=self._headers('token'))
+
+    async def me(self, request):
+        limited = await self._admit(request, 'identify')
+        if limited is not None:
+            return limited
+        authorization = request.headers.get('Authorization', '')
+        if not authorization.startswith('Bearer token-'):
+            return web.json_response({'message': '401: Unauthorized', 'code': 0}, status=401)
+        user = authorization[len('Bearer token-'):]
+        return web.json_response({
+            'id': str(abs(hash(user)) % 10 ** 18),
+            'username': user,
+            'discriminator': '0',
+        }, headers=self._headers('identify'))
+
+    async def _admit(self, request, route):
+        self.calls[route] = self.calls.get(route, 0) + 1
+        if request.transport not in self._transports:
+            self._transports.add(request.transport)
+            self.connections += 1
+            if self.connect_latency:
+                await asyncio.sleep(self.connect_latency)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rate_limit is None:
+            return None
+        started, count = self._window(route)
+        if count >= self.rate_limit:
+            self.rate_limited += 1
+            retry_after = round(started + self.window - time.monotonic(), 3)
+            return web.json_response(
+                {'message': 'You are being rate limited.', 'retry_after': retry_after, 'global': False},
+                status=429, headers={**self._headers(route), 'Retry-After': str(retry_after)},
+            )
+        self._windows[route] = (started, count + 1)
+        return None
+
+    def _window(self, route):
+        now = time.monotonic()
+        started, count = self._windows.get(route, (now, 0))
+        if now - started >= self.window:
+            started, count = now, 0
+        self._windows[route] = (started, count)
+        return started, count
+
+    def _headers(self, route):
+        if self.rate_limit is None:
+            return {}
+        started, count = self._window(route)
+        return {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(max(self.rate_limit - count, 0)),
+            'X-RateLimit-Reset-After': str(round(max(started + self.window - time.monotonic(), 0), 3)),
+            'X-RateLimit-Bucket': route,
+        }
@@ -0,0 +1,229 @@
+import asyncio
+import itertools
+import random
+import time
+from aiohttp import web
+from eth_abi import decode, encode
+from web3 import Web3
+
+
+TRANSFER_TOPIC = Web3.to_hex(Web3.keccak(text="Transfer(address,address,uint256)"))
+AGGREGATE3_SELECTOR = Web3.keccak(text='aggregate3((address,bool,bytes)[])')[:4]
+BALANCE_OF_SELECTOR = Web3.keccak(text='balanceOf(address)')[:4]
+DECIMALS_SELECTOR = Web3.keccak(text='decimals()')[:4]
+GET_ETH_BALANCE_SELECTOR = Web3.keccak(text='getEthBalance(address)')[:4]
+
+
+class MockNode:
+    """
+    A local JSON-RPC node that mines an empty block every `block_time` seconds and lands scheduled
+    ERC-20 deposits a given number of blocks after they were scheduled.
+
+    Only the calls made by the payment pipeline are implemented. Every request is counted per method.
+    Extra endpoints serving the same chain, each with its own latency, error rate and JSON-RPC error, can be
+    added with `add_endpoint` to exercise RPC failover, `mine` mines blocks on demand and `reorg` replaces recent
+    blocks with a competing fork.
+    """
+
+    def __init__(self, chain_id=137, block_time=1.0, decimals=6):
+        self.chain_id = chain_id
+        self.block_time = block_time
+        self.decimals = decimals
+        self.started_at = time.monotonic()
+        self.calls = {}
+        self.transfers = []
+        self.forks = []
+        self._transfer_ids = itertools.count()
+        self.balances = {}
+        self._runner = None
+        self.url = None
+        self.urls = []
+        self.endpoints = {}
+
+    @property
+    def head(self):
+        return int((time.monotonic() - self.started_at) / self.block_time)
+
+    def schedule_deposit(self, token_address, recipient, amount, after_blocks=3):
+        """
+        Schedules an ERC-20 transfer to land `after_blocks` blocks from now.
+
+        Args:
+            token_address (str): The token contract address.
+            recipient (str): The recipient address.
+            amount (int): The amount in token base units.
+            after_blocks (int): The number of blocks until the transfer is mined.
+        """
+        self.transfers.append({
+            'id': next(self._transfer_ids),
+            'block': self.head + after_blocks,
+            'token': token_address.lower(),
+            'to': recipient.lower(),
+            'amount': amount,
+        })
+
+    def mine(self, count=1):
+        """
+        Mines `count` blocks right away, on top of the blocks mined every `block_time` seconds.
+        """
+        self.started_at -= count * self.block_time
+
+    def reorg(self, depth, drop_transfers=True):
+        """
+        Replaces the last `depth` blocks with a competing fork.
+
+        Args:
+            depth (int): The number of blocks replaced.
+            drop_transfers (bool): Whether transfers in the replaced blocks are left out of the fork.
+                Otherwise they are included again at the same heights.
+        """
+        fork_block = self.head - depth + 1
+        self.forks.append(fork_block)
+        if drop_transfers:
+            self.transfers = [transfer for transfer in self.transfers if transfer['block'] < fork_block]
+
+    def block_hash(self, number):
+        epoch = sum(1 for fork_block in self.forks if fork_block <= number)
+        return Web3.to_hex(Web3.keccak(number.to_bytes(32, 'big') + epoch.to_bytes(4, 'big')))
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_post('/', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        self.url = await self.add_endpoint(host, port)
+        return self.url
+
+    async def add_endpoint(self, host='127.0.0.1', port=0, latency=0, error_rate=0, rpc_error=None):
+        """
+        Serves the chain on one more port.
+
+        Args:
+            latency (float): Seconds every request to the endpoint is delayed by.
+            error_rate (float): Share of requests answered with HTTP 503.
+            rpc_error (dict): The JSON-RPC error object every request is answered with, if any.
+
+        Returns:
+            str: The URL of the endpoint.
+        """
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.endpoints[port] = (latency, error_rate, rpc_error)
+        url = f"http://{host}:{port}/"
+        self.urls.append(url)
+        return url
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def handle(self, request):
+        latency, error_rate, rpc_error = self.endpoints.get(
+            request.transport.get_extra_info('sockname')[1], (0, 0, None)
+        )
+        if latency:
+            await asyncio.sleep(latency)
+        if random.random() < error_rate:
+            return web.Response(status=503)
+        body = await request.json()
+        if isinstance(body, list):
+            return web.json_response([self.dispatch(item, rpc_error) for item in body])
+        return web.json_response(self.dispatch(body, rpc_error))
+
+    def dispatch(self, request, rpc_error=None):
+        method = request['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if rpc_error is not None:
+            return {'jsonrpc': '2.0', 'id': request['id'], 'error': rpc_error}
+        handler = getattr(self, f"rpc_{method}", None)
+        if handler is None:
+            return {'jsonrpc': '2.0', 'id': request['id'], 'error': {'code': -32601, 'message': f"{method} not supported"}}
+        return {'jsonrpc': '2.0', 'id': request['id'], 'result': handler(*request.get('params', []))}
+
+    def _balance(self, token, owner):
+        return sum(
+            transfer['amount'] for transfer in self.transfers
+            if transfer['token'] == token and transfer['to'] == owner and transfer['block'] <= self.head
+        )
+
+    def _call(self, target, data):
+        selector, args = data[:4], data[4:]
+        if selector == DECIMALS_SELECTOR:
+            return encode(['uint8'], [self.decimals])
+        if selector == BALANCE_OF_SELECTOR:
+            owner = decode(['address'], args)[0].lower()
+            return encode(['uint256'], [self._balance(target.lower(), owner)])
+        if selector == GET_ETH_BALANCE_SELECTOR:
+            return encode(['uint256'], [0])
+        raise ValueError(f"Unsupported call {selector.hex()}")
+
+    def rpc_eth_chainId(self):
+        return hex(self.chain_id)
+
+    def rpc_net_version(self):
+        return str(self.chain_id)
+
+    def rpc_eth_blockNumber(self):
+        return hex(self.head)
+
+    def rpc_eth_getBalance(self, address, block='latest'):
+        return '0x0'
+
+    def rpc_eth_getBlockByNumber(self, number, full_transactions=False):
+        number = self.head if number == 'latest' else int(number, 16)
+        return {
+            'number': hex(number),
+            'hash': self.block_hash(number),
+            'parentHash': self.block_hash(max(number - 1, 0)),
+            'timestamp': hex(int(self.started_at + number * self.block_time)),
+            'transactions': [],
+        }
+
+    def rpc_eth_call(self, transaction, block='latest'):
+        target = transaction['to']
+        data = bytes.fromhex(transaction.get('data', transaction.get('input', '0x'))[2:])
+        if data[:4] == AGGREGATE3_SELECTOR:
+            calls = decode(['(address,bool,bytes)[]'], data[4:])[0]
+            results = []
+            for call_target, _, call_data in calls:
+                try:
+                    results.append((True, self._call(call_target, call_data)))
+                except ValueError:
+                    results.append((False, b''))
+            return '0x' + encode(['(bool,bytes)[]'], [results]).hex()
+        return '0x' + self._call(target, data).hex()
+
+    def rpc_eth_getLogs(self, log_filter):
+        from_block = int(log_filter['fromBlock'], 16)
+        to_block = int(log_filter['toBlock'], 16)
+        addresses = log_filter.get('address') or []
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        addresses = {address.lower() for address in addresses}
+
+        logs = []
+        for transfer in self.transfers:
+            if not from_block <= transfer['block'] <= to_block:
+                continue
+            if addresses and transfer['token'] not in addresses:
+                continue
+            logs.append({
+                'address': Web3.to_checksum_address(transfer['token']),
+                'topics': [
+                    TRANSFER_TOPIC,
+                    '0x' + '00' * 32,
+                    '0x' + '00' * 12 + transfer['to'][2:],
+                ],
+                'data': '0x' + transfer['amount'].to_bytes(32, 'big').hex(),
+                'blockNumber': hex(transfer['block']),
+                'blockHash': self.block_hash(transfer['block']),
+                'transactionHash': '0x' + transfer['id'].to_bytes(32, 'big').hex(),
+                'transactionIndex': '0x0',
+                'logIndex': '0x0',
+                'removed': False,
+            })
+        return logs
@@ -0,0 +1,151 @@
+"""
+Startup-time benchmark.
+
+Starts fresh interpreters and measures, for the web app, the time to import `index`, to run its startup and
+to answer the first request, and, for a standalone worker, the time to import `worker` and to start consuming
+jobs. Times are measured from the moment the process was spawned, so they include interpreter startup. Runs
+against fakeredis and a mock JSON-RPC node, and prints the median of `--runs` runs as JSON together with the
+heavy modules each process had loaded once it was ready.
+
+Usage:
+    python -m benchmarks.startup --runs 5 --output startup_output.txt
+    python -m benchmarks.startup --runs 5 --lazy
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules whose import cost the startup path tries to avoid or defer
+HEAVY_MODULES = ('web3', 'eth_account', 'discord', 'aiosmtplib', 'httpx')
+
+
+def loaded_modules():
+    return [name for name in HEAVY_MODULES if name in sys.modules]
+
+
+async def web(spawned_at, node_url, lazy):
+    from benchmarks.checkout import install_config, install_services
+
+    install_config(node_url)
+    sys.modules['config'].LAZY_STARTUP = lazy
+    import index
+    imported_at = time.time()
+    install_services(None, subsystems=False)
+
+    app = index.app
+    async with app.test_app():
+        started_at = time.time()
+        response = await app.test_client().get('/')
+        answered_at = time.time()
+        assert response.status_code == 200, response.status_code
+        modules = loaded_modules()
+        await app.network
+        network_at = time.time()
+
+    return {
+        'import_s': imported_at - spawned_at,
+        'startup_s': started_at - spawned_at,
+        'first_request_s': answered_at - spawned_at,
+        'network_ready_s': network_at - spawned_at,
+        'modules_at_first_request': modules,
+    }
+
+
+async def worker(spawned_at, node_url):
+    from benchmarks.checkout import install_config, install_services
+
+    install_config(node_url)
+    import worker
+    imported_at = time.time()
+    install_services(None, subsystems=False)
+
+    import aioredis
+    redis = aioredis.from_url('redis://localhost')
+    payments = worker.Payments()
+    await payments.connect()
+    await payments.warm_up()
+    payment_worker = worker.PaymentWorker(redis, payments)
+    await payment_worker.start()
+    ready_at = time.time()
+    modules = loaded_modules()
+    await payment_worker.stop()
+    await payments.close()
+
+    return {
+        'import_s': imported_at - spawned_at,
+        'ready_s': ready_at - spawned_at,
+        'modules_when_ready': modules,
+    }
+
+
+def spawn(target, node_url, lazy):
+    command = [sys.executable, '-m', 'benchmarks.startup', '--child', target, '--node-url', node_url,
+               '--spawned-at', repr(time.time())]
+    if lazy:
+        command.append('--lazy')
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(samples):
+    summary = {}
+    for key, value in samples[0].items():
+        if isinstance(value, float):
+            summary[key] = round(statistics.median(sample[key] for sample in samples), 3)
+        else:
+            summary[key] = value
+    return summary
+
+
+async def run(args):
+    from benchmarks.mock_node import MockNode
+
+    node = MockNode(block_time=1.0)
+    await node.start()
+    try:
+        web_samples, worker_samples = [], []
+        for _ in range(args.runs):
+            web_samples.append(await asyncio.to_thread(spawn, 'web', node.url, args.lazy))
+            worker_samples.append(await asyncio.to_thread(spawn, 'worker', node.url, False))
+    finally:
+        await node.close()
+
+    return {
+        'runs': args.runs,
+        'lazy_startup': args.lazy,
+        'web': summarize(web_samples),
+        'worker': summarize(worker_samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='processes started per target')
+    parser.add_argument('--lazy', action='store_true', help='run the web app with LAZY_STARTUP')
+    parser.add_argument('--output', default=None, help='file to write the JSON report to')
+    parser.add_argument('--child', choices=('web', 'worker'), help=argparse.SUPPRESS)
+    parser.add_argument('--node-url', help=argparse.SUPPRESS)
+    parser.add_argument('--spawned-at', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        if args.child == 'web':
+            result = asyncio.run(web(args.spawned_at, args.node_url, args.lazy))
+        else:
+            result = asyncio.run(worker(args.spawned_at, args.node_url))
+        print(json.dumps(result))
+        return
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+import asyncio
+import hashlib
+import json
+import time
+from contextlib import asynccontextmanager
+import config
+from logger import logging as logger
+from metrics import DISCORD_API_LATENCY, timed
+
+
+class DiscordRateLimiter:
+    """
+    Limits the requests in flight to the Discord API and holds requests back while their rate limit is used up.
+
+    Limits are tracked per route from the `X-RateLimit-Remaining` and `X-RateLimit-Reset-After` headers of
+    every response, less the requests still in flight, so concurrent requests do not overshoot a bucket.
+    A route whose bucket is empty is held until the bucket resets, and a 429 holds the route, or every route
+    if the limit is global, for its `retry_after`.
+    """
+
+    def __init__(self, concurrency=10):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._buckets = {}
+        self._in_flight = {}
+        self._blocked_globally = 0
+
+    def _delay(self, route):
+        now = time.monotonic()
+        delay = self._blocked_globally - now
+        bucket = self._buckets.get(route)
+        if bucket is not None:
+            remaining, reset_at = bucket
+            if reset_at <= now:
+                del self._buckets[route]
+            elif remaining <= 0:
+                delay = max(delay, reset_at - now)
+        return delay
+
+    @asynccontextmanager
+    async def slot(self, route):
+        """
+        Waits until a request to `route` may be sent and holds one of the concurrent slots while it runs.
+        """
+        while True:
+            delay = self._delay(route)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            await self._semaphore.acquire()
+            if self._delay(route) <= 0:
+                break
+            # The bucket ran out while this request waited for a slot
+            self._semaphore.release()
+        bucket = self._buckets.get(route)
+        if bucket is not None:
+            bucket[0] -= 1
+        self._in_flight[route] = self._in_flight.get(route, 0) + 1
+        try:
+            yield
+        finally:
+            self._in_flight[route] -= 1
+            self._semaphore.release()
+
+    def update(self, route, response):
+        """
+        Records the rate limit state reported by a response.
+
+        Args:
+            route (str): The route of the request.
+            response (Response): The httpx response.
+
+        Returns:
+            float: Seconds to wait before retrying, if the response is a 429, otherwise None.
+        """
+        now = time.monotonic()
+        headers = response.headers
+        if response.status_code == 429:
+            retry_after, is_global = _retry_after(response)
+            if is_global:
+                self._blocked_globally = max(self._blocked_globally, now + retry_after)
+            else:
+                self._buckets[route] = [0, now + retry_after]
+            return retry_after
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset_after = headers.get('X-RateLimit-Reset-After')
+        if remaining is not None and reset_after is not None:
+            self._buckets[route] = [int(remaining) - self._in_flight.get(route, 0), now + float(reset_after)]
+        return None
+
+
+def _retry_after(response):
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    retry_after = body.get('retry_after', response.headers.get('Retry-After', 1))
+    is_global = body.get('global', False) or response.headers.get('X-RateLimit-Global') == 'true'
+    return float(retry_after), is_global
+
+
+class DiscordOAuth:
+    """
+    Signs users in with Discord OAuth2 over one HTTP/2 client kept for the lifetime of the app.
+
+    Connections to the Discord API are pooled and reused across logins, so a login pays for the TLS handshake
+    only when no idle connection is left. Requests go through a `DiscordRateLimiter`, and 429 responses are
+    retried after their `retry_after` unless that is longer than `max_wait`. The identity behind an access token
+    is cached in Redis for `identity_ttl` seconds, keyed by a hash of the token, so a repeat login with the same
+    token skips the `/users/@me` request.
+    """
+
+    API_URL = 'https://discord.com/api'
+    CACHE_PREFIX = 'discord_identity_'
+
+    def __init__(self, redis, client_id, client_secret, redirect_uri, scope, api_url=None, concurrency=None,
+                 identity_ttl=None, max_retries=3, max_wait=10, timeout=10):
+        """
+        Initializes the client. `api_url`, `concurrency` and `identity_ttl` default to `DISCORD_API_URL`,
+        `DISCORD_CONCURRENCY` and `DISCORD_IDENTITY_TTL` in `config.py`.
+
+        Args:
+            redis (Redis): The Redis client.
+            client_id (str): The OAuth2 client id of the Discord application.
+            client_secret (str): The OAuth2 client secret of the Discord application.
+            redirect_uri (str): The redirect URI registered for the application.
+            scope (str): The OAuth2 scopes requested.
+            api_url (str): The base URL of the Discord API, e.g. of a local mock server.
+            concurrency (int): The most requests in flight to Discord, also the size of the connection pool.
+            identity_ttl (float): Seconds a user identity is cached.
+            max_retries (int): The most times a rate limited request is retried.
+            max_wait (float): The longest `retry_after` a request waits for before giving up.
+            timeout (float): Seconds a single request may take.
+        """
+        self.redis = redis
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+        self.scope = scope
+        self.api_url = api_url or getattr(config, 'DISCORD_API_URL', self.API_URL)
+        self.concurrency = concurrency or getattr(config, 'DISCORD_CONCURRENCY', 10)
+        self.identity_ttl = identity_ttl or getattr(config, 'DISCORD_IDENTITY_TTL', 5 * 60)
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.limiter = DiscordRateLimiter(self.concurrency)
+        self.client = None
+
+    async def start(self):
+        """
+        Opens the HTTP client, importing httpx on first use. Called by the first request if not called before.
+        """
+        if self.client is None:
+            import httpx
+
+            self.client = httpx.AsyncClient(
+                base_url=self.api_url,
+                http2=True,
+                limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+                timeout=self.timeout,
+            )
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def exchange_code(self, code):
+        """
+        Exchanges an authorization code for an access token.
+
+        Args:
+            code (str): The code Discord redirected the user back with.
+
+        Returns:
+            str: The access token, or None if Discord refused the code.
+        """
+        response = await self._request('token', 'POST', '/oauth2/token', data={
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': self.redirect_uri,
+            'scope': self.scope,
+        })
+        if response.status_code != 200:
+            return None
+        return response.json()['access_token']
+
+    async def identify(self, access_token):
+        """
+        Returns the Discord user an access token belongs to, from the cache when possible.
+
+        Args:
+            access_token (str): The access token.
+
+        Returns:
+            dict: The `id`, `username` and `discriminator` of the user, or None if Discord refused the token.
+        """
+        key = f"{self.CACHE_PREFIX}{hashlib.sha256(access_token.encode('utf-8')).hexdigest()}"
+        cached = await self.redis.get(key)
+        if cached is not None:
+            return json.loads(cached)
+
+        response = await self._request('identify', 'GET', '/v9/users/@me', headers={
+            'Authorization': f'Bearer {access_token}',
+        })
+        if response.status_code != 200:
+            return None
+        info = response.json()
+        user = {'id': info['id'], 'username': info['username'], 'discriminator': info.get('discriminator', '0')}
+        await self.redis.set(key, json.dumps(user), ex=int(self.identity_ttl))
+        return user
+
+    async def _request(self, route, method, path, **kwargs):
+        await self.start()
+        attempt = 0
+        while True:
+            async with self.limiter.slot(route):
+                with timed(DISCORD_API_LATENCY, route=route) as stage:
+                    response = await self.client.request(method, path, **kwargs)
+                    if response.status_code == 429:
+                        stage.outcome = 'rate_limited'
+                    elif response.status_code >= 400:
+                        stage.outcome = 'error'
+            retry_after = self.limiter.update(route, response)
+            if retry_after is None or attempt >= self.max_retries or retry_after > self.max_wait:
+                return response
+            attempt += 1
+            logger.bind(rate_limit=f"discord_{route}").info(
+                f"Rate limited by Discord on '{route}', retrying in {retry_after}s"
+            )
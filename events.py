@@ -0,0 +1,90 @@
+import asyncio
+from contextlib import asynccontextmanager
+from logger import logging as logger
+
+
+CHANNEL_PREFIX = 'payment_status_'
+
+
+async def publish_payment_status(redis, payment_id, status):
+    """
+    Publishes a payment status change to every process listening for it.
+
+    Args:
+        redis (Redis): The Redis client.
+        payment_id (str): The id of the payment, see `amounts.payment_id`.
+        status (str): The new session status, `PaymentSessions.CONFIRMED` or `PaymentSessions.EXPIRED`.
+    """
+    await redis.publish(f"{CHANNEL_PREFIX}{payment_id.lower()}", status)
+
+
+class PaymentEvents:
+    """
+    Fans payment status changes published in Redis out to local subscribers.
+
+    The process holds a single pattern subscription, so the number of Redis connections does not grow
+    with the number of browsers waiting on a payment.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.subscribers = {}
+        self._pubsub = None
+        self._task = None
+
+    async def start(self):
+        if self._task is None:
+            self._pubsub = self.redis.pubsub()
+            await self._pubsub.psubscribe(f"{CHANNEL_PREFIX}*")
+            self._task = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._pubsub is not None:
+            await self._pubsub.close()
+            self._pubsub = None
+
+    @asynccontextmanager
+    async def subscribe(self, payment_id):
+        """
+        Subscribes to the status changes of a payment.
+
+        Args:
+            payment_id (str): The id of the payment, see `amounts.payment_id`.
+
+        Yields:
+            asyncio.Queue: A queue receiving every status published for the payment.
+        """
+        key = payment_id.lower()
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(key, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            queues = self.subscribers.get(key)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self.subscribers[key]
+
+    async def _listen(self):
+        while True:
+            try:
+                async for message in self._pubsub.listen():
+                    if message['type'] != 'pmessage':
+                        continue
+                    channel = _decode(message['channel'])
+                    status = _decode(message['data'])
+                    for queue in self.subscribers.get(channel[len(CHANNEL_PREFIX):], ()):
+                        queue.put_nowait(status)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.bind(rate_limit='payment_events').exception(f"Payment event listener failed: {e}")
+                await asyncio.sleep(1)
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
@@ -1,122 +1,211 @@
-import asyncio
 import os
-import httpx
+import json
+import hashlib
+import importlib
+import time
+import asyncio
 import aioredis
-
-from datetime import datetime
-from quart import Quart, render_template, request, redirect, url_for, session, jsonify
-from payments import Payments
-from utils import Helper
+import config
+
+from quart import Quart, render_template, request, redirect, url_for, session, jsonify, make_response
+from jobs import PaymentJob, PaymentQueue
+from events import PaymentEvents
+from sessions import PaymentSessions
+from session_store import RedisSessionInterface
+from discord_oauth import DiscordOAuth
+from admission import CheckoutAdmission, user_key
+from amounts import AmountTags, from_units, to_units
+from plans import PlanCatalog, group_tiers, load_plans
 from logger import logging as logger
-from config import DISCORD_OAUTH2_URL, CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, SCOPE, REDIS_HOST, REDIS_PORT, REDIS_PASSWD, TOKEN as ds_token, GUILD_ID as guild_id, ROLE_NAME as role_name
-from send_message import send_message
-from add_role import assign_role_to_user
+from metrics import LoopMonitor, instrument_redis, render as render_metrics
+from config import DISCORD_OAUTH2_URL, CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, SCOPE, REDIS_HOST, REDIS_PORT, REDIS_PASSWD
 
 app = Quart(__name__)
 
-app.secret_key = os.urandom(16)
+# Every worker must sign cookies with the same key; a random one only works for a single process
+app.secret_key = getattr(config, 'SECRET_KEY', None) or os.urandom(16)
+
+# Seconds before a lazily started network subsystem that failed to start is restarted, doubled after each failure
+NETWORK_RETRY_DELAY = 1
+NETWORK_MAX_RETRY_DELAY = 60
 
 
 @app.before_serving
 async def startup():
     """
-    Initializes the application by setting up a connection to the Redis server before the server starts serving requests.
+    Initializes the application before the server starts serving requests: connects to the Redis server and
+    keeps the browser sessions there, starts the event loop lag monitor, compiles the templates and renders
+    the plan page, sets up checkout admission control and the payment job queue, subscribes to payment status
+    events and starts the network subsystem (see `start_network`). The Discord API client is opened by the
+    first login.
+    With `LAZY_STARTUP` enabled in `config.py`, the app starts serving while the network subsystem starts in
+    the background, and requests that need it wait for it. A failed start is retried with backoff (see
+    `keep_network_started`).
     """
-    app.redis = aioredis.from_url(
+    app.redis = instrument_redis(aioredis.from_url(
         f"redis://{REDIS_HOST}:{REDIS_PORT}",
         password=REDIS_PASSWD,
         encoding='utf-8'
-    )
+    ))
+    await app.redis.ping()
+    app.session_interface = RedisSessionInterface(app.redis, ttl=getattr(config, 'SESSION_TTL', 24 * 60 * 60))
+    app.discord = DiscordOAuth(app.redis, CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, SCOPE)
+    app.loop_monitor = LoopMonitor(stall_threshold=getattr(config, 'LOOP_STALL_THRESHOLD', None))
+    app.loop_monitor.start()
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    app.plan_table = load_plans()
+    app.plan_names = frozenset(app.plan_table)
+    app.plan_page = await render_template('plan.html', tiers=group_tiers(app.plan_table))
+    app.plan_page_etag = hashlib.sha1(app.plan_page.encode('utf-8')).hexdigest()
+
+    app.sessions = PaymentSessions(app.redis)
+    app.admission = CheckoutAdmission(app.redis, app.sessions)
+    app.jobs = PaymentQueue(app.redis)
+    await app.jobs.setup()
+    app.events = PaymentEvents(app.redis)
+    await app.events.start()
+
+    app.payments = app.price_oracle = app.plans = app.addresses = app.amount_tags = app.worker = None
+    app.network_failed = False
+    app.network = app.network_attempt = asyncio.ensure_future(start_network())
+    if getattr(config, 'LAZY_STARTUP', False):
+        app.network = asyncio.ensure_future(keep_network_started())
+    else:
+        await app.network
 
 
-@app.after_serving
-async def cleanup():
+async def keep_network_started():
     """
-    Closes the Redis connection after the app has finished serving.
+    Starts the network subsystem in the background and, whenever a start fails, stops what it had started and
+    tries again after `NETWORK_RETRY_DELAY` seconds, doubled after each failure up to `NETWORK_MAX_RETRY_DELAY`.
     """
-    await app.redis.close()
+    delay = NETWORK_RETRY_DELAY
+    while True:
+        try:
+            await app.network_attempt
+            return
+        except Exception as e:
+            app.network_failed = True
+            logger.exception(f"Failed to start the network subsystem, retrying in {delay}s: {e}")
+        await stop_network()
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, NETWORK_MAX_RETRY_DELAY)
+        app.network_attempt = asyncio.ensure_future(start_network())
 
 
-async def set_payment_status(wallet_address, status="false"):
+async def stop_network():
     """
-    Sets the payment status for a given wallet address in Redis with an expiration time.
-
-    Args:
-        wallet_address (str): The wallet address to which the status should be associated.
-        status (str): The payment status to set, defaults to "false".
+    Stops the parts of the network subsystem that have been started: the embedded payment worker, which hands
+    its unfinished payment jobs back to the queue, the blockchain connections, the deposit address pool, the
+    plan catalog and the ETH price cache.
     """
-    await app.redis.set(f"payment_confirmed_{wallet_address}", status, ex=60*10)
+    if app.worker is not None:
+        await app.worker.stop()
+    if app.payments is not None:
+        await app.payments.close()
+    if app.addresses is not None:
+        await app.addresses.close()
+    if app.plans is not None:
+        app.plans.close()
+    if app.price_oracle is not None:
+        await app.price_oracle.close()
+    app.payments = app.price_oracle = app.plans = app.addresses = app.amount_tags = app.worker = None
 
 
-async def get_payment_status(wallet_address):
+def network_started():
     """
-    Retrieves the payment status for a given wallet address from Redis.
-
-    Args:
-        wallet_address (str): The wallet address for which to retrieve the payment status.
+    Checks whether the network subsystem is up.
 
     Returns:
-        str: The payment status.
-    """
-    return await app.redis.get(f"payment_confirmed_{wallet_address}")
-
-
-async def set_payment_start_time(wallet_address):
-    """
-    Sets the payment start time for a given wallet address in Redis.
+        bool: True if the last start of the network subsystem has succeeded.
+    """
+    attempt = app.network_attempt
+    return attempt.done() and not attempt.cancelled() and attempt.exception() is None
+
+
+async def start_network():
+    """
+    Starts the network subsystem: opens the shared blockchain connections to every node, loads token metadata,
+    starts the ETH price cache, loads the plan catalog, starts the deposit address pool and the amount tags of
+    the shared deposit addresses. A payment worker is also run inside the web process when `EMBEDDED_WORKER` is
+    enabled in `config.py`, or by default when it is the only web process (see `embedded_worker`). Its modules,
+    and web3 with them, are only imported here, in a thread, so a lazy startup keeps serving requests while they
+    load.
+    """
+    await asyncio.to_thread(importlib.import_module, 'worker')
+    from payments import Payments
+    from address_pool import AddressPool
+    from utils import price_oracle
+    from worker import PaymentWorker
+
+    app.payments = Payments()
+    await app.payments.connect()
+    await app.payments.warm_up()
+    app.price_oracle = price_oracle
+    await price_oracle.start()
+    app.plans = PlanCatalog(app.payments.tokens, price_oracle, app.plan_table)
+    if getattr(config, 'HD_MNEMONIC', None):
+        app.addresses = AddressPool(app.redis, config.HD_MNEMONIC)
+        await app.addresses.start()
+    if getattr(config, 'SHARED_ADDRESSES', None):
+        app.amount_tags = AmountTags(
+            app.redis, config.SHARED_ADDRESSES, tags=getattr(config, 'AMOUNT_TAGS', 1000),
+            hold=getattr(config, 'AMOUNT_TAG_HOLD', 24 * 60 * 60),
+        )
+
+    if embedded_worker():
+        app.worker = PaymentWorker(app.redis, app.payments)
+        await app.worker.start()
+    logger.info("Network subsystem started")
+
+
+def embedded_worker():
+    """
+    Checks whether the web process runs a payment worker. Unless `EMBEDDED_WORKER` is set in `config.py`, only a
+    single web process does: when `serve.py` runs several, each of them would poll the nodes for its own jobs with
+    a request budget of its own, so the node rate limits would be exceeded.
 
-    Args:
-        wallet_address (str): The wallet address for which to set the payment start time.
-    """
-    await app.redis.set(f"payment_start_time_{wallet_address}", datetime.now().timestamp())
-
-
-async def get_payment_start_time(wallet_address):
-    """
-    Retrieves the payment start time for a given wallet address from Redis.
-
-    Args:
-        wallet_address (str): The wallet address for which to retrieve the payment start time.
+    Returns:
+        bool: True if a payment worker is run inside the web process.
     """
-    timestamp = await app.redis.get(f"payment_start_time_{wallet_address}")
-    if timestamp is not None:
-        return datetime.fromtimestamp(float(timestamp))
-    return None
+    embedded = getattr(config, 'EMBEDDED_WORKER', None)
+    if embedded is None:
+        return int(os.environ.get('WEB_WORKERS', 1)) <= 1
+    return embedded
 
 
-async def set_email_in_redis(username, email):
-    """
-    Stores an email address associated with a discord username in Redis.
-
-    Args:
-        username (str): The discord username associated with the email.
-        email (str): The email address to store.
+@app.after_serving
+async def cleanup():
     """
-    await app.redis.set(f"email_{username}", email)
-
-
-async def get_email_from_redis(username):
+    Stops the network subsystem (see `stop_network`) and closes the Discord and Redis connections after the app
+    has finished serving.
     """
-    Retrieves an email address associated with a discord username from Redis.
-
-    Args:
-        username (str): The discord username associated with the email.
-    """
-    email = await app.redis.get(f"email_{username}")
-    if email is not None:
-        return email.decode('utf-8')
-    return None
+    app.network.cancel()
+    app.network_attempt.cancel()
+    await asyncio.gather(app.network, app.network_attempt, return_exceptions=True)
+    await stop_network()
+    await app.discord.close()
+    await app.events.close()
+    await app.loop_monitor.close()
+    await app.redis.close()
+    await logger.complete()
 
 
 @app.route('/')
 async def index():
     """
-    Renders the main page of the application.
+    Serves the plan page rendered at startup, with an ETag so browsers and proxies can revalidate it cheaply.
 
     Returns:
-        Response: The rendered 'plan.html' template.
+        Response: The rendered 'plan.html' template, or 304 Not Modified.
     """
-    return await render_template('plan.html')
+    response = await make_response(app.plan_page)
+    response.set_etag(app.plan_page_etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = getattr(config, 'PLAN_PAGE_MAX_AGE', 5 * 60)
+    return await response.make_conditional(request)
 
 
 @app.route('/choose_plan', methods=['POST'])
@@ -128,6 +217,8 @@ async def choose_plan():
         Response: A redirect to the payment page.
     """
     form_data = await request.form
+    if form_data.get('plan') not in app.plan_names:
+        return "Unknown plan.", 400
     session['plan'] = form_data['plan']
     return redirect(url_for('payment'))
 
@@ -135,74 +226,84 @@ async def choose_plan():
 @app.route('/check_payment_status')
 async def check_payment_status():
     """
-    Checks and returns the payment status for the current session's wallet address.
+    Checks and returns the payment status for the current session's payment.
 
     Returns:
         json: A JSON object with payment confirmation status, timeout status, and error messages if any.
     """
-    wallet_address = session.get('wallet_address')
-
-    payment_confirmed = await get_payment_status(wallet_address)
-
-    await set_payment_start_time(wallet_address)
-    payment_start_time = await get_payment_start_time(wallet_address)
+    payment_id = session.get('payment_id')
+    status, deadline = await app.sessions.get_status(payment_id) if payment_id else (None, None)
 
-
-    if payment_confirmed == b'true':
+    if status == PaymentSessions.CONFIRMED:
         return jsonify(payment_confirmed=True, payment_timeout=False)
 
-    if not payment_start_time:
+    if status is None:
         return jsonify(payment_confirmed=False, payment_timeout=True, error="Payment session not started")
 
-    elapsed_time = datetime.now() - payment_start_time
-    if elapsed_time.total_seconds() > 10 * 60:
+    if status == PaymentSessions.EXPIRED or time.time() > deadline:
         return jsonify(payment_confirmed=False, payment_timeout=True)
 
     return jsonify(payment_confirmed=False, payment_timeout=False)
 
 
-async def payment_check_coroutine(wallet_address, expected_amount, token, network, username):
+@app.route('/payment_events')
+async def payment_events():
     """
-    Coroutine that continuously checks for payment confirmation within a specified time frame.
+    Streams the payment status of the current session's payment as Server-Sent Events.
 
-    Args:
-        wallet_address (str): The wallet address for which to check the payment.
-        expected_amount (float): The expected amount of payment.
-        token (str): The token type for the payment.
-        network (str): The network on which the payment is made.
-        username (str): The username associated with the payment.
-    """
-    logger.info("The balance check coroutine has started.")
-    payment = Payments()
-    end_time = asyncio.get_event_loop().time() + 10 * 60
-    try:
-        while asyncio.get_event_loop().time() < end_time:
-            logger.info(f"Checking payment at {asyncio.get_event_loop().time()}")
-            success, _ = await payment.start_payment_session(expected_amount, wallet_address, token, network)
-            logger.info(f"Check result: {success}, time: {asyncio.get_event_loop().time()}")
-            if success:
-                await set_payment_status(wallet_address, "true")
-                logger.info("Payment confirmed")
-
-                email = await get_email_from_redis(username)
-                if email:
-                    logger.info(f"Sending message to {email}")
-                    recipient_email = email
-                    subject = "10KDROP PAYMENT"
-                    body = f"TEXT"
-                    await send_message(recipient_email, subject, body)
-                else:
-                    logger.info("Cant get email address")
-
-                logger.info(f"Adding discord role")
-                formatted_username = username.split("#")[0]
-                await assign_role_to_user(ds_token, guild_id, formatted_username, role_name)
+    The stream sends a single event carrying the same fields as `check_payment_status` as soon as the
+    payment is confirmed or its window has passed, and keep-alive comments in between.
 
-                break
-            await asyncio.sleep(2)
-    except Exception as e:
-        logger.info(f"An error occurred: {e}")
-        pass
+    Returns:
+        Response: A text/event-stream response.
+    """
+    payment_id = session.get('payment_id')
+
+    async def stream():
+        if not payment_id:
+            yield _sse(payment_confirmed=False, payment_timeout=True, error="Payment session not started")
+            return
+
+        async with app.events.subscribe(payment_id) as statuses:
+            status, deadline = await app.sessions.get_status(payment_id)
+            if status is None:
+                yield _sse(payment_confirmed=False, payment_timeout=True, error="Payment session not started")
+                return
+            if status != PaymentSessions.PENDING:
+                yield _sse(payment_confirmed=status == PaymentSessions.CONFIRMED,
+                           payment_timeout=status == PaymentSessions.EXPIRED)
+                return
+
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    # A paid session is kept open while its deposit gathers confirmations
+                    status, deadline = await app.sessions.get_status(payment_id)
+                    if status == PaymentSessions.PENDING and deadline > time.time():
+                        continue
+                    yield _sse(payment_confirmed=status == PaymentSessions.CONFIRMED,
+                               payment_timeout=status != PaymentSessions.CONFIRMED)
+                    return
+                try:
+                    status = await asyncio.wait_for(statuses.get(), timeout=min(remaining, 15))
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                yield _sse(payment_confirmed=status == PaymentSessions.CONFIRMED,
+                           payment_timeout=status == PaymentSessions.EXPIRED)
+                return
+
+    response = await make_response(stream(), {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    response.timeout = None
+    return response
+
+
+def _sse(**data):
+    return f"data: {json.dumps(data)}\n\n".encode('utf-8')
 
 
 @app.route('/email', methods=['POST'])
@@ -213,40 +314,83 @@ async def save_email():
     data = await request.get_json()
     email = data['email']
     username = session.get('username')
-    await set_email_in_redis(username, email)
+    await app.sessions.set_email(username, email)
     return jsonify(1)
 
 
 @app.route('/payment', methods=['GET', 'POST'])
 async def payment():
     """
-    Handles the payment process. If the method is POST, it processes the payment data,
-    generates a wallet, and initiates a payment check coroutine.
+    Handles the payment process. If the method is POST, it processes the payment data and quotes the plan
+    price in token base units. A user who already has a pending payment for the same plan, network and token
+    gets that payment back; a request over the checkout rate limit or the pending session caps is rejected
+    with 429, or 503 when the service as a whole is at capacity. An admitted request gets a new deposit
+    address: when `SHARED_ADDRESSES` are configured, one of them with a unique dust-tagged amount; otherwise,
+    or if no unique amount is left, an address from the HD address pool (or a generated wallet when
+    `HD_MNEMONIC` is not configured). It then queues a payment job for the workers to verify.
+    While the network subsystem is starting for the first time the request waits for it; while it is down after
+    a failed start, the request is rejected with 503.
     If the method is GET, it renders the payment template.
 
     Returns:
         Response: Either a JSON response with payment details on POST or a rendered payment template on GET.
     """
     if request.method == 'POST':
+        if not app.network_failed:
+            await asyncio.wait([app.network_attempt])
+        if not network_started():
+            return jsonify(error="Payments are unavailable right now, please try again later"), 503, {
+                'Retry-After': str(NETWORK_RETRY_DELAY)
+            }
         data = await request.get_json()
         token = data['token']
         network = data['network']
 
-        wallet_address, private_key, mnemonic = await Payments.generate_wallet()
-        session['wallet_address'] = wallet_address
+        if not app.payments.tokens.supports(network, token):
+            return jsonify(error=f"{token.upper()} payments on {network} are not supported"), 400
 
-        # TODO SAVING PK AND MNEMONIC TO MONGODB
-        # session['private_key'] = private_key
-        # session['mnemonic'] = mnemonic
+        plan = session.get('plan')
+        price = app.plans.price(plan, network, token)
+        if price is None:
+            return jsonify(error=f"No {token.upper()} price is available for this plan right now"), 400
+        decimals = app.payments.tokens.get(network, token).decimals
+        expected_amount = to_units(price, decimals)
 
         username = session['username']
-
-        expected_amount = await Helper.getPlanPrice(plan_name=session['plan'], token=token)
-        await set_payment_status(wallet_address, "false")
-
-        asyncio.create_task(payment_check_coroutine(wallet_address, expected_amount, token, network, username))
-
-        return jsonify(wallet_address=wallet_address, amount=expected_amount, token=token.upper())
+        user = user_key(session.get('user_id'), username)
+        while True:
+            decision = await app.admission.admit(user, plan, network, token)
+            if decision.outcome != CheckoutAdmission.REUSED:
+                break
+            details = await app.sessions.get(decision.payment_id)
+            if details is not None:
+                session['wallet_address'] = details['wallet_address']
+                session['payment_id'] = decision.payment_id
+                return jsonify(
+                    wallet_address=details['wallet_address'],
+                    amount=from_units(int(details['amount']), decimals),
+                    token=token.upper(),
+                )
+            # The session has expired since it was offered for reuse: free its slot and admit the request again
+            await app.admission.release(user, decision.payment_id, plan, network, token)
+        if decision.outcome != CheckoutAdmission.ADMITTED:
+            return _rejected(decision)
+
+        try:
+            job = await _open_payment(username, network, token, expected_amount, decimals)
+        except Exception:
+            await app.admission.release(user, decision.ticket, plan, network, token)
+            raise
+        try:
+            await app.admission.bind(user, plan, network, token, decision.ticket, job.payment_id, job.deadline)
+            await app.jobs.enqueue(job)
+        except Exception:
+            await _abandon_payment(job, user, decision.ticket, plan, network, token)
+            raise
+
+        return jsonify(
+            wallet_address=job.wallet_address, amount=from_units(job.expected_amount, decimals), token=token.upper()
+        )
     else:
         if 'access_token' not in session:
             return await render_template('payment.html')
@@ -254,6 +398,109 @@ async def payment():
             return await render_template('payment.html', session=session)
 
 
+async def _open_payment(username, network, token, expected_amount, decimals):
+    """
+    Picks the deposit address of a new payment and creates its session. The payment can only land in a block
+    after the current head, which is recorded as the first block to scan together with the balance of the
+    address, so a worker that picks the job up late, or reclaims it, still finds a payment made before it
+    started watching. Newly derived and generated addresses have no balance; a reused pool address has its
+    balance read here, and shared addresses are never balance-swept.
+
+    Args:
+        username (str): The username of the payment.
+        network (str): The network name.
+        token (str): The token symbol.
+        expected_amount (int): The plan price in token base units.
+        decimals (int): The decimals of the token.
+
+    Returns:
+        PaymentJob: The job of the payment, not yet queued.
+    """
+    deadline = time.time() + 10 * 60
+    from_block = await app.payments.block_number(network.lower()) + 1
+    reservation = None
+    if app.amount_tags is not None:
+        reservation = await app.amount_tags.reserve(
+            network, token, expected_amount, decimals, ttl=deadline + app.sessions.retention - time.time()
+        )
+
+    address_index = None
+    baseline = None
+    if reservation is not None:
+        wallet_address, expected_amount = reservation
+    elif app.addresses is not None:
+        address_index, wallet_address, new = await app.addresses.acquire()
+        if new:
+            baseline = 0
+        else:
+            query = (wallet_address, token, network.lower())
+            baseline = (await app.payments.get_token_balances([query], raw=True)).get(query)
+    else:
+        wallet_address, private_key, mnemonic = await app.payments.generate_wallet()
+        baseline = 0
+
+        # TODO SAVING PK AND MNEMONIC TO MONGODB
+        # session['private_key'] = private_key
+        # session['mnemonic'] = mnemonic
+
+    job = PaymentJob(
+        wallet_address=wallet_address,
+        expected_amount=expected_amount,
+        token=token,
+        network=network,
+        username=username,
+        deadline=deadline,
+        user_id=session.get('user_id'),
+        from_block=from_block,
+        baseline=baseline,
+        shared=reservation is not None,
+    )
+    session['wallet_address'] = wallet_address
+    session['payment_id'] = job.payment_id
+
+    await app.sessions.create(
+        job.payment_id,
+        wallet_address,
+        expected_amount,
+        token,
+        network,
+        username,
+        deadline,
+        user_id=session.get('user_id'),
+        address_index=address_index,
+        from_block=from_block,
+        baseline=baseline,
+    )
+    return job
+
+
+async def _abandon_payment(job, user, ticket, plan, network, token):
+    """
+    Undoes a checkout whose payment job could not be queued, so no worker watches its session: expires the
+    session, returns a pooled deposit address to the address pool and frees the user's checkout slot and choice,
+    so the session is never handed out for reuse.
+    """
+    try:
+        if await app.sessions.expire(job.payment_id) and app.addresses is not None:
+            details = await app.sessions.get(job.payment_id) or {}
+            if 'address_index' in details:
+                await app.addresses.release(int(details['address_index']), job.wallet_address)
+        # The choice holds the ticket or, once bound, the payment id
+        for held in (ticket, job.payment_id):
+            await app.admission.release(user, held, plan, network, token)
+    except Exception as e:
+        logger.exception(f"Failed to abandon the payment to {job.wallet_address}: {e}")
+
+
+def _rejected(decision):
+    retry_after = {'Retry-After': str(int(decision.retry_after + 0.999))} if decision.retry_after else {}
+    if decision.outcome == CheckoutAdmission.RATE_LIMITED:
+        return jsonify(error="Too many payment requests, please try again later"), 429, retry_after
+    if decision.outcome == CheckoutAdmission.USER_LIMIT:
+        return jsonify(error="You have too many open payments, complete or wait for one of them first"), 429
+    return jsonify(error="Too many payments are in progress, please try again later"), 503, retry_after
+
+
 @app.route('/login/discord', methods=['POST'])
 def discord_login():
     """
@@ -266,46 +513,38 @@ def discord_login():
 async def discord_oauth_callback():
     """
     Handles the OAuth2 callback from Discord. Exchanges the code for an access token and
-    retrieves the user's Discord information to store in the session.
+    retrieves the user's Discord information to store in the session, both over the app's pooled
+    Discord client. The user's information is cached for a few minutes per access token.
 
     Returns:
         Response: A redirect to the payment route on success or an error message on failure.
     """
     code = request.args.get('code')
-    token_exchange_url = 'https://discord.com/api/oauth2/token'
-    token_data = {
-        'client_id': CLIENT_ID,
-        'client_secret': CLIENT_SECRET,
-        'grant_type': 'authorization_code',
-        'code': code,
-        'redirect_uri': REDIRECT_URI,
-        'scope': SCOPE
-    }
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-
-    async with httpx.AsyncClient() as client:
-        token_response = await client.post(token_exchange_url, data=token_data, headers=headers)
-        if token_response.status_code == 200:
-            token_json = token_response.json()
-            access_token = token_json['access_token']
-            session['access_token'] = access_token
-
-            user_info_response = await client.get(
-                'https://discord.com/api/v9/users/@me',
-                headers={'Authorization': f'Bearer {access_token}'}
-            )
-            if user_info_response.status_code == 200:
-                user_info = user_info_response.json()
-                session['user_id'] = user_info['id']
-                session['username'] = user_info['username'] + '#' + user_info['discriminator']
-
-                return redirect(url_for('payment'))
-            else:
-                return "Failed to retrieve Discord user information.", 400
-        else:
-            return "Failed to authenticate via Discord.", 400
+    access_token = await app.discord.exchange_code(code)
+    if access_token is None:
+        return "Failed to authenticate via Discord.", 400
+    session['access_token'] = access_token
+
+    user_info = await app.discord.identify(access_token)
+    if user_info is None:
+        return "Failed to retrieve Discord user information.", 400
+    session['user_id'] = user_info['id']
+    session['username'] = user_info['username'] + '#' + user_info['discriminator']
+
+    return redirect(url_for('payment'))
+
+
+@app.route('/metrics')
+async def metrics():
+    """
+    Exposes the latency histograms, active session gauge and event loop lag of this process
+    in the Prometheus text format.
+
+    Returns:
+        Response: The metrics of this process.
+    """
+    body, content_type = render_metrics()
+    return body, 200, {'Content-Type': content_type}
 
 
 if __name__ == '__main__':
@@ -0,0 +1,255 @@
+import os
+import socket
+import time
+from dataclasses import dataclass
+from aioredis.exceptions import ResponseError
+from amounts import payment_id
+
+
+@dataclass
+class PaymentJob:
+    """
+    A pending payment waiting to be verified by a worker.
+
+    Attributes:
+        wallet_address (str): The deposit address of the payment.
+        expected_amount (int): The expected amount of payment, in token base units.
+        token (str): The token symbol of the payment.
+        network (str): The network on which the payment is made.
+        username (str): The username associated with the payment.
+        deadline (float): Unix timestamp after which the payment is no longer accepted.
+        user_id (str): The Discord user id associated with the payment, if known.
+        id (str): The stream entry id, set once the job has been read from the queue.
+        from_block (int): The first block to scan for the deposit: the block after the head when the address
+            was handed out, or the first block a previous worker scanned if it handed the job back.
+        baseline (int): The balance of the address before the payment in base units, if known at checkout or
+            read by a previous worker.
+        shared (bool): Whether the deposit address is shared and the payment is told apart by its amount.
+    """
+    wallet_address: str
+    expected_amount: int
+    token: str
+    network: str
+    username: str
+    deadline: float
+    user_id: str = None
+    id: str = None
+    from_block: int = None
+    baseline: int = None
+    shared: bool = False
+
+    @property
+    def payment_id(self):
+        if self.shared:
+            return payment_id(self.wallet_address, self.network, self.token, self.expected_amount)
+        return payment_id(self.wallet_address)
+
+    def to_fields(self):
+        """
+        Serializes the job into stream entry fields.
+
+        Returns:
+            dict: The stream entry fields.
+        """
+        fields = {
+            'wallet_address': self.wallet_address,
+            'expected_amount': str(self.expected_amount),
+            'token': self.token,
+            'network': self.network,
+            'username': self.username,
+            'deadline': str(self.deadline),
+        }
+        if self.user_id is not None:
+            fields['user_id'] = str(self.user_id)
+        if self.from_block is not None:
+            fields['from_block'] = str(self.from_block)
+        if self.baseline is not None:
+            fields['baseline'] = str(self.baseline)
+        if self.shared:
+            fields['shared'] = '1'
+        return fields
+
+    @classmethod
+    def from_entry(cls, entry_id, fields):
+        """
+        Deserializes a job from a stream entry.
+
+        Args:
+            entry_id (bytes): The stream entry id.
+            fields (dict): The stream entry fields.
+
+        Returns:
+            PaymentJob: The deserialized job.
+        """
+        fields = {_decode(key): _decode(value) for key, value in fields.items()}
+        return cls(
+            wallet_address=fields['wallet_address'],
+            expected_amount=int(fields['expected_amount']),
+            token=fields['token'],
+            network=fields['network'],
+            username=fields['username'],
+            deadline=float(fields['deadline']),
+            user_id=fields.get('user_id'),
+            id=_decode(entry_id),
+            from_block=int(fields['from_block']) if 'from_block' in fields else None,
+            baseline=int(fields['baseline']) if 'baseline' in fields else None,
+            shared=fields.get('shared') == '1',
+        )
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _next_id(entry_id):
+    # The smallest stream entry id after `entry_id`, as exclusive ranges need Redis 6.2
+    milliseconds, sequence = _decode(entry_id).split('-')
+    return f"{milliseconds}-{int(sequence) + 1}"
+
+
+class PaymentQueue:
+    """
+    A durable queue of payment jobs stored in a Redis stream with a consumer group.
+
+    Jobs stay in the group's pending list until they are acknowledged. Workers keep the jobs they are
+    still watching alive with `heartbeat`; jobs whose worker stopped sending heartbeats for longer than
+    `visibility_timeout` are reclaimed by another worker. A worker that shuts down hands its jobs back with
+    `requeue`, so other workers pick them up right away.
+    """
+
+    STREAM = 'payment_jobs'
+    GROUP = 'payment_workers'
+
+    def __init__(self, redis, consumer=None, visibility_timeout=60):
+        """
+        Initializes the queue.
+
+        Args:
+            redis (Redis): The Redis client.
+            consumer (str): The name of this consumer, unique per worker process.
+            visibility_timeout (float): Seconds without a heartbeat after which a job is reclaimed.
+        """
+        self.redis = redis
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.visibility_timeout = visibility_timeout
+
+    async def setup(self):
+        """
+        Creates the stream and the consumer group if they do not exist yet.
+        """
+        try:
+            await self.redis.xgroup_create(self.STREAM, self.GROUP, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    async def enqueue(self, job):
+        """
+        Adds a job to the queue.
+
+        Args:
+            job (PaymentJob): The job to add.
+
+        Returns:
+            str: The stream entry id of the job.
+        """
+        job.id = _decode(await self.redis.xadd(self.STREAM, job.to_fields()))
+        return job.id
+
+    async def read(self, count=100, block=5):
+        """
+        Reads new jobs for this consumer, waiting up to `block` seconds for one to arrive.
+
+        Args:
+            count (int): The maximum number of jobs to read.
+            block (float): Seconds to wait for new jobs.
+
+        Returns:
+            list: The PaymentJob objects read.
+        """
+        response = await self.redis.xreadgroup(
+            self.GROUP, self.consumer, {self.STREAM: '>'}, count=count, block=int(block * 1000)
+        )
+        return [
+            PaymentJob.from_entry(entry_id, fields)
+            for _, entries in response or []
+            for entry_id, fields in entries
+        ]
+
+    async def reclaim(self, count=100):
+        """
+        Takes over jobs whose worker stopped sending heartbeats. The pending list is paged through from the
+        oldest entry, since the oldest entries are mostly jobs whose workers are alive and keep them fresh.
+
+        Args:
+            count (int): The maximum number of jobs to reclaim, also the number of pending entries read per page.
+
+        Returns:
+            list: The PaymentJob objects reclaimed by this consumer.
+        """
+        min_idle_time = int(self.visibility_timeout * 1000)
+        stale = []
+        start = '-'
+        while len(stale) < count:
+            pending = await self.redis.xpending_range(self.STREAM, self.GROUP, start, '+', count)
+            stale.extend(entry['message_id'] for entry in pending if entry['time_since_delivered'] >= min_idle_time)
+            if len(pending) < count:
+                break
+            start = _next_id(pending[-1]['message_id'])
+        stale = stale[:count]
+        if not stale:
+            return []
+        entries = await self.redis.xclaim(self.STREAM, self.GROUP, self.consumer, min_idle_time, stale)
+        return [PaymentJob.from_entry(entry_id, fields) for entry_id, fields in entries if fields]
+
+    async def heartbeat(self, jobs):
+        """
+        Resets the idle time of jobs this consumer is still working on so they are not reclaimed.
+
+        Args:
+            jobs (iterable): The PaymentJob objects still in progress.
+        """
+        ids = [job.id for job in jobs]
+        if ids:
+            await self.redis.xclaim(self.STREAM, self.GROUP, self.consumer, 0, ids, justid=True)
+
+    async def ack(self, job):
+        """
+        Acknowledges a finished job and removes it from the stream.
+
+        Args:
+            job (PaymentJob): The finished job.
+        """
+        await self.redis.xack(self.STREAM, self.GROUP, job.id)
+        await self.redis.xdel(self.STREAM, job.id)
+
+    async def requeue(self, job):
+        """
+        Puts an unfinished job back at the end of the queue for any worker to read, in one transaction.
+
+        Args:
+            job (PaymentJob): The unfinished job, with the progress to hand over.
+
+        Returns:
+            str: The stream entry id of the requeued job.
+        """
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.xadd(self.STREAM, job.to_fields())
+            pipe.xack(self.STREAM, self.GROUP, job.id)
+            pipe.xdel(self.STREAM, job.id)
+            entry_id, _, _ = await pipe.execute()
+        job.id = _decode(entry_id)
+        return job.id
+
+    @staticmethod
+    def is_expired(job):
+        """
+        Checks whether a job's payment window has passed.
+
+        Args:
+            job (PaymentJob): The job to check.
+
+        Returns:
+            bool: True if the deadline of the job has passed.
+        """
+        return time.time() >= job.deadline
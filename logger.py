@@ -1,11 +1,54 @@
+import sys
+import time
+import config
 from loguru import logger as logging
 
 
+LOG_FORMAT = "<green>{time:YYYY-MM-DD at HH:mm:ss}</green> | <level>{level}</level> | <level>{function}</level> : <level>{message}</level>"
+
+
+class RateLimit:
+    """
+    Sink filter that passes at most one record per `interval` seconds for each `rate_limit` key bound
+    to the logger, so a message repeated on every poll is written once per interval.
+    """
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.last = {}
+
+    def __call__(self, record):
+        key = record['extra'].get('rate_limit')
+        if key is None:
+            return True
+        now = time.monotonic()
+        last = self.last.get(key)
+        if last is not None and now - last < self.interval:
+            return False
+        if len(self.last) >= 10000:
+            self.last = {k: t for k, t in self.last.items() if now - t < self.interval}
+        self.last[key] = now
+        return True
+
+
+# Every sink is enqueued, so only the writes to stderr and the log file, and their rotation and compression, run on a
+# background thread. Records are still built, filtered and formatted by the caller, on the event loop.
+rate_limit = getattr(config, 'LOG_RATE_LIMIT', 60)
+logging.remove()
+logging.add(sys.stderr,
+            format=LOG_FORMAT,
+            enqueue=True,
+            filter=RateLimit(rate_limit),
+            )
 logging.add("logs/logs.log",
             rotation="500 MB",
+            compression="gz",
+            enqueue=True,
+            serialize=getattr(config, 'LOG_JSON', False),
             backtrace=True,
-            diagnose=True,
-            format="<green>{time:YYYY-MM-DD at HH:mm:ss}</green> | <level>{level}</level> | <level>{function}</level> : <level>{message}</level>",
+            diagnose=False,
+            filter=RateLimit(rate_limit),
+            format=LOG_FORMAT,
             colorize=False  # Включаем цветовую разметку
             )
 logging.opt(colors=True)
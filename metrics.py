@@ -0,0 +1,193 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest, start_http_server
+from logger import logging as logger
+
+
+RPC_LATENCY = Histogram(
+    'payment_rpc_request_seconds', 'Latency of JSON-RPC requests to blockchain nodes.',
+    ['network', 'method', 'outcome'],
+)
+RPC_ENDPOINT_FAILURES = Counter(
+    'payment_rpc_endpoint_failures_total', 'Failed JSON-RPC requests per node endpoint.', ['network', 'endpoint'],
+)
+RPC_HEDGED_REQUESTS = Counter(
+    'payment_rpc_hedged_requests_total', 'JSON-RPC reads also sent to a second endpoint because the first was slow.',
+    ['network'],
+)
+REDIS_LATENCY = Histogram(
+    'payment_redis_command_seconds', 'Latency of Redis commands. Blocking reads wait up to their block timeout.',
+    ['command', 'outcome'],
+)
+PRICE_FETCH_LATENCY = Histogram(
+    'payment_price_fetch_seconds', 'Latency of ETH price fetches from CoinGecko.', ['outcome'],
+)
+EMAIL_SEND_LATENCY = Histogram(
+    'payment_email_send_seconds', 'Latency of confirmation email sends over SMTP.', ['outcome'],
+)
+EMAIL_MESSAGES = Counter(
+    'payment_email_messages_total', 'Emails by outcome: sent, failed attempt or dead-lettered.', ['outcome'],
+)
+ROLE_GRANT_LATENCY = Histogram(
+    'payment_role_grant_seconds', 'Latency of Discord role grants.', ['outcome'],
+)
+DISCORD_API_LATENCY = Histogram(
+    'payment_discord_api_seconds', 'Latency of Discord OAuth2 API requests.', ['route', 'outcome'],
+)
+CONFIRMATION_HANDLER_LATENCY = Histogram(
+    'payment_confirmation_handler_seconds', 'Latency of post-confirmation handlers (status, email, role).',
+    ['handler', 'outcome'],
+)
+ACTIVE_SESSIONS = Gauge(
+    'payment_active_sessions', 'Payment sessions watched for deposits by this process.', ['network'],
+)
+CHECKOUT_ADMISSIONS = Counter(
+    'payment_checkout_admissions_total', 'Checkout requests by admission decision.', ['outcome'],
+)
+PENDING_CHECKOUTS = Gauge(
+    'payment_pending_checkouts', 'Pending payment sessions of all users, as last counted by this process.',
+)
+EVENT_LOOP_LAG = Histogram(
+    'payment_event_loop_lag_seconds', 'How late the event loop wakes up a sleeping task.',
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+EVENT_LOOP_STALLS = Counter(
+    'payment_event_loop_stalls_total', 'Times the event loop was blocked for longer than the stall threshold.',
+)
+
+
+class Stage:
+    """
+    The outcome of a timed stage. Callers may set `outcome` to label a result that did not raise.
+    """
+
+    def __init__(self):
+        self.outcome = None
+
+
+@contextmanager
+def timed(histogram, **labels):
+    """
+    Observes the duration of the enclosed block in a histogram with an `outcome` label.
+
+    The outcome is 'error' if the block raises and 'ok' otherwise, unless the block sets it itself.
+
+    Args:
+        histogram (Histogram): The histogram to observe.
+        **labels: The other label values of the histogram.
+
+    Yields:
+        Stage: The stage being timed.
+    """
+    stage = Stage()
+    started = time.perf_counter()
+    try:
+        yield stage
+    except BaseException:
+        stage.outcome = 'error'
+        raise
+    finally:
+        histogram.labels(outcome=stage.outcome or 'ok', **labels).observe(time.perf_counter() - started)
+
+
+def instrument_redis(redis):
+    """
+    Times every command sent through a Redis client, labelled with the command name.
+
+    Pub/sub connections do not go through `execute_command` and are not timed.
+
+    Args:
+        redis (Redis): The Redis client.
+
+    Returns:
+        Redis: The same client.
+    """
+    execute_command = redis.execute_command
+
+    async def timed_execute_command(*args, **options):
+        with timed(REDIS_LATENCY, command=str(args[0]).split(' ')[0].upper()):
+            return await execute_command(*args, **options)
+
+    redis.execute_command = timed_execute_command
+    return redis
+
+
+def render():
+    """
+    Renders every metric of this process in the Prometheus text format.
+
+    Returns:
+        tuple: The response body and its content type.
+    """
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def serve(port):
+    """
+    Exposes the metrics of a process that has no web server of its own on `port`.
+    """
+    start_http_server(port)
+    logger.info(f"Serving metrics on port {port}")
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag and, optionally, dumps the stack of the code that blocks the loop.
+
+    A task sleeps for `interval` seconds at a time and records how late it wakes up. If `stall_threshold`
+    is set, a watchdog thread samples the stack of the event loop thread whenever the task has not woken
+    up for longer than that, and logs it once per stall, so the blocking call is caught in the act.
+    """
+
+    def __init__(self, interval=0.25, stall_threshold=None):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = threading.get_ident()
+        self._task = asyncio.create_task(self._run())
+        if self.stall_threshold:
+            self._stopped.clear()
+            self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+            self._watchdog.start()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._watchdog is not None:
+            self._stopped.set()
+            self._watchdog = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            EVENT_LOOP_LAG.observe(max(loop.time() - started - self.interval, 0))
+            self._heartbeat = time.monotonic()
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(self.stall_threshold / 4):
+            heartbeat = self._heartbeat
+            stalled_for = time.monotonic() - heartbeat - self.interval
+            if stalled_for < self.stall_threshold or heartbeat == reported:
+                continue
+            reported = heartbeat
+            EVENT_LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else 'unavailable'
+            logger.warning(f"Event loop blocked for {stalled_for:.2f}s, stack of the loop thread:\n{stack}")
@@ -0,0 +1,254 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from dataclasses import dataclass
+from aioredis.exceptions import ResponseError
+from logger import logging as logger
+from metrics import CONFIRMATION_HANDLER_LATENCY, timed
+
+
+@dataclass
+class Handler:
+    """
+    A step run for every confirmed payment, such as sending the email or granting the Discord role.
+
+    Attributes:
+        name (str): The handler name, also the name of its consumer group.
+        func (callable): Coroutine function called with the event fields. Raising makes the event retried.
+        concurrency (int): The number of events the handler works on at once in this process.
+        max_attempts (int): Deliveries of an event after which it is dead-lettered.
+        backoff (float): Seconds before the first retry, doubled on every further attempt.
+        timeout (float): Seconds a single attempt may take.
+    """
+    name: str
+    func: object
+    concurrency: int = 4
+    max_attempts: int = 5
+    backoff: float = 2
+    timeout: float = 30
+
+
+class ConfirmationOutbox:
+    """
+    The outbox of confirmed payments: a Redis stream with one event per confirmed payment, consumed by
+    independent handlers.
+
+    `publish` writes the event of a payment at most once, however often the payment is confirmed. Every
+    handler reads the stream through its own consumer group with `concurrency` tasks, so a slow or failing
+    handler never holds back the others and a payment is fully processed as soon as its slowest handler is.
+    An event a handler fails on stays in the handler's pending list and is retried with exponential backoff,
+    by any process, until it has been delivered `max_attempts` times; then it is pushed to a dead-letter list.
+    Events and completed handlers are recorded per payment session, the idempotency key of each handler, rather
+    than per payment id, which a shared deposit address hands out again. A handler claims a session atomically
+    before it runs, for at most its `timeout`, so an event delivered again skips the handlers that have
+    completed, or are still running, for it.
+    """
+
+    STREAM = 'payment_confirmations'
+    EVENT_PREFIX = 'payment_confirmation_event_'
+    DONE_PREFIX = 'payment_confirmation_done_'
+    DEAD_LETTER_KEY = 'payment_confirmation_dead_letter'
+
+    # KEYS: event marker, stream. ARGV: marker TTL, max stream length, then field/value pairs.
+    PUBLISH_SCRIPT = """
+    if not redis.call('SET', KEYS[1], 1, 'NX', 'EX', ARGV[1]) then
+        return false
+    end
+    return redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], '*', unpack(ARGV, 3))
+    """
+
+    # KEYS: completed handlers hash. ARGV: handler name, now, claim duration, hash TTL.
+    # Returns 1 if the handler has been claimed, 0 if it has completed and -1 if another attempt holds it.
+    CLAIM_SCRIPT = """
+    local current = redis.call('HGET', KEYS[1], ARGV[1])
+    if current then
+        local claimed_until = string.match(current, '^claimed:(.+)$')
+        if not claimed_until then
+            return 0
+        end
+        if tonumber(claimed_until) > tonumber(ARGV[2]) then
+            return -1
+        end
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], 'claimed:' .. (tonumber(ARGV[2]) + tonumber(ARGV[3])))
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    return 1
+    """
+
+    def __init__(self, redis, handlers=(), consumer=None, retention=7 * 24 * 60 * 60, max_length=100000):
+        """
+        Initializes the outbox.
+
+        Args:
+            redis (Redis): The Redis client.
+            handlers (iterable): The Handler objects to run for every event in this process.
+            consumer (str): The name of this process in the consumer groups.
+            retention (float): Seconds the publication and completion of an event are remembered.
+            max_length (int): The approximate number of events kept in the stream.
+        """
+        self.redis = redis
+        self.handlers = list(handlers)
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.retention = retention
+        self.max_length = max_length
+        self._publish = redis.register_script(self.PUBLISH_SCRIPT)
+        self._claim = redis.register_script(self.CLAIM_SCRIPT)
+        self._tasks = []
+        self._closing = False
+
+    async def setup(self):
+        """
+        Creates the stream and a consumer group per handler if they do not exist yet.
+        """
+        for handler in self.handlers:
+            try:
+                await self.redis.xgroup_create(self.STREAM, handler.name, id='0', mkstream=True)
+            except ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+    async def start(self):
+        """
+        Starts the consumers and the retry loop of every handler in the background.
+        """
+        if self._tasks:
+            return
+        await self.setup()
+        self._closing = False
+        for handler in self.handlers:
+            self._tasks.extend(asyncio.create_task(self._consume(handler)) for _ in range(handler.concurrency))
+            self._tasks.append(asyncio.create_task(self._retry_loop(handler)))
+
+    async def close(self):
+        # The loops also check this flag, in case a client library swallows their cancellation
+        self._closing = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def publish(self, session_id, payment_id, fields):
+        """
+        Writes the event of a confirmed payment session, unless it has been written before.
+
+        Args:
+            session_id (str): The id of the payment session, see `PaymentSessions.create`.
+            payment_id (str): The id of the payment.
+            fields (dict): The event fields. None values are left out.
+
+        Returns:
+            bool: True if the event has been written by this call.
+        """
+        args = [int(self.retention), self.max_length, 'session_id', session_id, 'payment_id', payment_id]
+        for field, value in fields.items():
+            if value is not None:
+                args.extend((field, str(value)))
+        entry_id = await self._publish(keys=[f"{self.EVENT_PREFIX}{session_id}", self.STREAM], args=args)
+        return entry_id is not None
+
+    async def _consume(self, handler):
+        while not self._closing:
+            try:
+                response = await self.redis.xreadgroup(
+                    handler.name, self.consumer, {self.STREAM: '>'}, count=1, block=5000
+                )
+                if not response:
+                    # A backend that answers an empty blocking read immediately must not starve the loop
+                    await asyncio.sleep(0.1)
+                for _, entries in response or []:
+                    for entry_id, fields in entries:
+                        await self._handle(handler, entry_id, fields)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.bind(rate_limit=f"outbox_{handler.name}").exception(
+                    f"Confirmation handler '{handler.name}' failed to read events: {e}"
+                )
+                await asyncio.sleep(1)
+
+    async def _handle(self, handler, entry_id, fields):
+        event = {_decode(key): _decode(value) for key, value in fields.items()}
+        # Events written before they carried a session id are keyed on their payment id
+        done_key = f"{self.DONE_PREFIX}{event.get('session_id', event['payment_id'])}"
+        claimed = await self._claim(keys=[done_key], args=[handler.name, time.time(), handler.timeout,
+                                                          int(self.retention)])
+        if claimed == 0:
+            await self.redis.xack(self.STREAM, handler.name, entry_id)
+            return
+        if claimed < 0:
+            # Left pending: the attempt holding it completes it, or its claim runs out and it is retried
+            return
+        try:
+            with timed(CONFIRMATION_HANDLER_LATENCY, handler=handler.name):
+                await asyncio.wait_for(handler.func(event), handler.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Left pending, to be retried by `_retry_loop`
+            await self.redis.hdel(done_key, handler.name)
+            logger.bind(wallet=event.get('wallet_address'), rate_limit=f"outbox_{handler.name}").warning(
+                f"Confirmation handler '{handler.name}' failed for {event['payment_id']}: {e!r}"
+            )
+            return
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(done_key, handler.name, time.time())
+            pipe.expire(done_key, int(self.retention))
+            pipe.xack(self.STREAM, handler.name, entry_id)
+            await pipe.execute()
+
+    async def _retry_loop(self, handler):
+        while not self._closing:
+            await asyncio.sleep(handler.backoff)
+            try:
+                await self.retry(handler)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.bind(rate_limit=f"outbox_retry_{handler.name}").exception(
+                    f"Confirmation handler '{handler.name}' failed to retry events: {e}"
+                )
+
+    async def retry(self, handler, count=100):
+        """
+        Runs a handler again for the events it failed on whose backoff is over, and dead-letters the events
+        that have used up their attempts. Events of a process that died are retried the same way.
+
+        Args:
+            handler (Handler): The handler.
+            count (int): The maximum number of pending events to inspect.
+        """
+        pending = await self.redis.xpending_range(self.STREAM, handler.name, '-', '+', count)
+        for entry in pending:
+            deliveries = entry['times_delivered']
+            # An attempt in progress is never taken over: it ends within `timeout`
+            min_idle_time = max(handler.backoff * 2 ** (deliveries - 1), handler.timeout) * 1000
+            if entry['time_since_delivered'] < min_idle_time:
+                continue
+            claimed = await self.redis.xclaim(
+                self.STREAM, handler.name, self.consumer, int(min_idle_time), [entry['message_id']]
+            )
+            for entry_id, fields in claimed:
+                if not fields:
+                    await self.redis.xack(self.STREAM, handler.name, entry_id)
+                elif deliveries >= handler.max_attempts:
+                    await self._dead_letter(handler, entry_id, fields)
+                else:
+                    await self._handle(handler, entry_id, fields)
+
+    async def _dead_letter(self, handler, entry_id, fields):
+        event = {_decode(key): _decode(value) for key, value in fields.items()}
+        logger.bind(wallet=event.get('wallet_address')).error(
+            f"Confirmation handler '{handler.name}' gave up on {event['payment_id']} after {handler.max_attempts} attempts"
+        )
+        await self.redis.rpush(self.DEAD_LETTER_KEY, json.dumps({
+            'handler': handler.name,
+            'event': event,
+            'failed_at': time.time(),
+        }))
+        await self.redis.xack(self.STREAM, handler.name, entry_id)
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
@@ -1,14 +1,19 @@
+import asyncio
+import time
+import aiohttp
+import config
 from dataclasses import dataclass
-from web3 import Web3
-from web3.auto import w3
+from eth_abi import encode, decode
+from web3 import AsyncWeb3, Web3
+from eth_account import Account
 from config import POLYGON_NODE_URL, SEPOLIA_NODE_URL, ARBITRUM_NODE_URL
+from rpc import RouterProvider
+from scheduler import block_time, rpc_budget
 
 
 @dataclass
 class Data:
 
-    # TODO MORE NETWORKS AND TOKENS
-
     ERC20_ABI = [
         {
             "constant": True,
@@ -27,143 +32,351 @@ class Data:
     ]
 
 
+    # Checksummed token contract addresses
     CONTRACT_ADDRESSES = {
         'polygon': {
-            'USDT': Web3.to_checksum_address('0xc2132D05D31c914a87C6611C10748AEb04B58e8F'),
-            'USDC': Web3.to_checksum_address('0x2791Bca1f2de4661ED88A30C99A7a9449Aa84174')
+            'USDT': '0xc2132D05D31c914a87C6611C10748AEb04B58e8F',
+            'USDC': '0x2791Bca1f2de4661ED88A30C99A7a9449Aa84174'
         },
         'arbitrum': {
-            'USDT': Web3.to_checksum_address('0xfd086bc7cd5c481dcc9c85ebe478a1c0b69fcbb9'),
-            'USDC': Web3.to_checksum_address('0xaf88d065e77c8cc2239327c5edb3a432268e5831')
+            'USDT': '0xFd086bC7CD5C481DCC9C85ebE478A1C0b69FCbb9',
+            'USDC': '0xaf88d065e77c8cC2239327C5EDb3A432268e5831'
         }
     }
 
+    NATIVE_TOKENS = {
+        'sepolia': 'ETH'
+    }
+
+    # Multicall3 is deployed at the same address on every supported network
+    MULTICALL3_ADDRESS = '0xcA11bde05977b3631167028862bE2a173976CA11'
+
+    MULTICALL3_ABI = [
+        {
+            "inputs": [
+                {
+                    "components": [
+                        {"name": "target", "type": "address"},
+                        {"name": "allowFailure", "type": "bool"},
+                        {"name": "callData", "type": "bytes"}
+                    ],
+                    "name": "calls",
+                    "type": "tuple[]"
+                }
+            ],
+            "name": "aggregate3",
+            "outputs": [
+                {
+                    "components": [
+                        {"name": "success", "type": "bool"},
+                        {"name": "returnData", "type": "bytes"}
+                    ],
+                    "name": "returnData",
+                    "type": "tuple[]"
+                }
+            ],
+            "stateMutability": "payable",
+            "type": "function"
+        }
+    ]
+
+    # First 4 bytes of the keccak hash of each signature, precomputed so importing this module does no hashing
+    BALANCE_OF_SELECTOR = bytes.fromhex('70a08231')  # balanceOf(address)
+    GET_ETH_BALANCE_SELECTOR = bytes.fromhex('4d2301cc')  # getEthBalance(address)
+
+
+@dataclass
+class TokenInfo:
+    """
+    Metadata of a token on a network.
+
+    Attributes:
+        network (str): The network the token lives on.
+        symbol (str): The upper-cased token symbol.
+        address (str): The checksummed contract address, or None for the native coin.
+        contract (AsyncContract): The contract object, or None for the native coin.
+        decimals (int): The number of decimals, or None until fetched.
+    """
+    network: str
+    symbol: str
+    address: str = None
+    contract: object = None
+    decimals: int = None
+
+    @property
+    def native(self):
+        return self.address is None
+
+
+class TokenRegistry:
+    """
+    Memoizes contract objects, checksummed addresses and decimals per (network, token).
+
+    Tokens come from `Data.CONTRACT_ADDRESSES` and `Data.NATIVE_TOKENS`, extended by the optional
+    `TOKEN_CONTRACTS` ({network: {symbol: address}}) and `NATIVE_TOKENS` ({network: symbol}) settings
+    in `config.py`. Decimals are fetched once by `warm_up` and never re-fetched afterwards.
+    """
+
+    def __init__(self, networks):
+        """
+        Builds the registry for the given network connections.
+
+        Args:
+            networks (dict): The AsyncWeb3 instances keyed by network name.
+        """
+        self._tokens = {}
+        native_tokens = {**Data.NATIVE_TOKENS, **getattr(config, 'NATIVE_TOKENS', {})}
+        for network, symbol in native_tokens.items():
+            if network in networks:
+                self._tokens[(network, symbol.upper())] = TokenInfo(network, symbol.upper(), decimals=18)
+
+        contract_addresses = {network: dict(tokens) for network, tokens in Data.CONTRACT_ADDRESSES.items()}
+        for network, tokens in getattr(config, 'TOKEN_CONTRACTS', {}).items():
+            contract_addresses.setdefault(network, {}).update(tokens)
+        for network, tokens in contract_addresses.items():
+            if network not in networks:
+                continue
+            for symbol, address in tokens.items():
+                address = Web3.to_checksum_address(address)
+                contract = networks[network].eth.contract(address=address, abi=Data.ERC20_ABI)
+                self._tokens[(network, symbol.upper())] = TokenInfo(network, symbol.upper(), address, contract)
+
+    async def warm_up(self):
+        """
+        Fetches the decimals of every registered token concurrently.
+        """
+        await asyncio.gather(*(
+            self.decimals(info.network, info.symbol)
+            for info in self._tokens.values()
+            if info.decimals is None
+        ))
+
+    def supports(self, network, token):
+        """
+        Checks whether a token is registered on a network.
+
+        Args:
+            network (str): The network name.
+            token (str): The token symbol.
+
+        Returns:
+            bool: True if the token is registered on the network.
+        """
+        return (network.lower(), token.upper()) in self._tokens
+
+    def get(self, network, token):
+        """
+        Returns the metadata of a token.
+
+        Args:
+            network (str): The network name.
+            token (str): The token symbol.
+
+        Returns:
+            TokenInfo: The metadata of the token.
+
+        Raises:
+            KeyError: If the token is not registered on the network.
+        """
+        return self._tokens[(network.lower(), token.upper())]
+
+    def tokens(self, network):
+        """
+        Returns the metadata of every token registered on a network.
+
+        Args:
+            network (str): The network name.
+
+        Returns:
+            list: TokenInfo objects of the network.
+        """
+        return [info for (token_network, _), info in self._tokens.items() if token_network == network.lower()]
+
+    def all(self):
+        """
+        Returns the metadata of every registered token.
+
+        Returns:
+            list: TokenInfo objects of every network.
+        """
+        return list(self._tokens.values())
+
+    async def decimals(self, network, token):
+        """
+        Returns the decimals of a token, fetching them over the network only the first time.
+
+        Args:
+            network (str): The network name.
+            token (str): The token symbol.
+
+        Returns:
+            int: The number of decimals of the token.
+        """
+        info = self.get(network, token)
+        if info.decimals is None:
+            info.decimals = await info.contract.functions.decimals().call()
+        return info.decimals
+
+
+def _create_wallet():
+    Account.enable_unaudited_hdwallet_features()
+    new_account = Account.create_with_mnemonic()
+    address = new_account[0].address
+    private_key = new_account[0]._private_key.hex()
+    mnemonic = new_account[1]
+    return address, private_key, mnemonic
+
 
 class Payments:
     """
     A class to handle wallet generation and token balance checks for different networks.
 
+    A single instance is meant to be shared by the whole process: every node URL gets one keep-alive
+    connection pool, opened by `connect` and released by `close`. Each node URL setting may be a list of
+    URLs, which are routed between by a RouterProvider.
+
     Attributes:
-        polygon_w3 (Web3): An instance of Web3 connected to the Polygon network.
-        arbitrum_w3 (Web3): An instance of Web3 connected to the Arbitrum network.
-        sepolia_w3 (Web3): An instance of Web3 connected to the Sepolia testnet.
+        polygon_w3 (AsyncWeb3): An instance of AsyncWeb3 connected to the Polygon network.
+        arbitrum_w3 (AsyncWeb3): An instance of AsyncWeb3 connected to the Arbitrum network.
+        sepolia_w3 (AsyncWeb3): An instance of AsyncWeb3 connected to the Sepolia testnet.
+        networks (dict): The AsyncWeb3 instances keyed by network name.
+        tokens (TokenRegistry): The token metadata of every network.
     """
 
     def __init__(self):
         """
         Initializes the Payments class by setting up connections to the various Ethereum-based networks.
         """
-        self.polygon_w3 = Web3(Web3.HTTPProvider(POLYGON_NODE_URL))
-        self.arbitrum_w3 = Web3(Web3.HTTPProvider(ARBITRUM_NODE_URL))
-        self.sepolia_w3 = Web3(Web3.HTTPProvider(SEPOLIA_NODE_URL))
+        self.polygon_w3 = AsyncWeb3(self._provider('polygon', POLYGON_NODE_URL))
+        self.arbitrum_w3 = AsyncWeb3(self._provider('arbitrum', ARBITRUM_NODE_URL))
+        self.sepolia_w3 = AsyncWeb3(self._provider('sepolia', SEPOLIA_NODE_URL))
+        self.networks = {
+            'polygon': self.polygon_w3,
+            'arbitrum': self.arbitrum_w3,
+            'sepolia': self.sepolia_w3,
+        }
+        for network, node_url in getattr(config, 'NODE_URLS', {}).items():
+            self.networks[network] = AsyncWeb3(self._provider(network, node_url))
+        self.tokens = TokenRegistry(self.networks)
+        self._sessions = []
+        self._heads = {}
 
     @staticmethod
-    async def generate_wallet():
+    def _provider(network, node_urls):
+        return RouterProvider(network, node_urls, budget=rpc_budget(network), block_time=block_time(network))
+
+    async def connect(self, pool_size=100, keepalive_timeout=60):
         """
-        Generates a new Ethereum wallet with a mnemonic phrase.
+        Opens one keep-alive HTTP connection pool per node URL and starts the health checks of every network.
 
-        Returns:
-            tuple: A tuple containing the address, private key, and mnemonic phrase for the new wallet.
+        Args:
+            pool_size (int): The maximum number of concurrent connections per node URL.
+            keepalive_timeout (float): Seconds an idle connection is kept open for reuse.
+        """
+        for w3 in self.networks.values():
+            for endpoint in w3.provider.endpoints:
+                session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=pool_size, keepalive_timeout=keepalive_timeout),
+                    timeout=aiohttp.ClientTimeout(total=30),
+                )
+                await endpoint.provider.cache_async_session(session)
+                self._sessions.append(session)
+            w3.provider.start()
+
+    async def warm_up(self):
+        """
+        Opens a connection to every node URL and fetches the token metadata, so the first payments do not
+        wait for either.
+        """
+        await asyncio.gather(*(w3.provider.check_health() for w3 in self.networks.values()))
+        await self.tokens.warm_up()
+
+    async def close(self):
+        """
+        Stops the health checks and closes the connection pools opened by `connect`.
         """
-        w3.eth.account.enable_unaudited_hdwallet_features()
-        new_account = w3.eth.account.create_with_mnemonic()
-        address = new_account[0].address
-        private_key = new_account[0]._private_key.hex()
-        mnemonic = new_account[1]
-        return address, private_key, mnemonic
+        for w3 in self.networks.values():
+            await w3.provider.close()
+        for session in self._sessions:
+            await session.close()
+        self._sessions = []
 
-    async def get_token_balance(self, w3, address, token, network):
+    async def block_number(self, network, max_age=1):
         """
-        Fetches the token balance for a given address on a specified network.
+        Returns the head block number of a network. A head read less than `max_age` seconds ago is reused, so
+        a burst of checkouts costs one request; an older head only makes the watcher scan a few more blocks.
 
         Args:
-            w3 (Web3): The Web3 instance connected to the desired network.
-            address (str): The address to query the balance for.
-            token (str): The token symbol to query the balance of.
-            network (str): The network to query the balance on.
+            network (str): The network name.
+            max_age (float): Seconds a head that has been read is reused.
 
         Returns:
-            float: The balance of the token for the given address.
+            int: The head block number.
         """
-        contract_address = Data.CONTRACT_ADDRESSES[network][token]
-        token_contract = w3.eth.contract(address=contract_address, abi=Data.ERC20_ABI)
-        balance = token_contract.functions.balanceOf(Web3.to_checksum_address(address)).call()
+        head, read_at = self._heads.get(network, (None, 0))
+        if head is None or time.monotonic() - read_at > max_age:
+            head = await self.networks[network].eth.block_number
+            self._heads[network] = (head, time.monotonic())
+        return head
 
-        decimals = token_contract.functions.decimals().call()
-        readable_balance = balance / (10 ** decimals)
+    @staticmethod
+    async def generate_wallet():
+        """
+        Generates a new Ethereum wallet with a mnemonic phrase. The key stretching of the mnemonic runs in a
+        thread, off the event loop.
 
-        return readable_balance
+        Returns:
+            tuple: A tuple containing the address, private key, and mnemonic phrase for the new wallet.
+        """
+        return await asyncio.to_thread(_create_wallet)
 
-    async def check_token_transaction(self, w3, address, expected_amount, token, network):
+    async def get_token_balances(self, queries, chunk_size=500, block_identifier='latest', raw=False):
         """
-        Checks if a token transaction meets or exceeds an expected amount.
+        Fetches many balances at once, using one Multicall3 aggregate call per chunk per network.
 
         Args:
-            w3 (Web3): The Web3 instance connected to the desired network.
-            address (str): The address to check the transaction for.
-            expected_amount (str): The expected amount of tokens.
-            token (str): The token symbol to check the transaction of.
-            network (str): The network to check the transaction on.
+            queries (iterable): Tuples of (address, token, network). The native token of a network
+                is queried through Multicall3's getEthBalance, other tokens through balanceOf.
+                Decimals come from the token registry.
+            chunk_size (int): The maximum number of calls packed into a single aggregate call.
+            block_identifier (int or str): The block to read the balances at.
+            raw (bool): Return balances in token base units instead of readable amounts.
 
         Returns:
-            bool: True if the balance meets or exceeds the expected amount, False otherwise.
+            dict: Balances keyed by the (address, token, network) tuples of the query.
+                Queries whose call failed are left out.
         """
-        if token.lower() == 'eth':
-            balance = w3.eth.get_balance(w3.to_checksum_address(address))
-            balance_in_eth = w3.from_wei(balance, 'ether')
-            return balance_in_eth >= 0.97 * float(expected_amount)
-        else:
-            balance = await self.get_token_balance(w3, w3.to_checksum_address(address), token, network)
-            return balance >= 0.97 * float(expected_amount)
+        by_network = {}
+        for query in queries:
+            by_network.setdefault(query[2], []).append(query)
 
-    async def start_payment_session(self, expected_amount, address, token, network):
-        """
-        Starts a payment session by checking if the received amount of tokens at an address is as expected.
+        balances = {}
+        for network, network_queries in by_network.items():
+            w3 = self.networks[network]
+            multicall = w3.eth.contract(address=Data.MULTICALL3_ADDRESS, abi=Data.MULTICALL3_ABI)
 
-        Args:
-            expected_amount (float): The amount of tokens expected to receive.
-            address (str): The wallet address to monitor for incoming tokens.
-            token (str): The token symbol to monitor.
-            network (str): The network where the address is to be monitored.
+            calls = []
+            decimals = []
+            for address, token, _ in network_queries:
+                info = self.tokens.get(network, token)
+                owner = encode(['address'], [Web3.to_checksum_address(address)])
+                if info.native:
+                    calls.append((Data.MULTICALL3_ADDRESS, True, Data.GET_ETH_BALANCE_SELECTOR + owner))
+                else:
+                    calls.append((info.address, True, Data.BALANCE_OF_SELECTOR + owner))
+                decimals.append(await self.tokens.decimals(network, token))
 
-        Returns:
-            tuple: A tuple containing a boolean indicating success, and a string indicating the network, if successful.
-        """
-
-        if network == "ethereum":
-            if token == "ETH":
-                pass
-            elif token == "USDT":
-                pass
-            elif token == "USDC":
-                pass
-
-        elif network.lower() == "sepolia":
-            if token == "eth":
-                res = await self.check_token_transaction(self.sepolia_w3, address, expected_amount, 'ETH', 'sepolia')
-                if res:
-                    return True, "sepolia"
-
-        elif network == "polygon":
-            if token == "ETH":
-                pass
-            elif token == "USDT":
-                if await self.check_token_transaction(self.polygon_w3, address, expected_amount, 'USDT', 'polygon'):
-                    return True, "polygon"
-
-            elif token == "USDC":
-                if await self.check_token_transaction(self.polygon_w3, address, expected_amount, 'USDC', 'polygon'):
-                    return True, "polygon"
-
-        elif network == "arbitrum":
-            if token == "ETH":
-                pass
-            elif token == "USDT":
-                if await self.check_token_transaction(self.arbitrum_w3, address, expected_amount, 'USDT', 'arbitrum'):
-                    return True, "arbitrum"
-
-            elif token == "USDC":
-                if await self.check_token_transaction(self.arbitrum_w3, address, expected_amount, 'USDC', 'arbitrum'):
-                    return True, "arbitrum"
-
-        return False, "-"
\ No newline at end of file
+            results = []
+            for start in range(0, len(calls), chunk_size):
+                results.extend(
+                    await multicall.functions.aggregate3(calls[start:start + chunk_size]).call(
+                        block_identifier=block_identifier
+                    )
+                )
+
+            for query, token_decimals, (success, data) in zip(network_queries, decimals, results):
+                if success:
+                    balance = decode(['uint256'], data)[0]
+                    balances[query] = balance if raw else balance / (10 ** token_decimals)
+
+        return balances
@@ -0,0 +1,166 @@
+from dataclasses import dataclass
+from decimal import Decimal, ROUND_UP
+from types import MappingProxyType
+import config
+
+
+# Subscription plans in the order they are shown: name -> (tier, term, price in USD).
+# Replaced by `PLANS` in `config.py`.
+PLANS = {
+    'basic_1_month': ('Basic', '1 Month', 9),
+    'basic_6_months': ('Basic', '6 Months', 18),
+    'basic_lifetime': ('Basic', 'Lifetime', 49),
+    'vip_1_month': ('VIP', '1 Month', 14),
+    'vip_6_months': ('VIP', '6 Months', 36),
+    'vip_lifetime': ('VIP', 'Lifetime', 79),
+}
+
+# Native coins priced from the ETH price. Every other token is a USD stablecoin priced 1:1.
+ETH_PRICED_TOKENS = {'ETH'}
+
+# The most decimals an amount is quoted with, however many the token has.
+MAX_DECIMALS = 6
+
+
+@dataclass(frozen=True)
+class Plan:
+    """
+    A subscription plan.
+
+    Attributes:
+        name (str): The plan id submitted by the plan form.
+        tier (str): The tier the plan belongs to.
+        term (str): The duration of the plan.
+        usd (Decimal): The price of the plan in USD.
+    """
+    name: str
+    tier: str
+    term: str
+    usd: Decimal
+
+
+def load_plans(plans=None):
+    """
+    Loads the subscription plans.
+
+    Args:
+        plans (dict): The plans as name -> (tier, term, price in USD). Defaults to `PLANS` in `config.py`.
+
+    Returns:
+        MappingProxyType: Plan objects keyed by name, in catalog order.
+    """
+    plans = plans or getattr(config, 'PLANS', PLANS)
+    return MappingProxyType({
+        name: Plan(name, tier, term, Decimal(str(usd))) for name, (tier, term, usd) in plans.items()
+    })
+
+
+def group_tiers(plans):
+    """
+    Groups plans by tier, in catalog order.
+
+    Args:
+        plans (Mapping): Plan objects keyed by name.
+
+    Returns:
+        dict: Lists of Plan objects keyed by tier.
+    """
+    tiers = {}
+    for plan in plans.values():
+        tiers.setdefault(plan.tier, []).append(plan)
+    return tiers
+
+
+def quantize(amount, decimals):
+    """
+    Rounds an amount up to the precision a token is quoted with, without trailing zeros.
+
+    Args:
+        amount (Decimal): The exact amount.
+        decimals (int): The decimals of the token.
+
+    Returns:
+        Decimal: The amount rounded up to `min(decimals, MAX_DECIMALS)` places.
+    """
+    amount = amount.quantize(Decimal(1).scaleb(-min(decimals, MAX_DECIMALS)), rounding=ROUND_UP)
+    return amount.quantize(Decimal(1)) if amount == amount.to_integral_value() else amount.normalize()
+
+
+class PlanCatalog:
+    """
+    The subscription plans and their price in every supported token, computed ahead of the requests.
+
+    The catalog is loaded once into read-only tables keyed by (plan, network, token), so quoting a price is a
+    single lookup. Stablecoin prices are fixed; ETH prices are recomputed for every plan at once each time the
+    price oracle refreshes the ETH price, and the whole table is swapped. ETH prices are withdrawn while the
+    oracle's price is older than its `max_staleness`.
+    """
+
+    def __init__(self, tokens, oracle, plans=None):
+        """
+        Builds the catalog. Token decimals must have been fetched already.
+
+        Args:
+            tokens (TokenRegistry): The token metadata of every network.
+            oracle (PriceOracle): The ETH price source.
+            plans (Mapping): Plan objects keyed by name, see `load_plans`. Defaults to loading `PLANS` in `config.py`.
+        """
+        self.plans = plans if plans is not None else load_plans()
+        self.tokens = tokens
+        self.oracle = oracle
+        self._eth_tokens = []
+        fixed = {}
+        for info in tokens.all():
+            if info.symbol in ETH_PRICED_TOKENS:
+                self._eth_tokens.append((info.network, info.symbol, info.decimals))
+            elif not info.native:
+                for plan in self.plans.values():
+                    fixed[(plan.name, info.network, info.symbol)] = quantize(plan.usd, info.decimals)
+        self._fixed = MappingProxyType(fixed)
+        self._eth = MappingProxyType({})
+        self.eth_price = None
+        if oracle.price is not None:
+            self.update_eth_price(oracle.price)
+        oracle.add_listener(self.update_eth_price)
+
+    def close(self):
+        """
+        Stops following the ETH price of the oracle.
+        """
+        self.oracle.remove_listener(self.update_eth_price)
+
+    def update_eth_price(self, price):
+        """
+        Recomputes the ETH price of every plan.
+
+        Args:
+            price (float): The ETH price in USD.
+        """
+        if price == self.eth_price:
+            return
+        eth_price = Decimal(str(price))
+        self._eth = MappingProxyType({
+            (plan.name, network, symbol): quantize(plan.usd / eth_price, decimals)
+            for plan in self.plans.values()
+            for network, symbol, decimals in self._eth_tokens
+        })
+        self.eth_price = price
+
+    def price(self, plan_name, network, token):
+        """
+        Quotes the price of a plan in a token.
+
+        Args:
+            plan_name (str): The plan name.
+            network (str): The network name.
+            token (str): The token symbol.
+
+        Returns:
+            Decimal: The amount to pay, or None if the plan or token is unknown or no fresh ETH price is available.
+        """
+        key = (plan_name, network.lower(), token.upper())
+        if key in self._fixed:
+            return self._fixed[key]
+        if self.oracle.stale:
+            return None
+        return self._eth.get(key)
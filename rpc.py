@@ -0,0 +1,289 @@
+import asyncio
+import time
+from collections import deque
+from urllib.parse import urlparse
+from web3.providers import AsyncHTTPProvider
+from web3.providers.async_base import AsyncBaseProvider
+from logger import logging as logger
+from metrics import RPC_ENDPOINT_FAILURES, RPC_HEDGED_REQUESTS, RPC_LATENCY, timed
+
+
+# Calls with side effects are never sent to two endpoints at once.
+UNHEDGED_METHODS = {'eth_sendRawTransaction', 'eth_sendTransaction'}
+
+# JSON-RPC errors every node gives for the same request: execution reverted, invalid request, invalid params.
+# They are answers, not failures of the node.
+DETERMINISTIC_ERROR_CODES = {3, -32600, -32602}
+
+
+class ErrorResponse(Exception):
+    """
+    A JSON-RPC error response from a node that another node may answer successfully, such as a lagging
+    node's "header not found" or a provider's rate limit.
+    """
+
+    def __init__(self, response):
+        super().__init__(response['error'])
+        self.response = response
+
+
+def _is_deterministic(error):
+    if not isinstance(error, dict):
+        return False
+    return error.get('code') in DETERMINISTIC_ERROR_CODES or 'revert' in str(error.get('message', '')).lower()
+
+
+def _discard(task):
+    if not task.cancelled():
+        task.exception()
+
+
+def _http_provider(uri):
+    # web3 7+ retries failed requests on the same node by itself, which would hold back failover
+    try:
+        return AsyncHTTPProvider(uri, exception_retry_configuration=None)
+    except TypeError:
+        return AsyncHTTPProvider(uri)
+
+
+class Endpoint:
+    """
+    One node URL of a network, with its recent latencies and outcomes and a circuit breaker.
+
+    After `failure_threshold` consecutive failures the circuit opens and the endpoint is only used as a last
+    resort for `reset_timeout` seconds. Afterwards a single success closes it again and a failure reopens it.
+    """
+
+    def __init__(self, uri, failure_threshold=3, reset_timeout=30, window=100):
+        self.uri = uri
+        self.name = urlparse(uri).netloc or uri
+        self.provider = _http_provider(uri)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.failures = 0
+        self.open_until = 0
+        self.head = None
+        self.head_at = None
+
+    @property
+    def available(self):
+        return time.monotonic() >= self.open_until
+
+    def percentile(self, q, min_samples=10):
+        """
+        Returns the `q` quantile of the recent latencies, or None until there are `min_samples` of them.
+        """
+        if not self.latencies or len(self.latencies) < min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[int(q * (len(latencies) - 1))]
+
+    def score(self):
+        """
+        Ranks the endpoint: its median latency inflated by its recent error rate. Lower is better,
+        and an endpoint without samples comes first so it gets measured.
+        """
+        if not self.outcomes:
+            return 0
+        success_rate = sum(self.outcomes) / len(self.outcomes)
+        if not success_rate:
+            return float('inf')
+        return (self.percentile(0.5, min_samples=1) or 0) / success_rate
+
+    def record_success(self, latency):
+        self.latencies.append(latency)
+        self.outcomes.append(True)
+        self.failures = 0
+        self.open_until = 0
+
+    def record_failure(self):
+        self.outcomes.append(False)
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.open_until = time.monotonic() + self.reset_timeout
+
+
+class RouterProvider(AsyncBaseProvider):
+    """
+    Routes the JSON-RPC requests of one network across several node URLs.
+
+    Each request goes to the fastest healthy endpoint. Reads still unanswered after that endpoint's
+    `hedge_percentile` latency are also sent to the next endpoint and the first answer wins, while the slower
+    request runs to completion and is still measured. A request that fails is retried on the next endpoint
+    right away. Endpoints whose circuit is open or whose head lags more than `max_lag` blocks behind the others
+    are only used when nothing better is left. A background task probes every endpoint's head each
+    `health_interval` seconds.
+
+    A JSON-RPC error response counts as a failure of the endpoint and is retried on the next one, unless it is
+    an error every node would give, such as a reverted call. When every endpoint has failed with an error
+    response, the last one is returned for web3 to raise.
+
+    Every request sent to an endpoint, including hedged and failed-over ones, is spaced out by the network's
+    request budget, if it has one, and their latency is recorded by network and method.
+    """
+
+    def __init__(self, network, endpoint_uris, budget=None, block_time=None, hedge_percentile=0.9, hedge_delay=1.0,
+                 min_hedge_delay=0.05, max_lag=3, health_interval=15, failure_threshold=3, reset_timeout=30):
+        """
+        Initializes the router.
+
+        Args:
+            network (str): The network name.
+            endpoint_uris (str or list): One node URL or a list of them.
+            budget (TokenBucket): The request budget of the network, if any.
+            block_time (float): Seconds per block, used to compare heads read at different times.
+            hedge_percentile (float): The latency quantile of an endpoint after which a read is hedged.
+            hedge_delay (float): The hedge delay of an endpoint with too few latency samples.
+            min_hedge_delay (float): The shortest hedge delay.
+            max_lag (int): Blocks an endpoint may lag behind the highest head before it is avoided.
+            health_interval (float): Seconds between health probes.
+            failure_threshold (int): Consecutive failures that open the circuit of an endpoint.
+            reset_timeout (float): Seconds the circuit of an endpoint stays open.
+        """
+        super().__init__()
+        if isinstance(endpoint_uris, str):
+            endpoint_uris = [endpoint_uris]
+        self.network = network
+        self.endpoints = [Endpoint(uri, failure_threshold, reset_timeout) for uri in endpoint_uris]
+        self.budget = budget
+        self.block_time = block_time
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.max_lag = max_lag
+        self.health_interval = health_interval
+        self._task = None
+
+    def start(self):
+        """
+        Starts probing the endpoints in the background, if there is more than one.
+        """
+        if self._task is None and len(self.endpoints) > 1:
+            self._task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def ranked(self):
+        """
+        Orders the endpoints for the next request.
+
+        Returns:
+            list: Available, up-to-date endpoints by score, then lagging ones by score, then endpoints with
+                an open circuit in the order their circuits close.
+        """
+        now = time.monotonic()
+        heads = {endpoint: self._projected_head(endpoint, now) for endpoint in self.endpoints if endpoint.head is not None}
+        best_head = max(heads.values(), default=None)
+
+        def lagging(endpoint):
+            return endpoint in heads and best_head - heads[endpoint] > self.max_lag
+
+        available = [endpoint for endpoint in self.endpoints if endpoint.available]
+        unavailable = sorted(
+            (endpoint for endpoint in self.endpoints if not endpoint.available),
+            key=lambda endpoint: endpoint.open_until,
+        )
+        return sorted(available, key=lambda endpoint: (lagging(endpoint), endpoint.score())) + unavailable
+
+    def _projected_head(self, endpoint, now):
+        # A head read earlier has moved on since, so heads read at different times are compared at `now`
+        if not self.block_time:
+            return endpoint.head
+        return endpoint.head + (now - endpoint.head_at) / self.block_time
+
+    async def make_request(self, method, params):
+        if self.budget is not None:
+            await self.budget.acquire()
+        with timed(RPC_LATENCY, network=self.network, method=method):
+            return await self._send(method, params, self.ranked(), hedge=method not in UNHEDGED_METHODS)
+
+    async def _send(self, method, params, candidates, hedge):
+        candidates = list(candidates)
+        endpoint = candidates.pop(0)
+        tasks = {asyncio.ensure_future(self._call(endpoint, method, params))}
+        delay = self._hedge_delay(endpoint) if hedge else None
+        error = None
+        try:
+            while tasks:
+                can_hedge = candidates and candidates[0].available
+                done, _ = await asyncio.wait(
+                    tasks, timeout=delay if can_hedge else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # Too slow: race the next endpoint once
+                    RPC_HEDGED_REQUESTS.labels(network=self.network).inc()
+                    tasks.add(await self._launch(candidates.pop(0), method, params))
+                    delay = None
+                    continue
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not tasks and candidates:
+                    # Failed: fail over to the next endpoint
+                    tasks.add(await self._launch(candidates.pop(0), method, params))
+        finally:
+            # Requests still in flight are left to finish, as cancelling one inside web3's session lock leaks the lock
+            for task in tasks:
+                task.add_done_callback(_discard)
+        if isinstance(error, ErrorResponse):
+            return error.response
+        raise error
+
+    async def _launch(self, endpoint, method, params):
+        # Hedged and failed-over requests are charged to the budget like the first one
+        if self.budget is not None:
+            await self.budget.acquire()
+        return asyncio.ensure_future(self._call(endpoint, method, params))
+
+    def _hedge_delay(self, endpoint):
+        delay = endpoint.percentile(self.hedge_percentile)
+        if delay is None:
+            delay = self.hedge_delay
+        return max(delay, self.min_hedge_delay)
+
+    async def _call(self, endpoint, method, params):
+        started = time.monotonic()
+        try:
+            response = await endpoint.provider.make_request(method, params)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._record_failure(endpoint)
+            raise
+        if isinstance(response, dict) and 'error' in response and not _is_deterministic(response['error']):
+            self._record_failure(endpoint)
+            raise ErrorResponse(response)
+        endpoint.record_success(time.monotonic() - started)
+        return response
+
+    def _record_failure(self, endpoint):
+        endpoint.record_failure()
+        RPC_ENDPOINT_FAILURES.labels(network=self.network, endpoint=endpoint.name).inc()
+
+    async def check_health(self):
+        """
+        Reads the head of every endpoint, which also closes the circuit of endpoints that have recovered.
+        """
+        async def probe(endpoint):
+            try:
+                response = await self._call(endpoint, 'eth_blockNumber', [])
+                endpoint.head = int(response['result'], 16)
+                endpoint.head_at = time.monotonic()
+            except Exception as e:
+                logger.bind(network=self.network, rate_limit=f"rpc_health_{self.network}_{endpoint.name}").info(
+                    f"Health check of {endpoint.name} on {self.network} failed: {e}"
+                )
+
+        await asyncio.gather(*(probe(endpoint) for endpoint in self.endpoints))
+
+    async def _health_loop(self):
+        while True:
+            await self.check_health()
+            await asyncio.sleep(self.health_interval)
@@ -0,0 +1,90 @@
+import asyncio
+import time
+import config
+
+
+# Average seconds per block. Deposit watchers poll at this cadence, but never faster than MIN_POLL_INTERVAL.
+BLOCK_TIMES = {
+    'polygon': 2,
+    'arbitrum': 0.25,
+    'sepolia': 12,
+}
+MIN_POLL_INTERVAL = 1
+
+# Requests per second and burst size allowed per RPC provider, unless set in `RPC_RATE_LIMITS`.
+DEFAULT_RPC_RATE_LIMIT = (20, 40)
+
+
+def block_time(network):
+    """
+    Returns the average block time of a network from `BLOCK_TIMES`, overridable in `config.py`.
+
+    Args:
+        network (str): The network name.
+
+    Returns:
+        float: Seconds per block, or None if the network's block time is unknown.
+    """
+    return {**BLOCK_TIMES, **getattr(config, 'BLOCK_TIMES', {})}.get(network)
+
+
+def poll_interval(network):
+    """
+    Returns the cadence at which new blocks are polled on a network.
+
+    Args:
+        network (str): The network name.
+
+    Returns:
+        float: Seconds between polls, the network's block time but at least MIN_POLL_INTERVAL.
+    """
+    return max(block_time(network) or MIN_POLL_INTERVAL, MIN_POLL_INTERVAL)
+
+
+def rpc_budget(network):
+    """
+    Builds the request budget of a network's RPC provider from `RPC_RATE_LIMITS` in `config.py`.
+
+    Args:
+        network (str): The network name.
+
+    Returns:
+        TokenBucket: The budget, or None if the network is configured without a limit.
+    """
+    limits = getattr(config, 'RPC_RATE_LIMITS', {}).get(network, DEFAULT_RPC_RATE_LIMIT)
+    if limits is None:
+        return None
+    rate, burst = limits
+    return TokenBucket(rate, burst)
+
+
+class TokenBucket:
+    """
+    Spaces out requests to at most `rate` per second on average, with bursts of up to `burst`.
+
+    Waiters are served in arrival order, so a caller that is over budget delays later callers instead of
+    being overtaken by them.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, tokens=1):
+        """
+        Waits until `tokens` requests fit in the budget and spends them.
+        """
+        async with self._lock:
+            self._refill()
+            while self.tokens < tokens:
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= tokens
@@ -1,33 +1,168 @@
-import aiosmtplib
+import asyncio
+import json
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 from config import GMAIL_USER, GMAIL_PASSWORD
 from logger import logging as logger
+from metrics import EMAIL_MESSAGES, EMAIL_SEND_LATENCY, timed
 
 
-async def send_message(recipient_email, subject, body):
-    smtp_server = 'smtp.gmail.com'
-    smtp_port = 587
-    gmail_user = GMAIL_USER
-    gmail_password = GMAIL_PASSWORD
-
-    msg = MIMEMultipart()
-    msg['From'] = gmail_user
-    msg['To'] = recipient_email
-    msg['Subject'] = subject
-
-    msg.attach(MIMEText(body, 'plain'))
-
-    try:
-        await aiosmtplib.send(
-            msg,
-            hostname=smtp_server,
-            port=smtp_port,
-            start_tls=True,
-            username=gmail_user,
-            password=gmail_password,
-        )
-        logger.info(f"Message was sent to {recipient_email}")
-    except aiosmtplib.SMTPException as err:
-        logger.info(f"Message was not sent to {recipient_email}: {err}")
+class Mailer:
+    """
+    Sends emails through a small pool of persistent, authenticated SMTP connections.
+
+    Messages are put on a bounded queue and sent by `pool_size` senders that each keep one connection
+    open, reconnecting after `idle_timeout` seconds without traffic or after an error. `send` returns once a
+    message is queued; failed messages are retried with exponential backoff and pushed to a dead-letter list in
+    Redis after `max_attempts`. `deliver` makes a single attempt and waits for it, leaving retries to its caller;
+    a message whose caller has stopped waiting before it was sent is dropped.
+    Sent, failed and dead-lettered messages are counted in the `payment_email_messages_total` metric.
+    aiosmtplib is imported when the first message is sent.
+    """
+
+    DEAD_LETTER_KEY = 'mail_dead_letter'
+
+    def __init__(self, redis=None, pool_size=2, queue_size=1000, max_attempts=5, idle_timeout=60,
+                 hostname='smtp.gmail.com', port=587, start_tls=True, username=GMAIL_USER, password=GMAIL_PASSWORD,
+                 sender=None):
+        self.redis = redis
+        self.pool_size = pool_size
+        self.max_attempts = max_attempts
+        self.idle_timeout = idle_timeout
+        self.hostname = hostname
+        self.port = port
+        self.start_tls = start_tls
+        self.username = username
+        self.password = password
+        self.sender = sender or username
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+
+    async def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._sender()) for _ in range(self.pool_size)]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def send(self, recipient_email, subject, body):
+        """
+        Queues an email, waiting for room if the queue is full.
+
+        Args:
+            recipient_email (str): The recipient address.
+            subject (str): The subject line.
+            body (str): The plain-text body.
+        """
+        await self.queue.put((self.build_message(recipient_email, subject, body), 1, None))
+
+    async def deliver(self, recipient_email, subject, body):
+        """
+        Queues an email and waits for a single attempt to send it. The email is neither retried nor dead-lettered,
+        and it is dropped if the caller is cancelled before it has been sent.
+
+        Args:
+            recipient_email (str): The recipient address.
+            subject (str): The subject line.
+            body (str): The plain-text body.
+
+        Returns:
+            bool: True if the email was sent, False if the attempt failed.
+        """
+        done = asyncio.get_running_loop().create_future()
+        await self.queue.put((self.build_message(recipient_email, subject, body), 1, done))
+        # Cancelling the caller cancels `done`, which the senders check before sending
+        return await done
+
+    def build_message(self, recipient_email, subject, body):
+        msg = MIMEMultipart()
+        msg['From'] = self.sender
+        msg['To'] = recipient_email
+        msg['Subject'] = subject
+
+        msg.attach(MIMEText(body, 'plain'))
+        return msg
+
+    async def _sender(self):
+        smtp = None
+        last_used = 0
+        while True:
+            msg, attempt, done = await self.queue.get()
+            if done is not None and done.cancelled():
+                self.queue.task_done()
+                continue
+            import aiosmtplib
+            try:
+                if smtp is not None and (not smtp.is_connected or time.monotonic() - last_used > self.idle_timeout):
+                    smtp.close()
+                    smtp = None
+                with timed(EMAIL_SEND_LATENCY):
+                    if smtp is None:
+                        smtp = aiosmtplib.SMTP(
+                            hostname=self.hostname,
+                            port=self.port,
+                            start_tls=self.start_tls,
+                            username=self.username,
+                            password=self.password,
+                        )
+                        await smtp.connect()
+                    await smtp.send_message(msg)
+                last_used = time.monotonic()
+                EMAIL_MESSAGES.labels(outcome='sent').inc()
+                logger.info(f"Message was sent to {msg['To']}")
+                _resolve(done, True)
+            except (aiosmtplib.SMTPException, OSError) as err:
+                if smtp is not None:
+                    smtp.close()
+                    smtp = None
+                EMAIL_MESSAGES.labels(outcome='failed').inc()
+                await self._retry(msg, attempt, done, err)
+            except Exception as err:
+                EMAIL_MESSAGES.labels(outcome='failed').inc()
+                await self._retry(msg, self.max_attempts, done, err)
+            finally:
+                self.queue.task_done()
+
+    async def _retry(self, msg, attempt, done, err):
+        if done is not None:
+            # The caller of `deliver` retries it
+            logger.info(f"Message was not sent to {msg['To']}: {err}")
+            _resolve(done, False)
+            return
+        if attempt < self.max_attempts:
+            delay = 2 ** attempt
+            logger.info(f"Message was not sent to {msg['To']}, retrying in {delay}s: {err}")
+            asyncio.get_running_loop().call_later(delay, self._requeue, msg, attempt + 1, done)
+            return
+
+        logger.info(f"Message was not sent to {msg['To']}: {err}")
+        EMAIL_MESSAGES.labels(outcome='dead_lettered').inc()
+        _resolve(done, False)
+        if self.redis is not None:
+            # A failure here must not end the sender task
+            try:
+                await self.redis.rpush(self.DEAD_LETTER_KEY, json.dumps({
+                    'to': msg['To'],
+                    'subject': msg['Subject'],
+                    'message': msg.as_string(),
+                    'error': str(err),
+                    'failed_at': time.time(),
+                }))
+            except Exception as e:
+                logger.exception(f"Failed to dead-letter the message to {msg['To']}: {e}")
+
+    def _requeue(self, msg, attempt, done):
+        try:
+            self.queue.put_nowait((msg, attempt, done))
+        except asyncio.QueueFull:
+            asyncio.create_task(self.queue.put((msg, attempt, done)))
+
+
+def _resolve(done, sent):
+    if done is not None and not done.done():
+        done.set_result(sent)
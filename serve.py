@@ -0,0 +1,33 @@
+"""
+Serves the app with Hypercorn in several worker processes.
+
+Each worker process runs the startup of `index.py` before it accepts connections and, on SIGTERM or SIGINT,
+stops accepting new requests, lets open ones finish for up to `GRACEFUL_TIMEOUT` seconds and hands the
+payment jobs of its embedded worker back to the queue. With more than one worker process, payment jobs are
+only verified by standalone `worker.py` processes, unless `EMBEDDED_WORKER` is enabled in `config.py`.
+"""
+import os
+import config
+from hypercorn.config import Config
+from hypercorn.run import run
+
+
+def main():
+    workers = getattr(config, 'WEB_WORKERS', None) or os.cpu_count() or 1
+    if workers > 1 and not getattr(config, 'SECRET_KEY', None):
+        raise SystemExit("Set SECRET_KEY in config.py to run more than one web worker.")
+
+    # Read by every worker process of `index.py` to leave payment verification to standalone workers
+    os.environ['WEB_WORKERS'] = str(workers)
+
+    hypercorn_config = Config()
+    hypercorn_config.application_path = 'index:app'
+    hypercorn_config.bind = [getattr(config, 'BIND', '0.0.0.0:8000')]
+    hypercorn_config.workers = workers
+    hypercorn_config.graceful_timeout = getattr(config, 'GRACEFUL_TIMEOUT', 30)
+    hypercorn_config.accesslog = '-' if getattr(config, 'ACCESS_LOG', False) else None
+    run(hypercorn_config)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import secrets
+from itsdangerous import BadSignature, Signer
+from quart.sessions import SecureCookieSession, SessionInterface, session_json_serializer
+
+
+class ServerSession(SecureCookieSession):
+    """
+    A session whose data lives in Redis. Only its id travels in the cookie.
+    """
+
+    def __init__(self, initial=None, sid=None):
+        super().__init__(initial)
+        self.sid = sid or secrets.token_urlsafe(32)
+
+
+class RedisSessionInterface(SessionInterface):
+    """
+    Stores the data of every session under a random id in Redis, so any web worker can serve any request.
+
+    The cookie holds the session id signed with the app's `secret_key`; every worker must share that key.
+    A session is written back only when it was modified, and expires `ttl` seconds after its last write.
+    """
+
+    KEY_PREFIX = 'web_session_'
+    salt = 'server-session'
+    serializer = session_json_serializer
+
+    def __init__(self, redis, ttl=24 * 60 * 60):
+        """
+        Initializes the session interface.
+
+        Args:
+            redis (Redis): The Redis client.
+            ttl (float): Seconds a session is kept after its last write.
+        """
+        self.redis = redis
+        self.ttl = ttl
+
+    def key(self, sid):
+        return f"{self.KEY_PREFIX}{sid}"
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=self.salt)
+
+    async def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie is None:
+            return ServerSession()
+        try:
+            sid = self._signer(app).unsign(cookie).decode('utf-8')
+        except BadSignature:
+            return ServerSession()
+        data = await self.redis.get(self.key(sid))
+        if data is None:
+            return ServerSession()
+        return ServerSession(self.serializer.loads(data), sid=sid)
+
+    async def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            if session.modified:
+                await self.redis.delete(self.key(session.sid))
+                response.delete_cookie(name, domain=domain, path=path)
+                response.vary.add('Cookie')
+            return
+
+        if session.modified:
+            await self.redis.set(self.key(session.sid), self.serializer.dumps(dict(session)), ex=int(self.ttl))
+        if self.should_set_cookie(app, session):
+            response.set_cookie(
+                name,
+                self._signer(app).sign(session.sid).decode('utf-8'),
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
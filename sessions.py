@@ -0,0 +1,217 @@
+import time
+import uuid
+
+
+class PaymentSessions:
+    """
+    Stores the state of every payment session as a single Redis hash per payment id.
+
+    The hash holds the status, start time, deposit address, amount in base units, token, network, username,
+    Discord user id, email, deadline and HD address index of the payment, and a session id. A payment id on a
+    shared deposit address is handed out again once its session is over, while the session id is never reused.
+    Each read or write takes a single round-trip, and every hash expires `retention` seconds after its deadline,
+    so memory stays bounded.
+    """
+
+    KEY_PREFIX = 'payment_session_'
+    EMAIL_PREFIX = 'email_'
+
+    PENDING = 'pending'
+    CONFIRMED = 'confirmed'
+    EXPIRED = 'expired'
+
+    # KEYS: session hash, email key. ARGV: expire-at timestamp, then field/value pairs.
+    CREATE_SCRIPT = """
+    redis.call('DEL', KEYS[1])
+    redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+    local email = redis.call('GET', KEYS[2])
+    if email then
+        redis.call('HSET', KEYS[1], 'email', email)
+    end
+    redis.call('EXPIREAT', KEYS[1], ARGV[1])
+    return 1
+    """
+
+    # KEYS: session hash. ARGV: new status, timestamp. Only moves a pending session forward.
+    TRANSITION_SCRIPT = """
+    if redis.call('HGET', KEYS[1], 'status') ~= 'pending' then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], 'status', ARGV[1], ARGV[1] .. '_at', ARGV[2])
+    return 1
+    """
+
+    # KEYS: session hash. ARGV: new deadline, expire-at timestamp. Only pushes the deadline of a pending session back.
+    EXTEND_SCRIPT = """
+    if redis.call('HGET', KEYS[1], 'status') ~= 'pending' then
+        return 0
+    end
+    if tonumber(redis.call('HGET', KEYS[1], 'deadline')) >= tonumber(ARGV[1]) then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], 'deadline', ARGV[1])
+    redis.call('EXPIREAT', KEYS[1], ARGV[2])
+    return 1
+    """
+
+    def __init__(self, redis, retention=10 * 60, email_ttl=24 * 60 * 60):
+        """
+        Initializes the session store.
+
+        Args:
+            redis (Redis): The Redis client.
+            retention (float): Seconds a session is kept after its deadline.
+            email_ttl (float): Seconds an email address saved before checkout is kept.
+        """
+        self.redis = redis
+        self.retention = retention
+        self.email_ttl = email_ttl
+        self._create = redis.register_script(self.CREATE_SCRIPT)
+        self._transition = redis.register_script(self.TRANSITION_SCRIPT)
+        self._extend = redis.register_script(self.EXTEND_SCRIPT)
+
+    def key(self, payment_id):
+        return f"{self.KEY_PREFIX}{payment_id.lower()}"
+
+    async def create(self, payment_id, wallet_address, amount, token, network, username, deadline, user_id=None,
+                     address_index=None, from_block=None, baseline=None):
+        """
+        Creates a pending payment session with a new session id, copying the email saved for the username into
+        it.
+
+        Args:
+            payment_id (str): The id of the payment, see `amounts.payment_id`.
+            wallet_address (str): The deposit address of the payment.
+            amount (int): The expected amount of payment, in token base units.
+            token (str): The token symbol of the payment.
+            network (str): The network on which the payment is made.
+            username (str): The username associated with the payment.
+            deadline (float): Unix timestamp after which the payment is no longer accepted.
+            user_id (str): The Discord user id associated with the payment, if known.
+            address_index (int): The HD child index of the deposit address, if it comes from the address pool.
+            from_block (int): The first block that can hold the payment.
+            baseline (int): The balance of the deposit address before the payment in base units, if known.
+
+        Returns:
+            str: The session id.
+        """
+        session_id = uuid.uuid4().hex
+        fields = {
+            'session_id': session_id,
+            'status': self.PENDING,
+            'start_time': time.time(),
+            'wallet_address': wallet_address,
+            'amount': amount,
+            'token': token,
+            'network': network,
+            'username': username,
+            'deadline': deadline,
+        }
+        if user_id is not None:
+            fields['user_id'] = user_id
+        if address_index is not None:
+            fields['address_index'] = address_index
+        if from_block is not None:
+            fields['from_block'] = from_block
+        if baseline is not None:
+            fields['baseline'] = baseline
+        args = [int(deadline + self.retention)]
+        for field, value in fields.items():
+            args.extend((field, str(value)))
+        await self._create(keys=[self.key(payment_id), f"{self.EMAIL_PREFIX}{username}"], args=args)
+        return session_id
+
+    async def get(self, payment_id):
+        """
+        Returns every field of a payment session.
+
+        Args:
+            payment_id (str): The id of the payment, see `amounts.payment_id`.
+
+        Returns:
+            dict: The session fields, or None if the session does not exist.
+        """
+        fields = await self.redis.hgetall(self.key(payment_id))
+        if not fields:
+            return None
+        return {_decode(field): _decode(value) for field, value in fields.items()}
+
+    async def get_status(self, payment_id):
+        """
+        Returns the status and deadline of a payment session.
+
+        Args:
+            payment_id (str): The id of the payment, see `amounts.payment_id`.
+
+        Returns:
+            tuple: The status string and the deadline timestamp, or (None, None) if the session does not exist.
+        """
+        status, deadline = await self.redis.hmget(self.key(payment_id), 'status', 'deadline')
+        if status is None:
+            return None, None
+        return _decode(status), float(deadline)
+
+    async def confirm(self, payment_id):
+        """
+        Marks a pending payment session as confirmed.
+
+        Args:
+            payment_id (str): The id of the payment, see `amounts.payment_id`.
+
+        Returns:
+            bool: True if the session was pending and is now confirmed.
+        """
+        return bool(await self._transition(keys=[self.key(payment_id)], args=[self.CONFIRMED, time.time()]))
+
+    async def expire(self, payment_id):
+        """
+        Marks a pending payment session as expired.
+
+        Args:
+            payment_id (str): The id of the payment, see `amounts.payment_id`.
+
+        Returns:
+            bool: True if the session was pending and is now expired.
+        """
+        return bool(await self._transition(keys=[self.key(payment_id)], args=[self.EXPIRED, time.time()]))
+
+    async def extend(self, payment_id, deadline):
+        """
+        Pushes back the deadline of a pending payment session, e.g. while its deposit gathers confirmations.
+
+        Args:
+            payment_id (str): The id of the payment, see `amounts.payment_id`.
+            deadline (float): The new deadline as a Unix timestamp. Earlier deadlines are ignored.
+
+        Returns:
+            bool: True if the deadline was pushed back.
+        """
+        return bool(await self._extend(
+            keys=[self.key(payment_id)], args=[deadline, int(deadline + self.retention)]
+        ))
+
+    async def set_email(self, username, email):
+        """
+        Stores the email address of a discord username for `email_ttl` seconds.
+
+        Args:
+            username (str): The discord username associated with the email.
+            email (str): The email address to store.
+        """
+        await self.redis.set(f"{self.EMAIL_PREFIX}{username}", email, ex=self.email_ttl)
+
+    async def get_email(self, username):
+        """
+        Returns the email address last stored for a discord username.
+
+        Args:
+            username (str): The discord username associated with the email.
+
+        Returns:
+            str: The email address, or None if none is stored.
+        """
+        return _decode(await self.redis.get(f"{self.EMAIL_PREFIX}{username}"))
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
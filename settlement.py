@@ -0,0 +1,98 @@
+import config
+from logger import logging as logger
+
+
+# Blocks a crediting transfer must be buried under before a payment is confirmed. 1 confirms on inclusion.
+CONFIRMATIONS = {
+    'polygon': 32,
+    'arbitrum': 1,
+    'sepolia': 3,
+}
+
+
+def confirmations(network):
+    """
+    Returns the confirmation depth of a network from `CONFIRMATIONS`, overridable in `config.py`.
+
+    Args:
+        network (str): The network name.
+
+    Returns:
+        int: The number of confirmations a payment needs, at least 1.
+    """
+    return max({**CONFIRMATIONS, **getattr(config, 'CONFIRMATIONS', {})}.get(network, 1), 1)
+
+
+class BlockWindow:
+    """
+    The hashes of the most recent blocks of one network, extended one block at a time.
+
+    Every new block must build on the block before it. When it does not, the chain has been reorganized:
+    the window walks back to the last block it still shares with the node and drops everything above it.
+    Only `size` blocks are kept, so a reorg deeper than that cannot be traced back exactly.
+    """
+
+    def __init__(self, w3, size=128):
+        self.w3 = w3
+        self.size = size
+        self.hashes = {}
+
+    @property
+    def top(self):
+        return next(reversed(self.hashes), None)
+
+    def get(self, number):
+        return self.hashes.get(number)
+
+    def clear(self):
+        self.hashes = {}
+
+    async def extend(self, head, start=None):
+        """
+        Appends the blocks up to `head`, rolling back first if they no longer build on the window.
+
+        Args:
+            head (int): The current head block number.
+            start (int): The first block to read when the window is empty. Defaults to `head`.
+
+        Returns:
+            int: The last block still on the canonical chain if a reorg was found, otherwise None.
+        """
+        fork = None
+        number = self.top + 1 if self.hashes else (head if start is None else start)
+        while number <= head:
+            block = await self.w3.eth.get_block(number)
+            parent = self.hashes.get(number - 1)
+            if parent is not None and block['parentHash'] != parent:
+                ancestor = await self.find_ancestor(number - 1)
+                fork = ancestor if fork is None else min(fork, ancestor)
+                number = ancestor + 1
+                continue
+            self.hashes[number] = block['hash']
+            number += 1
+        while len(self.hashes) > self.size:
+            del self.hashes[next(iter(self.hashes))]
+        return fork
+
+    async def find_ancestor(self, number):
+        """
+        Walks back from `number` to the newest block whose hash still matches the node and drops the
+        blocks above it.
+
+        Args:
+            number (int): The block to start from.
+
+        Returns:
+            int: The number of the common ancestor.
+        """
+        while number in self.hashes:
+            block = await self.w3.eth.get_block(number)
+            if block['hash'] == self.hashes[number]:
+                break
+            del self.hashes[number]
+            number -= 1
+        else:
+            logger.warning(f"Reorg deeper than the block window, rolling back to block {number}")
+        for stale in [n for n in self.hashes if n > number]:
+            del self.hashes[stale]
+        return number
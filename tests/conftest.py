@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import pytest
+
+from benchmarks.checkout import install_config
+from benchmarks.mock_node import MockNode
+
+
+@pytest.fixture(scope='session')
+def node_loop():
+    """
+    A background event loop the mock nodes are served from, so tests can run their own loops.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+def _run_in(loop, coro):
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+@pytest.fixture(scope='session')
+def node(node_loop):
+    """
+    A mock JSON-RPC node serving every network, with a `config` module pointing at it installed. Its blocks
+    are a minute apart, so tests mine the blocks they need with `node.mine()`. The modules that read `config`
+    on import must be imported inside the tests.
+    """
+    node = MockNode(block_time=60)
+    _run_in(node_loop, node.start())
+    node.mine(10)
+    install_config(node.urls, confirmations=3)
+    yield node
+    _run_in(node_loop, node.close())
+
+
+@pytest.fixture
+def endpoints(node_loop, node):
+    """
+    Returns a function that serves a separate mock chain from one endpoint per keyword dict given, with the
+    latency, error rate and JSON-RPC error of `MockNode.add_endpoint`, and returns their URLs. The chains are
+    closed after the test.
+    """
+    nodes = []
+
+    def serve(*options):
+        chain = MockNode(block_time=60)
+        nodes.append(chain)
+
+        async def start():
+            await chain.start()
+            # The default endpoint is left unused, so every endpoint of the test has its own options
+            return [await chain.add_endpoint(**endpoint) for endpoint in options]
+
+        return _run_in(node_loop, start())
+
+    yield serve
+    for chain in nodes:
+        _run_in(node_loop, chain.close())
+
+
+@pytest.fixture
+def payments(node):
+    """
+    Returns a function that runs a coroutine function with a connected Payments instance.
+    """
+    def run(func):
+        async def main():
+            from payments import Payments
+
+            payments = Payments()
+            await payments.connect()
+            await payments.warm_up()
+            try:
+                return await func(payments)
+            finally:
+                await payments.close()
+
+        return asyncio.run(main())
+
+    return run
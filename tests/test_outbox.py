@@ -0,0 +1,26 @@
+import asyncio
+
+import fakeredis.aioredis
+
+
+def test_reused_payment_id_publishes_a_new_event_per_session(node):
+    # `node` installs the config module the outbox reads on import
+    from outbox import ConfirmationOutbox
+    from sessions import PaymentSessions
+
+    async def run():
+        redis = fakeredis.aioredis.FakeRedis()
+        sessions = PaymentSessions(redis)
+        outbox = ConfirmationOutbox(redis)
+        payment_id = 'shared_address:polygon:usdt:1000042'
+        published = []
+        for username in ('first', 'second'):
+            session_id = await sessions.create(payment_id, '0x' + '11' * 20, 1000042, 'USDT', 'polygon', username, 0)
+            published.append(await outbox.publish(session_id, payment_id, {'username': username}))
+            published.append(await outbox.publish(session_id, payment_id, {'username': username}))
+        return published, await redis.xlen(ConfirmationOutbox.STREAM)
+
+    published, events = asyncio.run(run())
+
+    assert published == [True, False, True, False]
+    assert events == 2
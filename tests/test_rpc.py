@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+REVERTED = {'code': 3, 'message': 'execution reverted'}
+HEADER_NOT_FOUND = {'code': -32000, 'message': 'header not found'}
+
+
+def _request(urls, method='eth_blockNumber', requests=1, **options):
+    # Sends `requests` requests through a router over `urls` and returns the last response or error, its latency
+    # and the router
+    async def run():
+        from rpc import RouterProvider
+
+        router = RouterProvider('polygon', urls, **options)
+        for _ in range(requests):
+            started = time.monotonic()
+            try:
+                response = await router.make_request(method, [])
+            except Exception as e:
+                response = e
+        latency = time.monotonic() - started
+        # Let requests still in flight finish
+        await asyncio.sleep(0.3)
+        for endpoint in router.endpoints:
+            await endpoint.provider.disconnect()
+        return response, latency, router
+
+    return asyncio.run(run())
+
+
+def test_failed_request_fails_over_to_the_next_endpoint(endpoints):
+    urls = endpoints({'error_rate': 1}, {})
+
+    response, _, router = _request(urls)
+
+    failing, healthy = router.endpoints
+    assert 'result' in response
+    assert list(failing.outcomes) == [False]
+    assert list(healthy.outcomes) == [True]
+
+
+def test_error_response_of_a_lagging_node_fails_over_to_the_next_endpoint(endpoints):
+    urls = endpoints({'rpc_error': HEADER_NOT_FOUND}, {})
+
+    response, _, router = _request(urls)
+
+    lagging, healthy = router.endpoints
+    assert 'result' in response
+    assert list(lagging.outcomes) == [False]
+    assert list(healthy.outcomes) == [True]
+
+
+def test_error_response_of_every_endpoint_is_returned(endpoints):
+    urls = endpoints({'rpc_error': HEADER_NOT_FOUND}, {'rpc_error': HEADER_NOT_FOUND})
+
+    response, _, router = _request(urls)
+
+    assert response['error'] == HEADER_NOT_FOUND
+    assert [list(endpoint.outcomes) for endpoint in router.endpoints] == [[False], [False]]
+
+
+def test_reverted_call_is_returned_without_failover(endpoints):
+    urls = endpoints({'rpc_error': REVERTED}, {})
+
+    response, _, router = _request(urls, method='eth_call')
+
+    reverting, other = router.endpoints
+    assert response['error'] == REVERTED
+    assert list(reverting.outcomes) == [True]
+    assert not other.outcomes
+
+
+def test_slow_request_is_hedged_to_the_next_endpoint(endpoints):
+    urls = endpoints({'latency': 0.2}, {})
+
+    response, latency, router = _request(urls, hedge_delay=0.05)
+
+    slow, fast = router.endpoints
+    assert 'result' in response
+    assert latency < 0.15
+    assert list(fast.outcomes) == [True]
+    # The slower request is not cancelled and is still measured once it completes
+    assert list(slow.outcomes) == [True]
+    assert len(slow.latencies) == 1
+
+
+def test_circuit_opens_after_consecutive_failures(endpoints):
+    urls = endpoints({'error_rate': 1})
+
+    _, _, router = _request(urls, requests=2, failure_threshold=3)
+    assert router.endpoints[0].available
+
+    _, _, router = _request(urls, requests=3, failure_threshold=3)
+    assert not router.endpoints[0].available
+
+
+def test_failed_over_and_hedged_requests_are_charged_to_the_budget(endpoints):
+    from scheduler import TokenBucket
+
+    urls = endpoints({'error_rate': 1}, {'latency': 0.2}, {})
+    budget = TokenBucket(rate=0.001, burst=10)
+
+    response, _, _ = _request(urls, budget=budget, hedge_delay=0.05)
+
+    assert 'result' in response
+    assert round(budget.tokens) == 7
@@ -0,0 +1,79 @@
+import asyncio
+
+
+def _calls_since(node, before):
+    return {method: count - before.get(method, 0) for method, count in node.calls.items() if count != before.get(method, 0)}
+
+
+def _poll_calls(node, payments, addresses, blocks=3):
+    # RPC calls by method of the first poll after `addresses` deposits are watched, then of one poll per new block
+    async def run(payments):
+        from watcher import DepositWatcher
+
+        async def on_confirmed(deposit):
+            pass
+
+        watcher = DepositWatcher('polygon', payments, on_confirmed)
+        for index in range(addresses):
+            watcher.watch(f"0x{index + 1:040x}", 10 ** 6, 'USDT', 'buyer')
+        polls = []
+        for _ in range(blocks + 1):
+            before = dict(node.calls)
+            await watcher.poll()
+            polls.append(_calls_since(node, before))
+            node.mine()
+        return polls
+
+    return payments(run)
+
+
+def test_rpc_calls_per_poll_do_not_grow_with_watched_addresses(node, payments):
+    one = _poll_calls(node, payments, 1)
+    many = _poll_calls(node, payments, 200)
+
+    assert one == many
+    assert all(one)
+
+
+def _settle_deposit(node, payments, address, reorg):
+    # Pays `address` in the next block, optionally reorgs that block out, then polls until the confirmation depth
+    async def run(payments):
+        from payments import Data
+        from watcher import DepositWatcher
+
+        confirmed = []
+
+        async def on_confirmed(deposit):
+            confirmed.append(deposit)
+
+        watcher = DepositWatcher('polygon', payments, on_confirmed)
+        watcher.watch(address, 10 ** 6, 'USDT', 'buyer')
+        deposit = next(iter(watcher.pending.values()))
+        await watcher.poll()
+        node.schedule_deposit(Data.CONTRACT_ADDRESSES['polygon']['USDT'], address, 10 ** 6, after_blocks=1)
+        node.mine()
+        await watcher.poll()
+        assert deposit.paid_block == node.head
+        if reorg:
+            node.reorg(1)
+        for _ in range(watcher.confirmations):
+            node.mine()
+            await watcher.poll()
+        await asyncio.sleep(0)
+        return confirmed, deposit
+
+    return payments(run)
+
+
+def test_deposit_is_confirmed_at_the_confirmation_depth(node, payments):
+    confirmed, deposit = _settle_deposit(node, payments, f"0x{0xc0ffee:040x}", reorg=False)
+
+    assert confirmed == [deposit]
+
+
+def test_deposit_reorged_out_before_the_confirmation_depth_is_not_confirmed(node, payments):
+    confirmed, deposit = _settle_deposit(node, payments, f"0x{0xdecaf:040x}", reorg=True)
+
+    assert confirmed == []
+    assert deposit.paid_block is None
+    assert deposit.received == 0
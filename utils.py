@@ -1,64 +1,112 @@
+import asyncio
+import time
 import aiohttp
+from logger import logging as logger
+from metrics import PRICE_FETCH_LATENCY, timed
 
 
-class Helper:
-    @staticmethod
-    async def getEthPrice():
-        url = 'https://api.coingecko.com/api/v3/simple/price?ids=ethereum&vs_currencies=usd'
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if 'ethereum' in data and 'usd' in data['ethereum']:
-                        eth_to_usd = data['ethereum']['usd']
-                        return float(eth_to_usd)
-                return None
-
-    @staticmethod
-    async def convertUsdToEth(amount_in_usd):
-        eth_price = await Helper.getEthPrice()
-        if eth_price is not None:
-            eth_amount = amount_in_usd / eth_price
-            return eth_amount
-        else:
+class PriceOracle:
+    """
+    ETH/USD price source in front of CoinGecko.
+
+    `start` fetches the first price and then refreshes it in the background every `ttl` seconds, so readers take
+    `price` without waiting on the network. A single HTTP session is reused for every fetch and concurrent fetches
+    share one request. A failed fetch keeps the last price, which `stale` reports once it is older than
+    `max_staleness` seconds; the plan catalog withdraws ETH prices until a fetch succeeds again. Listeners added
+    with `add_listener` are called with every newly fetched price.
+    """
+
+    URL = 'https://api.coingecko.com/api/v3/simple/price?ids=ethereum&vs_currencies=usd'
+
+    def __init__(self, ttl=30, max_staleness=10 * 60):
+        self.ttl = ttl
+        self.max_staleness = max_staleness
+        self.price = None
+        self.updated_at = None
+        self._session = None
+        self._inflight = None
+        self._refresh_task = None
+        self._listeners = []
+
+    async def start(self):
+        """
+        Fetches the first price and keeps refreshing it in the background every `ttl` seconds.
+        """
+        await self.refresh()
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def add_listener(self, listener):
+        """
+        Registers a function to call with the price each time a fetch succeeds.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """
+        Unregisters a function added with `add_listener`, if it is registered.
+        """
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    @property
+    def stale(self):
+        age = self._age()
+        return age is None or age >= self.max_staleness
+
+    async def refresh(self):
+        await asyncio.shield(self._fetch_once())
+
+    def _age(self):
+        if self.updated_at is None:
             return None
+        return time.monotonic() - self.updated_at
+
+    def _fetch_once(self):
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._fetch())
+            self._inflight.add_done_callback(self._clear_inflight)
+        return self._inflight
+
+    def _clear_inflight(self, _):
+        self._inflight = None
+
+    async def _fetch(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        with timed(PRICE_FETCH_LATENCY) as stage:
+            try:
+                async with self._session.get(self.URL) as response:
+                    if response.status == 200:
+                        data = await response.json()
+                        if 'ethereum' in data and 'usd' in data['ethereum']:
+                            self.price = float(data['ethereum']['usd'])
+                            self.updated_at = time.monotonic()
+                            for listener in self._listeners:
+                                listener(self.price)
+                            return
+                    stage.outcome = 'error'
+                    logger.info(f"Failed to fetch the ETH price: HTTP {response.status}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                stage.outcome = 'error'
+                logger.info(f"Failed to fetch the ETH price: {e}")
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            # Anything a fetch raises, such as malformed JSON or a failing listener, must not stop the refreshes
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.bind(rate_limit='price_refresh').exception(f"Failed to refresh the ETH price: {e}")
+
 
-    @staticmethod
-    async def getPlanPrice(plan_name, token):
-        if plan_name == "basic_1_month":
-            if token == "eth":
-                price = await Helper.convertUsdToEth(9)
-                return price
-            else:
-                return 9
-        elif plan_name == "basic_6_months":
-            if token == "eth":
-                price = await Helper.convertUsdToEth(18)
-                return price
-            else:
-                return 18
-        elif plan_name == "basic_lifetime":
-            if token == "eth":
-                price = await Helper.convertUsdToEth(49)
-                return price
-            else:
-                return 49
-        elif plan_name == "vip_1_month":
-            if token == "eth":
-                price = await Helper.convertUsdToEth(14)
-                return price
-            else:
-                return 14
-        elif plan_name == "vip_6_months":
-            if token == "eth":
-                price = await Helper.convertUsdToEth(36)
-                return price
-            else:
-                return 36
-        elif plan_name == "vip_lifetime":
-            if token == "eth":
-                price = await Helper.convertUsdToEth(79)
-                return price
-            else:
-                return 79
\ No newline at end of file
+price_oracle = PriceOracle()
@@ -0,0 +1,548 @@
+import asyncio
+from dataclasses import dataclass, field
+from web3 import Web3
+from amounts import from_units, is_paid, payment_id
+from logger import logging as logger
+from metrics import ACTIVE_SESSIONS
+from scheduler import poll_interval as network_poll_interval
+from settlement import BlockWindow, confirmations
+
+
+TRANSFER_TOPIC = Web3.to_hex(Web3.keccak(text="Transfer(address,address,uint256)"))
+
+
+@dataclass
+class PendingDeposit:
+    """
+    A deposit address that is waiting for funds.
+
+    Attributes:
+        address (str): The checksummed deposit address.
+        expected_amount (int): The expected amount of payment, in token base units.
+        token (str): The upper-cased token symbol of the payment.
+        network (str): The network on which the payment is made.
+        username (str): The username associated with the payment.
+        deadline (float): Event loop time after which the deposit is dropped.
+        received (int): Amount received so far, in token base units.
+        credits (dict): The (block number, amount) of every crediting transfer, keyed by transaction hash
+            and log index, so rescanned blocks are not counted twice.
+        paid_block (int): The block in which the expected amount was reached, None while it has not been.
+        baseline (int): Balance of the address in base units before the payment, None until it has been read.
+            Balance sweeps only count funds above it, so reused addresses are not confirmed by old deposits.
+        next_check (float): Event loop time of the next balance sweep of the address.
+        checks (int): Number of balance sweeps that found the address unpaid.
+        from_block (int): The first block scanned for the deposit, None until the watcher has polled once
+            unless it was recorded at checkout.
+        shared (bool): Whether the address is shared, so only a transfer of exactly the expected amount pays.
+    """
+    address: str
+    expected_amount: int
+    token: str
+    network: str
+    username: str
+    deadline: float
+    received: int = 0
+    credits: dict = field(default_factory=dict)
+    paid_block: int = None
+    baseline: int = None
+    next_check: float = 0
+    checks: int = 0
+    from_block: int = None
+    shared: bool = False
+
+    @property
+    def payment_id(self):
+        if self.shared:
+            return payment_id(self.address, self.network, self.token, self.expected_amount)
+        return payment_id(self.address)
+
+
+class DepositWatcher:
+    """
+    Follows new blocks on a single network and matches incoming transfers against pending deposit addresses.
+
+    A single watcher serves every open payment session on its network, so the number of RPC calls
+    grows with the number of blocks instead of the number of sessions. Blocks are polled at the network's
+    block time, backing off while nothing is pending. A balance sweep batches due addresses into a few
+    Multicall3 calls as a safety net for transfers missed between polls: quiet addresses are swept less
+    and less often, and addresses close to their deadline are swept often and first.
+
+    A payment is only confirmed once the block that completed it has the network's confirmation depth.
+    Until then, the hash of every new block is checked against its parent in a window of recent blocks;
+    on a reorg, credits from dropped blocks are reverted and the blocks after the fork are scanned again.
+    Balance sweeps read balances at the newest block that already has the confirmation depth.
+
+    Pending deposits are keyed by payment id: a transfer is matched by its recipient, or on a shared
+    address by its recipient and exact amount, with a single dictionary lookup. Shared addresses hold the
+    funds of many payments, so they are never balance-swept.
+
+    A deposit carries the first block that can hold its payment and its baseline from checkout, or from the
+    worker that handed it over. If this watcher has already scanned past that block, the blocks the deposit
+    missed are scanned for its token transfers and its balance is swept right away.
+
+    Attributes:
+        network (str): The network the watcher is following.
+        payments (Payments): The Payments instance holding the network connections.
+        w3 (AsyncWeb3): The AsyncWeb3 instance connected to the network.
+        on_confirmed (callable): Coroutine function called with a PendingDeposit once it is paid.
+        on_expired (callable): Coroutine function called with a PendingDeposit whose window has passed.
+        on_paid (callable): Coroutine function called with a PendingDeposit once the expected amount is
+            seen, before it has the confirmation depth.
+        confirmations (int): The confirmation depth of the network.
+        blocks (BlockWindow): The recent block hashes of the network.
+        pending (dict): Pending deposits keyed by payment id.
+    """
+
+    MAX_BLOCK_RANGE = 100
+
+    def __init__(self, network, payments, on_confirmed, on_expired=None, on_paid=None, poll_interval=None,
+                 idle_interval=30, sweep_interval=60, max_sweep_interval=5 * 60, urgent_window=2 * 60):
+        """
+        Initializes the watcher for a network.
+
+        Args:
+            network (str): The network to follow.
+            payments (Payments): The Payments instance holding the network connections.
+            on_confirmed (callable): Coroutine function called with a PendingDeposit once it is paid.
+            on_expired (callable): Optional coroutine function called with a PendingDeposit whose window has passed.
+            on_paid (callable): Optional coroutine function called with a PendingDeposit once the expected
+                amount is seen, while it waits for the confirmation depth.
+            poll_interval (float): Seconds to wait between polls for a new block. Defaults to the block time
+                of the network.
+            idle_interval (float): The longest wait between polls while no deposit is pending.
+            sweep_interval (float): Seconds until the first balance sweep of an address.
+            max_sweep_interval (float): The longest wait between balance sweeps of a quiet address.
+            urgent_window (float): Seconds before its deadline from which an address is swept every
+                `sweep_interval / 4` seconds.
+        """
+        self.network = network
+        self.payments = payments
+        self.w3 = payments.networks[network]
+        self.on_confirmed = on_confirmed
+        self.on_expired = on_expired
+        self.on_paid = on_paid
+        self.confirmations = confirmations(network)
+        self.blocks = BlockWindow(self.w3, size=max(128, 2 * self.confirmations))
+        self.poll_interval = poll_interval or network_poll_interval(network)
+        self.idle_interval = idle_interval
+        self.sweep_interval = sweep_interval
+        self.max_sweep_interval = max_sweep_interval
+        self.urgent_window = urgent_window
+        self.pending = {}
+        self.backfills = []
+        self.last_block = None
+        self.contracts = {
+            info.address.lower(): info.symbol
+            for info in payments.tokens.tokens(network)
+            if not info.native
+        }
+        self.native_token = next(
+            (info.symbol for info in payments.tokens.tokens(network) if info.native), None
+        )
+        self._task = None
+        self._wakeup = asyncio.Event()
+        ACTIVE_SESSIONS.labels(network=network).set_function(lambda: len(self.pending))
+
+    def supports(self, token):
+        """
+        Checks whether payments in a token can be watched on this network.
+
+        Args:
+            token (str): The token symbol.
+
+        Returns:
+            bool: True if the token is the native coin or a known contract on this network.
+        """
+        return self.payments.tokens.supports(self.network, token)
+
+    def watch(self, address, expected_amount, token, username, timeout=10 * 60, from_block=None, baseline=None,
+              shared=False):
+        """
+        Starts watching an address for an incoming payment.
+
+        Args:
+            address (str): The deposit address.
+            expected_amount (int): The expected amount of payment, in token base units.
+            token (str): The token symbol of the payment.
+            username (str): The username associated with the payment.
+            timeout (float): Seconds after which the deposit is dropped.
+            from_block (int): The first block to scan for the deposit, if it was recorded at checkout or the
+                deposit was handed over by another worker.
+            baseline (int): The balance of the address before the payment, if it is known.
+            shared (bool): Whether the address is shared with other payments.
+        """
+        now = asyncio.get_event_loop().time()
+        missed_blocks = from_block is not None and (self.last_block is None or from_block <= self.last_block)
+        deposit = PendingDeposit(
+            address=Web3.to_checksum_address(address),
+            expected_amount=expected_amount,
+            token=token.upper(),
+            network=self.network,
+            username=username,
+            deadline=now + timeout,
+            baseline=baseline,
+            next_check=now if missed_blocks else now + self.sweep_interval,
+            from_block=from_block,
+            shared=shared,
+        )
+        if not self.pending:
+            self._wakeup.set()
+        self.pending[deposit.payment_id] = deposit
+        if from_block is not None:
+            self.backfills.append(deposit)
+        amount = from_units(expected_amount, self.payments.tokens.get(self.network, deposit.token).decimals)
+        logger.bind(wallet=deposit.address, network=self.network).info(f"Watching {deposit.address} for {amount} {deposit.token} on {self.network}")
+
+    def unwatch(self, payment_id):
+        """
+        Stops watching a payment.
+
+        Args:
+            payment_id (str): The id of the payment.
+        """
+        self.pending.pop(payment_id, None)
+
+    async def start(self):
+        """
+        Starts following new blocks in the background.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        Stops following new blocks.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        """
+        Polls for new blocks and scans each new block range once for all pending deposits.
+        """
+        logger.info(f"The deposit watcher for {self.network} has started.")
+        idle_polls = 0
+        while True:
+            # A deposit watched from here on wakes an idle watcher up early
+            self._wakeup.clear()
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.bind(network=self.network, rate_limit=f"watcher_{self.network}").exception(
+                    f"Deposit watcher for {self.network} failed: {e}"
+                )
+            if self.pending:
+                idle_polls = 0
+                delay = self.poll_interval
+            else:
+                delay = min(self.poll_interval * 2 ** idle_polls, self.idle_interval)
+                idle_polls += 1
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    @property
+    def settle_timeout(self):
+        """
+        Seconds a paid deposit is expected to need to reach the confirmation depth, with room to spare.
+        """
+        return self.confirmations * self.poll_interval * 2 + 60
+
+    async def poll(self):
+        """
+        Follows the chain to the new head, scans the blocks mined since the last poll, settles deposits that
+        have the confirmation depth and expires stale ones.
+        """
+        self.expire()
+        new_deposits = [deposit for deposit in self.pending.values() if deposit.baseline is None and not deposit.shared]
+        if new_deposits:
+            await self.record_baselines(new_deposits)
+        head = await self.w3.eth.block_number
+        if self.last_block is None:
+            self.last_block = head - 1
+        for deposit in self.pending.values():
+            if deposit.from_block is None:
+                deposit.from_block = self.last_block + 1
+        if self.pending and self.confirmations > 1:
+            fork = await self.blocks.extend(head, start=self.last_block)
+            if fork is not None:
+                self.revert(fork)
+        for deposit in list(self.backfills):
+            if deposit.payment_id in self.pending and deposit.from_block <= self.last_block:
+                await self.backfill(deposit)
+            self.backfills.remove(deposit)
+        while self.pending and self.last_block < head:
+            from_block = self.last_block + 1
+            to_block = min(head, from_block + self.MAX_BLOCK_RANGE - 1)
+            await self.scan(from_block, to_block)
+            self.last_block = to_block
+        if not self.pending:
+            self.last_block = head
+            self.blocks.clear()
+        else:
+            self.settle(head)
+            await self.sweep(head)
+
+    def expire(self):
+        """
+        Drops unpaid deposits whose payment window has passed.
+        """
+        now = asyncio.get_event_loop().time()
+        for key, deposit in list(self.pending.items()):
+            # A deposit paid in time is kept until it settles or is reverted
+            if now >= deposit.deadline and deposit.paid_block is None:
+                logger.bind(wallet=deposit.address, network=self.network).info(
+                    f"Payment window for {deposit.address} on {self.network} has expired"
+                )
+                del self.pending[key]
+                if self.on_expired is not None:
+                    asyncio.create_task(self.on_expired(deposit))
+
+    async def scan(self, from_block, to_block):
+        """
+        Scans a block range for token transfers and native transfers to pending addresses.
+
+        Args:
+            from_block (int): The first block of the range.
+            to_block (int): The last block of the range, inclusive.
+        """
+        tokens = {deposit.token for deposit in self.pending.values()}
+        if self.contracts and tokens - {self.native_token}:
+            await self.scan_token_transfers(from_block, to_block)
+        if self.native_token in tokens:
+            for number in range(from_block, to_block + 1):
+                await self.scan_native_transfers(number)
+
+    async def backfill(self, deposit):
+        """
+        Scans the blocks a handed-over deposit was watched in before this watcher's last scanned block for
+        transfers to its address. Native transfers are left to the balance sweep, which counts from the
+        baseline carried over with the deposit.
+
+        Args:
+            deposit (PendingDeposit): The handed-over deposit.
+        """
+        if deposit.token == self.native_token:
+            return
+        for from_block in range(deposit.from_block, self.last_block + 1, self.MAX_BLOCK_RANGE):
+            to_block = min(self.last_block, from_block + self.MAX_BLOCK_RANGE - 1)
+            await self.scan_token_transfers(from_block, to_block, recipient=deposit.address)
+
+    async def scan_token_transfers(self, from_block, to_block, recipient=None):
+        """
+        Matches ERC-20 Transfer logs in a block range against pending addresses.
+
+        Args:
+            from_block (int): The first block of the range.
+            to_block (int): The last block of the range, inclusive.
+            recipient (str): Only fetch transfers to this address.
+        """
+        topics = [TRANSFER_TOPIC]
+        if recipient is not None:
+            topics += [None, '0x' + '00' * 12 + recipient[2:].lower()]
+        logs = await self.w3.eth.get_logs({
+            'fromBlock': from_block,
+            'toBlock': to_block,
+            'address': [Web3.to_checksum_address(address) for address in self.contracts],
+            'topics': topics,
+        })
+        for log in logs:
+            if len(log['topics']) < 3:
+                continue
+            recipient = '0x' + bytes(log['topics'][2])[-20:].hex()
+            amount = int.from_bytes(bytes(log['data']), 'big')
+            deposit = self.match(recipient, self.contracts.get(log['address'].lower()), amount)
+            if deposit is None:
+                continue
+            if not self.on_canonical_chain(log['blockNumber'], log['blockHash']):
+                continue
+            key = (Web3.to_hex(log['transactionHash']), log['logIndex'])
+            self.credit(deposit, amount, log['blockNumber'], key)
+
+    async def scan_native_transfers(self, number):
+        """
+        Matches native-value transactions in a block against pending addresses.
+
+        Args:
+            number (int): The block number.
+        """
+        block = await self.w3.eth.get_block(number, full_transactions=True)
+        if not self.on_canonical_chain(number, block['hash']):
+            return
+        for tx in block['transactions']:
+            if not tx['to'] or not tx['value']:
+                continue
+            deposit = self.match(tx['to'], self.native_token, tx['value'])
+            if deposit is None:
+                continue
+            self.credit(deposit, tx['value'], number, (Web3.to_hex(tx['hash']), None))
+
+    def match(self, recipient, token, amount):
+        """
+        Finds the pending deposit a transfer pays into: the deposit of its recipient, or the deposit issued
+        exactly this amount on a shared recipient address.
+
+        Args:
+            recipient (str): The recipient address.
+            token (str): The token symbol of the transfer.
+            amount (int): The transferred amount in base units.
+
+        Returns:
+            PendingDeposit: The matching deposit, or None.
+        """
+        deposit = self.pending.get(payment_id(recipient))
+        if deposit is None and token is not None:
+            deposit = self.pending.get(payment_id(recipient, self.network, token, amount))
+        if deposit is None or deposit.token != token:
+            return None
+        return deposit
+
+    def on_canonical_chain(self, number, block_hash):
+        """
+        Checks a block against the block window. Blocks the window has not seen yet are assumed canonical;
+        a fork the window has not caught up with is caught on the next poll.
+
+        Args:
+            number (int): The block number.
+            block_hash (bytes): The block hash.
+
+        Returns:
+            bool: False if the window holds a different hash for the block.
+        """
+        known = self.blocks.get(number)
+        return known is None or known == block_hash
+
+    async def sweep(self, head):
+        """
+        Checks the balances of the pending addresses that are due in one batch, closest deadline first,
+        and confirms the ones already paid as of the newest block with the confirmation depth.
+
+        Args:
+            head (int): The current head block number.
+        """
+        now = asyncio.get_event_loop().time()
+        due = sorted(
+            (deposit for deposit in self.pending.values()
+             if deposit.baseline is not None and now >= deposit.next_check),
+            key=lambda deposit: deposit.deadline,
+        )
+        if not due:
+            return
+        for deposit in due:
+            deposit.checks += 1
+            deposit.next_check = now + self.sweep_delay(deposit, now)
+        queries = {(deposit.address, deposit.token, self.network): deposit for deposit in due}
+        balances = await self.payments.get_token_balances(
+            queries, block_identifier=head - self.confirmations + 1, raw=True
+        )
+        for query, balance in balances.items():
+            deposit = queries[query]
+            if is_paid(balance - deposit.baseline, deposit.expected_amount) and deposit.payment_id in self.pending:
+                self.confirm(deposit)
+
+    def sweep_delay(self, deposit, now):
+        """
+        Returns the seconds until the next balance sweep of a deposit that was just found unpaid.
+
+        The delay doubles with every sweep up to `max_sweep_interval`, but never runs past the start of
+        the deposit's `urgent_window`, within which it drops to a quarter of `sweep_interval`.
+
+        Args:
+            deposit (PendingDeposit): The deposit.
+            now (float): The current event loop time.
+
+        Returns:
+            float: The delay in seconds.
+        """
+        until_urgent = deposit.deadline - self.urgent_window - now
+        if until_urgent <= 0:
+            return self.sweep_interval / 4
+        return min(self.sweep_interval * 2 ** deposit.checks, self.max_sweep_interval, until_urgent)
+
+    async def record_baselines(self, deposits):
+        """
+        Reads the current balances of newly watched addresses in one batch.
+
+        Args:
+            deposits (list): The PendingDeposit objects without a baseline.
+        """
+        queries = {(deposit.address, deposit.token, self.network): deposit for deposit in deposits}
+        balances = await self.payments.get_token_balances(queries, raw=True)
+        for query, balance in balances.items():
+            queries[query].baseline = balance
+
+    def credit(self, deposit, amount, block_number, key):
+        """
+        Adds an incoming transfer to a deposit and marks it paid once the expected amount is reached.
+        Without a confirmation depth, the deposit is confirmed right away.
+
+        Args:
+            deposit (PendingDeposit): The deposit receiving the transfer.
+            amount (int): The transferred amount in token base units.
+            block_number (int): The block of the transfer.
+            key (tuple): The transaction hash and log index of the transfer.
+        """
+        if key in deposit.credits:
+            return
+        deposit.credits[key] = (block_number, amount)
+        deposit.received += amount
+        if deposit.paid_block is None and is_paid(deposit.received, deposit.expected_amount):
+            deposit.paid_block = block_number
+            if self.confirmations <= 1:
+                self.confirm(deposit)
+                return
+            logger.bind(wallet=deposit.address, network=self.network).info(
+                f"Payment to {deposit.address} on {self.network} seen in block {block_number}, "
+                f"waiting for {self.confirmations} confirmations"
+            )
+            if self.on_paid is not None:
+                asyncio.create_task(self.on_paid(deposit))
+
+    def settle(self, head):
+        """
+        Confirms the paid deposits whose completing block has the confirmation depth.
+
+        Args:
+            head (int): The current head block number.
+        """
+        for deposit in list(self.pending.values()):
+            if deposit.paid_block is not None and head - deposit.paid_block + 1 >= self.confirmations:
+                self.confirm(deposit)
+
+    def revert(self, fork):
+        """
+        Undoes the credits from blocks a reorg has dropped and rescans the chain from the fork.
+
+        Args:
+            fork (int): The last block still on the canonical chain.
+        """
+        logger.warning(f"Chain reorganization on {self.network}, rolling back to block {fork}")
+        self.last_block = min(self.last_block, fork)
+        for deposit in self.pending.values():
+            dropped = [key for key, (number, _) in deposit.credits.items() if number > fork]
+            for key in dropped:
+                deposit.received -= deposit.credits.pop(key)[1]
+            if deposit.paid_block is not None and deposit.paid_block > fork:
+                deposit.paid_block = None
+                logger.bind(wallet=deposit.address, network=self.network).warning(
+                    f"Payment to {deposit.address} on {self.network} was reverted by a reorg"
+                )
+
+    def confirm(self, deposit):
+        """
+        Stops watching a paid deposit and hands it to the confirmation callback.
+
+        Args:
+            deposit (PendingDeposit): The paid deposit.
+        """
+        self.unwatch(deposit.payment_id)
+        logger.bind(wallet=deposit.address, network=self.network).info(f"Payment to {deposit.address} on {self.network} confirmed")
+        asyncio.create_task(self.on_confirmed(deposit))
@@ -0,0 +1,345 @@
+import asyncio
+import signal
+import time
+import aioredis
+import config
+
+from jobs import PaymentQueue
+from admission import CheckoutAdmission, user_key
+from outbox import ConfirmationOutbox, Handler
+from events import publish_payment_status
+from sessions import PaymentSessions
+from address_pool import AddressPool
+from payments import Payments
+from watcher import DepositWatcher
+from logger import logging as logger
+from config import REDIS_HOST, REDIS_PORT, REDIS_PASSWD, TOKEN as ds_token, GUILD_ID as guild_id, ROLE_NAME as role_name
+from send_message import Mailer
+from add_role import RoleAssigner
+from metrics import LoopMonitor, instrument_redis, serve as serve_metrics
+
+
+class PaymentWorker:
+    """
+    Consumes payment jobs from the Redis queue and verifies them with one deposit watcher per network.
+
+    A job is acknowledged once its payment is confirmed or its window has passed. A confirmed payment is
+    written to the confirmation outbox, whose handlers publish its status, send the email and grant the
+    Discord role independently of each other. Jobs are kept alive with heartbeats while they are being watched,
+    so a job whose worker dies is picked up by another one. A worker that is stopped hands the jobs it is still
+    watching back to the queue instead.
+
+    Attributes:
+        redis (Redis): The Redis client.
+        payments (Payments): The shared Payments instance.
+        sessions (PaymentSessions): The payment session store.
+        addresses (AddressPool): The deposit address pool expired addresses are returned to.
+        admission (CheckoutAdmission): The checkout admission control finished payments are released from.
+        queue (PaymentQueue): The payment job queue.
+        watchers (dict): The deposit watchers keyed by network name.
+        roles (RoleAssigner): The Discord role assigner of this process.
+        mail (Mailer): The outbound mail sender of this process.
+        outbox (ConfirmationOutbox): The outbox of confirmed payments and its handlers.
+        jobs (dict): The jobs being watched, keyed by payment id.
+    """
+
+    CONFIRM_ATTEMPTS = 3
+
+    def __init__(self, redis, payments, consumer=None):
+        """
+        Initializes the worker.
+
+        Args:
+            redis (Redis): The Redis client.
+            payments (Payments): The shared Payments instance.
+            consumer (str): The consumer name of this worker in the queue's consumer group.
+        """
+        self.redis = redis
+        self.payments = payments
+        self.sessions = PaymentSessions(redis)
+        self.addresses = AddressPool(redis)
+        self.admission = CheckoutAdmission(redis, self.sessions)
+        self.queue = PaymentQueue(redis, consumer)
+        self.watchers = {
+            network: DepositWatcher(network, payments, self.confirm, self.expire, self.paid)
+            for network in payments.networks
+        }
+        self.roles = RoleAssigner(ds_token, guild_id)
+        self.mail = Mailer(redis)
+        self.outbox = ConfirmationOutbox(redis, [
+            Handler('status', self.publish_status, concurrency=8),
+            Handler('email', self.send_email, timeout=120),
+            Handler('role', self.grant_role, timeout=60),
+        ], consumer=self.queue.consumer)
+        self.jobs = {}
+        self._task = None
+        self._stopping = False
+
+    async def start(self):
+        """
+        Starts the mail senders, the confirmation handlers and the deposit watchers and begins consuming jobs
+        in the background. Discord is connected to when the first role is granted.
+        """
+        await self.queue.setup()
+        await self.mail.start()
+        await self.outbox.start()
+        for watcher in self.watchers.values():
+            await watcher.start()
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        Stops consuming jobs, stops the deposit watchers, hands the unfinished jobs back to the queue,
+        stops the confirmation handlers and the mail senders and disconnects from Discord.
+        """
+        if self._task is not None:
+            # `run` also checks this flag, in case a client library swallows its cancellation
+            self._stopping = True
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for watcher in self.watchers.values():
+            await watcher.stop()
+        await self.drain()
+        await self.outbox.close()
+        await self.mail.close()
+        await self.roles.close()
+
+    async def drain(self):
+        """
+        Requeues the jobs still being watched, with the first block scanned for their deposit and its
+        baseline, so another worker resumes them right away instead of after the visibility timeout.
+        """
+        for key, job in list(self.jobs.items()):
+            deposit = self.watchers[job.network.lower()].pending.get(key)
+            if deposit is not None:
+                job.from_block = deposit.from_block
+                job.baseline = deposit.baseline
+            try:
+                await self.queue.requeue(job)
+                logger.info(f"Handed payment job for {job.wallet_address} back to the queue")
+            except Exception as e:
+                logger.exception(f"Failed to requeue the payment job for {job.wallet_address}: {e}")
+            del self.jobs[key]
+
+    async def run(self):
+        """
+        Reads new jobs, reclaims stale ones and sends heartbeats for the jobs being watched.
+        """
+        logger.info(f"Payment worker {self.queue.consumer} has started.")
+        next_maintenance = 0
+        while not self._stopping:
+            try:
+                jobs = await self.queue.read()
+                for job in jobs:
+                    await self.accept(job)
+                if not jobs:
+                    # A backend that answers an empty blocking read immediately must not starve the loop
+                    await asyncio.sleep(0.1)
+
+                now = time.monotonic()
+                if now >= next_maintenance:
+                    next_maintenance = now + self.queue.visibility_timeout / 3
+                    await self.queue.heartbeat(self.jobs.values())
+                    for job in await self.queue.reclaim():
+                        logger.info(f"Reclaimed payment job for {job.wallet_address}")
+                        await self.accept(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.bind(rate_limit=f"worker_{self.queue.consumer}").exception(f"Payment worker failed: {e}")
+                await asyncio.sleep(1)
+
+    async def accept(self, job):
+        """
+        Starts watching the deposit address of a job, or drops the job if it cannot be verified.
+
+        Args:
+            job (PaymentJob): The job to accept.
+        """
+        watcher = self.watchers.get(job.network.lower())
+        if watcher is None or not watcher.supports(job.token):
+            logger.info(f"Dropping payment job for {job.wallet_address}: {job.token} on {job.network} is not supported")
+            await self.queue.ack(job)
+            return
+        deadline = job.deadline
+        if PaymentQueue.is_expired(job):
+            # The session may have been extended while its deposit gathers confirmations
+            status, deadline = await self.sessions.get_status(job.payment_id)
+            if status != PaymentSessions.PENDING or deadline <= time.time():
+                await self.queue.ack(job)
+                return
+        self.jobs[job.payment_id] = job
+        watcher.watch(job.wallet_address, job.expected_amount, job.token, job.username, timeout=deadline - time.time(),
+                      from_block=job.from_block, baseline=job.baseline, shared=job.shared)
+
+    async def paid(self, deposit):
+        """
+        Keeps the payment session of a deposit that has been paid open until it has the confirmation depth.
+
+        Args:
+            deposit (PendingDeposit): The paid deposit.
+        """
+        watcher = self.watchers[deposit.network]
+        await self.sessions.extend(deposit.payment_id, time.time() + watcher.settle_timeout)
+
+    async def confirm(self, deposit):
+        """
+        Marks a payment confirmed once its deposit watcher has seen the expected amount arrive, and writes
+        it to the confirmation outbox for the handlers to complete, keyed on its session id.
+
+        Every step can be repeated, so a failed attempt is retried with backoff `CONFIRM_ATTEMPTS` times.
+        If all of them fail, the job is handed back to the queue with the first block scanned for its deposit
+        and its baseline, so the worker that picks it up finds the payment again.
+
+        Args:
+            deposit (PendingDeposit): The confirmed deposit.
+        """
+        job = self.jobs.pop(deposit.payment_id, None)
+        log = logger.bind(wallet=deposit.address, network=deposit.network, username=deposit.username)
+        for attempt in range(self.CONFIRM_ATTEMPTS):
+            try:
+                await self.sessions.confirm(deposit.payment_id)
+                details = await self.sessions.get(deposit.payment_id) or {}
+                session_id = details.get('session_id') or (job.id if job is not None else deposit.payment_id)
+                await self.outbox.publish(session_id, deposit.payment_id, {
+                    'wallet_address': deposit.address,
+                    'network': deposit.network,
+                    'token': deposit.token,
+                    'username': deposit.username,
+                    'user_id': job.user_id if job is not None else None,
+                    'confirmed_at': time.time(),
+                })
+                if job is not None:
+                    await self.admission.release(user_key(job.user_id, job.username), deposit.payment_id)
+                log.info("Payment confirmed")
+                break
+            except Exception as e:
+                log.exception(f"Failed to complete the payment to {deposit.address}: {e}")
+                if attempt + 1 < self.CONFIRM_ATTEMPTS:
+                    await asyncio.sleep(2 ** attempt)
+        else:
+            if job is not None:
+                job.from_block = deposit.from_block
+                job.baseline = deposit.baseline
+                try:
+                    await self.queue.requeue(job)
+                    log.info(f"Handed payment job for {deposit.address} back to the queue")
+                except Exception as e:
+                    # Left pending in the queue, to be reclaimed with the first block recorded at checkout
+                    log.exception(f"Failed to requeue the payment job for {deposit.address}: {e}")
+            return
+
+        if job is not None:
+            await self.queue.ack(job)
+
+    async def publish_status(self, event):
+        """
+        Notifies the browsers waiting on a confirmed payment.
+
+        Args:
+            event (dict): The confirmation event.
+        """
+        await publish_payment_status(self.redis, event['payment_id'], PaymentSessions.CONFIRMED)
+
+    async def send_email(self, event):
+        """
+        Sends the confirmation email of a payment to the address last saved for its username, or else to the one
+        copied into its session at checkout, if any.
+
+        Args:
+            event (dict): The confirmation event.
+
+        Raises:
+            RuntimeError: If the single attempt of the mailer to send the email failed, so the outbox retries it.
+        """
+        log = logger.bind(wallet=event['wallet_address'], network=event['network'], username=event['username'])
+        # The email may have been saved or changed after checkout, while the copy in the session outlives it
+        email = await self.sessions.get_email(event['username'])
+        if not email:
+            details = await self.sessions.get(event['payment_id']) or {}
+            email = details.get('email')
+        if not email:
+            log.info("Cant get email address")
+            return
+        log.info(f"Sending message to {email}")
+        recipient_email = email
+        subject = "10KDROP PAYMENT"
+        body = f"TEXT"
+        if not await self.mail.deliver(recipient_email, subject, body):
+            raise RuntimeError(f"Email to {recipient_email} was not sent")
+
+    async def grant_role(self, event):
+        """
+        Grants the Discord role of a confirmed payment.
+
+        Args:
+            event (dict): The confirmation event.
+
+        Raises:
+            RuntimeError: If the role has not been granted, so the outbox retries it.
+        """
+        log = logger.bind(wallet=event['wallet_address'], network=event['network'], username=event['username'])
+        log.info(f"Adding discord role")
+        formatted_username = event['username'].split("#")[0]
+        if not await self.roles.assign(role_name, user_id=event.get('user_id'), username=formatted_username):
+            raise RuntimeError(f"Role '{role_name}' was not granted to '{formatted_username}'")
+
+    async def expire(self, deposit):
+        """
+        Acknowledges the job of a deposit whose payment window has passed, notifies its subscribers,
+        returns a pooled deposit address to the address pool and frees the user's checkout slot.
+
+        Args:
+            deposit (PendingDeposit): The expired deposit.
+        """
+        if await self.sessions.expire(deposit.payment_id):
+            details = await self.sessions.get(deposit.payment_id) or {}
+            if 'address_index' in details:
+                await self.addresses.release(int(details['address_index']), deposit.address)
+        await publish_payment_status(self.redis, deposit.payment_id, PaymentSessions.EXPIRED)
+        job = self.jobs.pop(deposit.payment_id, None)
+        if job is not None:
+            await self.admission.release(user_key(job.user_id, job.username), deposit.payment_id)
+            await self.queue.ack(job)
+
+
+async def main():
+    """
+    Runs a standalone payment worker until it is interrupted or terminated.
+    """
+    redis = instrument_redis(aioredis.from_url(
+        f"redis://{REDIS_HOST}:{REDIS_PORT}",
+        password=REDIS_PASSWD,
+        encoding='utf-8'
+    ))
+    loop_monitor = LoopMonitor(stall_threshold=getattr(config, 'LOOP_STALL_THRESHOLD', None))
+    loop_monitor.start()
+    if getattr(config, 'METRICS_PORT', None):
+        serve_metrics(config.METRICS_PORT)
+
+    payments = Payments()
+    await payments.connect()
+    await payments.warm_up()
+
+    worker = PaymentWorker(redis, payments)
+    await worker.start()
+    stopped = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+    try:
+        await stopped.wait()
+    finally:
+        await worker.stop()
+        await payments.close()
+        await loop_monitor.close()
+        await redis.close()
+        await logger.complete()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())